@@ -1,6 +1,6 @@
 import tensorflow as tf
 import tensorflow.keras.layers as tfkl
-from Segmentation.model.unet_build_blocks import Conv_Block, Up_Conv
+from Segmentation.model.unet_build_blocks import Conv_Block, Up_Conv, get_recompute_policy
 from Segmentation.model.unet_build_blocks import Attention_Gate
 from Segmentation.model.unet_build_blocks import Recurrent_ResConv_block
 from Segmentation.model.backbone import Encoder
@@ -25,13 +25,18 @@ class UNet(tf.keras.Model):
                  dropout_rate=0.25,
                  use_spatial_dropout=True,
                  data_format='channels_last',
+                 recompute=False,
                  **kwargs):
+        """ recompute is a bool or a list with one bool per level, the blocks
+        of the levels set to True keep only their inputs and outputs for the
+        backward pass and recompute the activations inside them. """
 
         super(UNet, self).__init__(**kwargs)
 
         self.backbone_name = backbone_name
         self.contracting_path = []
         self.upsampling_path = []
+        recompute = get_recompute_policy(recompute, len(num_channels))
 
         if self.backbone_name == 'default':
             for i in range(len(num_channels)):
@@ -46,7 +51,8 @@ class UNet(tf.keras.Model):
                                                         use_dropout=use_dropout,
                                                         dropout_rate=dropout_rate,
                                                         use_spatial_dropout=use_spatial_dropout,
-                                                        data_format=data_format))
+                                                        data_format=data_format,
+                                                        recompute=recompute[i]))
                 if i != len(num_channels) - 1:
                     if use_2d:
                         self.contracting_path.append(tfkl.MaxPooling2D())
@@ -58,7 +64,7 @@ class UNet(tf.keras.Model):
             encoder.freeze_pretrained_layers()
             self.backbone = encoder.construct_backbone()
 
-        n = len(self.num_channels) - 2
+        n = len(num_channels) - 2
         for i in range(n, -1, -1):
             output = num_channels[i]
             self.upsampling_path.append(Up_Conv(output,
@@ -70,19 +76,22 @@ class UNet(tf.keras.Model):
                                                 use_transpose=False,
                                                 use_bias=use_bias,
                                                 strides=2,
-                                                data_format=data_format))
+                                                data_format=data_format,
+                                                recompute=recompute[i]))
 
         if use_2d:
             self.conv_1x1 = tfkl.Conv2D(num_classes,
                                         (1, 1),
                                         activation='sigmoid' if num_classes == 1 else 'softmax',
                                         padding='same',
+                                        dtype='float32',
                                         data_format=data_format)
         else:
             self.conv_1x1 = tfkl.Conv3D(num_classes,
                                         (1, 1, 1),
                                         activation='linear' if num_classes == 1 else 'softmax',
                                         padding='same',
+                                        dtype='float32',
                                         data_format=data_format)
 
     def call(self, x, training=False):
@@ -183,12 +192,14 @@ class R2_UNet(tf.keras.Model):
                                         kernel_size=(1, 1),
                                         activation='sigmoid' if num_classes == 1 else 'softmax',
                                         padding='same',
+                                        dtype='float32',
                                         data_format=data_format)
         else:
             self.conv_1x1 = tfkl.Conv3D(filters=num_classes,
                                         kernel_size=(1, 1, 1),
                                         activation='sigmoid' if num_classes == 1 else 'softmax',
                                         padding='same',
+                                        dtype='float32',
                                         data_format=data_format)
 
     def call(self, x, training=False):
@@ -252,12 +263,14 @@ class Nested_UNet(tf.keras.Model):
                                         (1, 1),
                                         activation='sigmoid' if self.num_classes == 1 else 'softmax',
                                         padding='same',
+                                        dtype='float32',
                                         data_format=data_format)
         else:
             self.conv_1x1 = tfkl.Conv3D(num_classes,
                                         (1, 1, 1),
                                         activation='sigmoid' if self.num_classes == 1 else 'softmax',
                                         padding='same',
+                                        dtype='float32',
                                         data_format=data_format)
 
     def call(self, input, training=False):
@@ -329,12 +342,14 @@ class Nested_UNet_v2(tf.keras.Model):
                                         (1, 1),
                                         activation='sigmoid' if self.num_classes == 1 else 'softmax',
                                         padding='same',
+                                        dtype='float32',
                                         data_format=data_format)
         else:
             self.conv_1x1 = tfkl.Conv3D(num_classes,
                                         (1, 1, 1),
                                         activation='sigmoid' if self.num_classes == 1 else 'softmax',
                                         padding='same',
+                                        dtype='float32',
                                         data_format=data_format)
 
     def call(self, input, training=False):
@@ -2,6 +2,60 @@ import tensorflow as tf
 import tensorflow.keras.layers as tfkl
 
 
+def is_built(model):
+    """ True once model and all of its sublayers have created their variables """
+    return model.built and all(layer.built for layer in model.layers)
+
+
+def recompute_call(layer, call, *inputs, outside=()):
+    """ Runs call(*inputs) under tf.recompute_grad, so only the inputs and
+    outputs of call are kept for the backward pass and the activations inside
+    it are recomputed from the inputs. The variables used by call have to exist
+    already, so the first (building) call must run without it.
+
+    The batchnorm layers of layer update their moving statistics in the
+    forward pass only, not again when it is recomputed for the gradients.
+    A recomputed dropout would draw a new mask for the gradients, so the
+    dropout layers of layer have to be run outside call, and listed in outside. """
+    dropouts = [module for module in layer.submodules
+                if isinstance(module, tfkl.Dropout) and module.rate > 0 and module not in outside]
+    if dropouts:
+        raise ValueError(f"{layer.name} can not recompute its dropout layers {[d.name for d in dropouts]}")
+    batchnorms = [module for module in layer.submodules if isinstance(module, tfkl.BatchNormalization)]
+    num_calls = [0]
+
+    def recomputable(*args):
+        num_calls[0] += 1
+        if num_calls[0] == 1:
+            return call(*args)
+        momentums = [batchnorm.momentum for batchnorm in batchnorms]
+        try:
+            # a momentum of 1 keeps the moving statistics as they are
+            for batchnorm in batchnorms:
+                batchnorm.momentum = 1.0
+            return call(*args)
+        finally:
+            for batchnorm, momentum in zip(batchnorms, momentums):
+                batchnorm.momentum = momentum
+
+    return tf.recompute_grad(recomputable)(*inputs)
+
+
+def call_layers(layers, x, training):
+    """ x through the layers in order, as a Sequential of them would """
+    for layer in layers:
+        x = layer(x, training=training)
+    return x
+
+
+def get_recompute_policy(recompute, num_levels):
+    """ Expands a single recompute bool to one per level """
+    if isinstance(recompute, bool):
+        return [recompute] * num_levels
+    assert len(recompute) == num_levels, f"recompute needs one value per level, got {len(recompute)} for {num_levels}"
+    return list(recompute)
+
+
 class Conv_Block(tf.keras.Sequential):
 
     def __init__(self,
@@ -16,11 +70,18 @@ class Conv_Block(tf.keras.Sequential):
                  dropout_rate=0.25,
                  use_spatial_dropout=True,
                  data_format='channels_last',
+                 recompute=False,
                  **kwargs):
 
         super(Conv_Block, self).__init__(**kwargs)
 
-        for _ in range(self.num_conv_layers):
+        self.recompute = recompute
+        self.use_dropout = use_dropout
+        spatial_axes = [1, 2] if use_2d else [1, 2, 3]
+        if data_format != 'channels_last':
+            spatial_axes = [axis + 1 for axis in spatial_axes]
+
+        for _ in range(num_conv_layers):
             if use_2d:
                 self.add(tfkl.Conv2D(num_channels,
                                      kernel_size,
@@ -37,7 +98,10 @@ class Conv_Block(tf.keras.Sequential):
                 self.add(tfkl.BatchNormalization(axis=-1 if data_format == 'channels_last' else 1,
                                                  momentum=0.95,
                                                  epsilon=0.001))
-            self.add(tfkl.Activation(nonlinearity))
+            if nonlinearity == 'prelu':
+                self.add(tfkl.PReLU(shared_axes=spatial_axes))
+            else:
+                self.add(tfkl.Activation(nonlinearity))
 
         if use_dropout:
             if use_spatial_dropout:
@@ -50,6 +114,13 @@ class Conv_Block(tf.keras.Sequential):
 
     def call(self, inputs, training=False):
 
+        if self.recompute and training and is_built(self):
+            # the dropout comes after the recomputed layers, so its gradients use the mask of the forward pass
+            dropout = self.layers[-1] if self.use_dropout else None
+            layers = self.layers[:-1] if self.use_dropout else self.layers
+            outputs = recompute_call(self, lambda x: call_layers(layers, x, training), inputs, outside=[dropout])
+            return dropout(outputs, training=training) if self.use_dropout else outputs
+
         outputs = super(Conv_Block, self).call(inputs, training=training)
 
         return outputs
@@ -68,11 +139,14 @@ class Up_Conv(tf.keras.Model):
                  use_bias=True,
                  strides=2,
                  data_format='channels_last',
+                 recompute=False,
                  **kwargs):
 
         super(Up_Conv, self).__init__(**kwargs)
 
         self.data_format = data_format
+        self.use_attention = use_attention
+        self.recompute = recompute
 
         if use_transpose:
             if use_2d:
@@ -123,6 +197,13 @@ class Up_Conv(tf.keras.Model):
 
     def call(self, inputs, bridge, training=False):
 
+        if self.recompute and training and is_built(self):
+            return recompute_call(self, lambda x, y: self.up_conv_call(x, y, training=training), inputs, bridge)
+
+        return self.up_conv_call(inputs, bridge, training=training)
+
+    def up_conv_call(self, inputs, bridge, training=False):
+
         up = self.upconv_layer(inputs)
         up = self.conv(up, training=training)
         if self.use_attention:
@@ -2,6 +2,7 @@ import tensorflow as tf
 import tensorflow.keras.layers as tfkl
 import inspect
 from Segmentation.model.vnet_build_blocks import Conv_ResBlock, Up_ResBlock
+from Segmentation.model.unet_build_blocks import get_recompute_policy
 
 class VNet(tf.keras.Model):
 
@@ -18,7 +19,11 @@ class VNet(tf.keras.Model):
                  use_spatial_dropout=True,
                  predict_slice=False,
                  slice_format="mean",
+                 recompute=False,
                  **kwargs):
+        """ recompute is a bool or a list with one bool per level, the blocks
+        of the levels set to True keep only their inputs and outputs for the
+        backward pass and recompute the activations inside them. """
 
         self.params = str(inspect.currentframe().f_locals)
         super(VNet, self).__init__(**kwargs)
@@ -28,33 +33,35 @@ class VNet(tf.keras.Model):
 
         block_args = {
             'use_2d': use_2d,
-            'num_conv_layers': num_conv_layers,
             'kernel_size': kernel_size,
-            'activation': activation,
+            'nonlinearity': activation,
             'use_batchnorm': use_batchnorm,
-            'dropout_rate': dropout_rate,
-            'use_spatial_dropout': use_spatial_dropout,
         }
+        recompute = get_recompute_policy(recompute, len(num_channels))
 
         self.contracting_path = []
 
         for i in range(len(num_channels)):
             output_ch = num_channels[i]
             self.contracting_path.append(Conv_ResBlock(output_ch,
-                                                       **block_args,
-                                                       **kwargs))
+                                                       num_conv_layers=num_conv_layers,
+                                                       dropout_rate=dropout_rate,
+                                                       use_spatial_dropout=use_spatial_dropout,
+                                                       res_activation=activation,
+                                                       recompute=recompute[i],
+                                                       **block_args))
 
         self.upsampling_path = []
         n = len(num_channels) - 1
         for i in range(n, -1, -1):
             output_ch = num_channels[i]
             self.upsampling_path.append(Up_ResBlock(output_ch,
-                                                    **block_args,
-                                                    **kwargs))
+                                                    recompute=recompute[i],
+                                                    **block_args))
 
         # convolution num_channels at the output
         if use_2d:
-            self.conv_output = tfkl.Conv2D(filters=num_channels,
+            self.conv_output = tfkl.Conv2D(filters=num_classes,
                                            kernel_size=kernel_size,
                                            activation=None,
                                            padding='same')
@@ -64,7 +71,7 @@ class VNet(tf.keras.Model):
                                            activation=None,
                                            padding='same')
         if activation == 'prelu':
-            self.activation = tfkl.PReLU()  # alpha_initializer=tf.keras.initializers.Constant(value=0.25))
+            self.activation = tfkl.PReLU(shared_axes=[1, 2] if use_2d else [1, 2, 3])  # alpha_initializer=tf.keras.initializers.Constant(value=0.25))
         else:
             self.activation = tfkl.Activation(activation)
 
@@ -77,7 +84,8 @@ class VNet(tf.keras.Model):
                                         kernel_size=(1, 1, 1),
                                         padding='same')
 
-        self.output_act = tfkl.Activation('sigmoid' if num_classes == 1 else 'softmax')
+        # softmax/sigmoid in float32 so mixed precision policies return float32 predictions
+        self.output_act = tfkl.Activation('sigmoid' if num_classes == 1 else 'softmax', dtype='float32')
 
     def call(self, x, training):
 
@@ -1,6 +1,6 @@
 import tensorflow as tf
 import tensorflow.keras.layers as tfkl
-from Segmentation.model.unet_build_blocks import Conv_Block, Up_Conv
+from Segmentation.model.unet_build_blocks import Conv_Block, Up_Conv, is_built, recompute_call
 
 class Conv_ResBlock(tf.keras.Model):
     def __init__(self,
@@ -8,9 +8,14 @@ class Conv_ResBlock(tf.keras.Model):
                  use_2d=False,
                  num_conv_layers=2,
                  kernel_size=3,
+                 nonlinearity='relu',
+                 use_batchnorm=False,
+                 dropout_rate=0.25,
+                 use_spatial_dropout=True,
                  strides=2,
                  res_activation='relu',
                  data_format='channels_last',
+                 recompute=False,
                  **kwargs):
 
         super(Conv_ResBlock, self).__init__(**kwargs)
@@ -20,15 +25,18 @@ class Conv_ResBlock(tf.keras.Model):
         self.num_conv_layers = num_conv_layers
         self.kernel_size = kernel_size
         self.strides = strides
-        self.res_activation = res_activation
         self.data_format = data_format
+        self.recompute = recompute
 
         self.conv_block = Conv_Block(num_channels=self.num_channels,
                                      use_2d=self.use_2d,
                                      num_conv_layers=self.num_conv_layers,
                                      kernel_size=self.kernel_size,
-                                     data_format=self.data_format,
-                                     **kwargs)
+                                     nonlinearity=nonlinearity,
+                                     use_batchnorm=use_batchnorm,
+                                     dropout_rate=dropout_rate,
+                                     use_spatial_dropout=use_spatial_dropout,
+                                     data_format=self.data_format)
         if self.use_2d:
             self.conv_stride = tfkl.Conv2D(num_channels * 2,
                                            kernel_size=(2, 2),
@@ -41,11 +49,16 @@ class Conv_ResBlock(tf.keras.Model):
                                            strides=strides,
                                            padding='same')
         if res_activation == 'prelu':
-            self.res_activation = tfkl.PReLU()
+            self.res_activation = tfkl.PReLU(shared_axes=[1, 2] if use_2d else [1, 2, 3])
         else:
             self.res_activation = tfkl.Activation(res_activation)
 
     def call(self, inputs, training):
+        if self.recompute and training and is_built(self):
+            return recompute_call(self, lambda x: self.res_block_call(x, training=training), inputs)
+        return self.res_block_call(inputs, training=training)
+
+    def res_block_call(self, inputs, training):
         x = inputs
         x = self.conv_block(x, training=training)
         x = tfkl.add([x, inputs])
@@ -58,19 +71,32 @@ class Up_ResBlock(tf.keras.Model):
                  num_channels,
                  use_2d=False,
                  kernel_size=3,
+                 nonlinearity='relu',
+                 use_batchnorm=False,
+                 data_format='channels_last',
+                 recompute=False,
                  **kwargs):
         super(Up_ResBlock, self).__init__(**kwargs)
 
         self.num_channels = num_channels
         self.use_2d = use_2d
         self.kernel_size = kernel_size
+        self.recompute = recompute
         self.up_conv = Up_Conv(num_channels=self.num_channels,
                                use_2d=self.use_2d,
                                kernel_size=self.kernel_size,
-                               **kwargs)
+                               nonlinearity=nonlinearity,
+                               use_batchnorm=use_batchnorm,
+                               data_format=data_format)
 
     def call(self, inputs, training):
         x, x_highway = inputs
+        if self.recompute and training and is_built(self):
+            return recompute_call(self, lambda x, y: self.res_block_call(x, y, training=training), x, x_highway)
+        return self.res_block_call(x, x_highway, training=training)
+
+    def res_block_call(self, x, x_highway, training):
         x_res_start = self.up_conv(x, x_highway, training=training)
-        x = tfkl.add([x, x_res_start])
+        # the residual runs over the skip connection, which has the output resolution
+        x = tfkl.add([x_highway, x_res_start])
         return x
@@ -3,15 +3,17 @@ from mpl_toolkits.mplot3d import Axes3D
 import matplotlib.animation as animation
 from matplotlib.animation import PillowWriter
 import io
+import numpy as np
 import tensorflow as tf
 
 def plot_volume(volume, show=False):
+    volume = np.asarray(volume)
     if len(volume.shape) == 3:
         voxel = volume[:, :, :] > 0
     else:
         voxel = volume[:, :, :, 0] > 0
     fig = plt.figure()
-    ax = fig.gca(projection='3d')
+    ax = fig.add_subplot(111, projection='3d')
 
     print("Beginning voxel representation")
     print("...please wait, it's going to take a while...")
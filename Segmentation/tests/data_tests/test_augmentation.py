@@ -0,0 +1,67 @@
+import numpy as np
+import tensorflow as tf
+
+
+def get_test_batch(batch_size=2, depth=48, width=64, num_classes=7):
+    image = tf.random.uniform((batch_size, depth, width, width, 1), seed=1)
+    classes = tf.random.uniform((batch_size, depth, width, width), maxval=num_classes, dtype=tf.int32, seed=2)
+    label = tf.one_hot(classes, num_classes)
+    return image, label
+
+
+def augment(image, label, seeds):
+    from Segmentation.utils.augmentation import apply_valid_random_crop_3d, apply_flip_3d, apply_rotate_3d
+
+    image, label = apply_valid_random_crop_3d(image, label, seeds, 8, 4, resize=True, random_shift=True, output_slice=False)
+    image, label = apply_flip_3d(image, label, seeds)
+    image, label = apply_rotate_3d(image, label, seeds)
+    return image, label
+
+
+def get_seeds(seed, epoch, batch_size=2):
+    from Segmentation.utils.augmentation import get_augmentation_seed
+
+    return tf.stack([get_augmentation_seed(seed, epoch, index) for index in range(batch_size)])
+
+
+def test_augmentation_is_reproducible():
+    image, label = get_test_batch()
+
+    image_a, label_a = augment(image, label, get_seeds(1, 0))
+    image_b, label_b = augment(image, label, get_seeds(1, 0))
+    assert np.array_equal(image_a.numpy(), image_b.numpy())
+    assert np.array_equal(label_a.numpy(), label_b.numpy())
+
+    image_c, _ = augment(image, label, get_seeds(1, 1))
+    assert not np.array_equal(image_a.numpy(), image_c.numpy())
+
+
+def test_resize_keeps_one_hot_labels():
+    image, label = get_test_batch()
+
+    _, label = augment(image, label, get_seeds(3, 0))
+    assert label.shape == (2, 8, 16, 16, 7)
+    assert np.array_equal(tf.reduce_sum(label, axis=-1).numpy(), np.ones((2, 8, 16, 16)))
+
+
+def test_intensity_matches_the_chained_adjustments():
+    from Segmentation.utils.augmentation import apply_random_intensity_3d, get_intensity_params
+
+    image, label = get_test_batch(batch_size=3, depth=8, width=16)
+    seeds = get_seeds(5, 0, batch_size=3)
+    out, out_label = apply_random_intensity_3d(image, label, seeds, prob=1.0)
+    assert out_label is label
+
+    params = [get_intensity_params(seed, True, True, True, 1.0).numpy() for seed in seeds]
+    # every sample draws its own parameters
+    assert len({tuple(p) for p in params}) == 3
+    for x, (delta, contrast, gamma, gain), y in zip(image, params, out):
+        x = tf.image.adjust_brightness(x, delta)
+        mean = tf.reduce_mean(x)
+        x = (x - mean) * contrast + mean
+        x = tf.image.adjust_gamma(x, gamma, gain)
+        np.testing.assert_allclose(y.numpy(), x.numpy(), rtol=1e-5, atol=1e-6)
+
+    # prob=0 leaves the image unchanged
+    out, _ = apply_random_intensity_3d(image, label, seeds, prob=0.0)
+    np.testing.assert_allclose(out.numpy(), image.numpy(), rtol=1e-6)
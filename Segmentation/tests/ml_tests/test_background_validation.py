@@ -0,0 +1,70 @@
+import queue
+
+import numpy as np
+import tensorflow as tf
+
+
+def read_scalars(log_dir):
+    """ {tag: [steps]} of the summaries under log_dir """
+    scalars = {}
+    for path in tf.io.gfile.glob(str(log_dir / 'whole_val_metrics' / 'events.*')):
+        for event in tf.compat.v1.train.summary_iterator(path):
+            for value in event.summary.value:
+                scalars.setdefault(value.tag, []).append(event.step)
+    return scalars
+
+
+def get_config(tmp_path):
+    from Segmentation.train.train import build_model
+
+    return {'model_fn': build_model, 'model_kwargs': {'num_channels': [4, 8], 'num_classes': 1, 'name': 'background'},
+            'tfrec_dir': str(tmp_path / 'tfrecords'), 'multi_class': False, 'crop_size': 8, 'depth_crop_size': 4,
+            'predict_slice': False, 'val_batch_size': 1, 'buffer_size': 1, 'num_volumes': None, 'gpu': None,
+            'inference_batch_size': 2, 'gaussian': False, 'tta': ()}
+
+
+def test_worker_validates_the_newest_checkpoint(tmp_path, monkeypatch):
+    from Segmentation.train import background_validation
+    from Segmentation.train.checkpoint import AsyncCheckpointManager
+
+    config = get_config(tmp_path)
+    model = config['model_fn'](**config['model_kwargs'])
+    model(tf.zeros((1, 8, 16, 16, 1)), training=False)
+    manager = AsyncCheckpointManager(model, str(tmp_path / 'checkpoints'), keep_top_k=1, keep_latest=0)
+    for epoch, loss in enumerate([2.0, 1.0]):
+        manager.save(epoch, loss)
+    manager.close()
+    assert not (tmp_path / 'checkpoints' / 'weights.000.npz').exists()
+
+    x = np.random.RandomState(0).rand(1, 16, 24, 24, 1).astype(np.float32)
+    dataset = tf.data.Dataset.from_tensors((x, (x > 0.5).astype(np.float32)))
+    monkeypatch.setattr(background_validation, 'get_whole_val_dataset', lambda *args: dataset)
+
+    # the first best, dropped by retention since, is skipped
+    requests = queue.Queue()
+    requests.put((0, str(tmp_path / 'checkpoints' / 'weights.000.npz')))
+    requests.put(None)
+    background_validation.whole_validation_worker(requests, str(tmp_path), config)
+    assert read_scalars(tmp_path) == {}
+
+    # of the queued checkpoints only the newest is validated
+    for request in [(0, str(tmp_path / 'checkpoints' / 'weights.000.npz')),
+                    (1, str(tmp_path / 'checkpoints' / 'weights.001.npz')), None]:
+        requests.put(request)
+    background_validation.whole_validation_worker(requests, str(tmp_path), config)
+    scalars = read_scalars(tmp_path)
+    assert scalars['loss'] == [1]
+    assert all(steps == [1] for steps in scalars.values())
+
+
+def test_background_validator_process(tmp_path):
+    from Segmentation.train.background_validation import BackgroundValidator
+
+    config = get_config(tmp_path)
+    validator = BackgroundValidator(config['model_fn'], config['model_kwargs'], config['tfrec_dir'], False, 8, 4)
+    validator.start(str(tmp_path))
+    # dropped by retention before the worker got to it
+    validator.submit(0, str(tmp_path / 'weights.000.npz'))
+    validator.close()
+    assert validator.process is None
+    assert read_scalars(tmp_path) == {}
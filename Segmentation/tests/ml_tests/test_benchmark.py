@@ -0,0 +1,14 @@
+import tensorflow as tf
+
+
+def test_benchmark_jit_skips_the_cache_runs_without_a_gpu(tmp_path):
+    from Segmentation.train.benchmark import benchmark_jit
+
+    results = benchmark_jit(('vnet',), crop_size=8, depth_crop_size=8, compile_cache_dir=str(tmp_path),
+                            num_channels=(4, 8), num_classes=1, num_steps=1)
+    runs = [result['run'] for result in results]
+    if tf.config.experimental.list_physical_devices('GPU'):
+        assert runs == ['tf.function', 'xla', 'xla cold cache', 'xla warm cache']
+    else:
+        assert runs == ['tf.function', 'xla']
+    assert all(result['step_s'] > 0 for result in results)
@@ -0,0 +1,81 @@
+import json
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+
+def get_model():
+    model = tf.keras.Sequential([tf.keras.layers.Dense(3), tf.keras.layers.BatchNormalization()])
+    model(tf.zeros((1, 2)), training=False)
+    return model
+
+
+def set_weights(model, value):
+    model.set_weights([np.full(w.shape, value, np.float32) for w in model.weights])
+
+
+def test_retention_and_restore_best(tmp_path):
+    from Segmentation.train.checkpoint import AsyncCheckpointManager
+
+    model = get_model()
+    manager = AsyncCheckpointManager(model, str(tmp_path), keep_top_k=2, keep_latest=1)
+    losses = [5.0, 1.0, 4.0, 2.0, 6.0]
+    for epoch, loss in enumerate(losses):
+        set_weights(model, epoch)
+        manager.save(epoch, loss)
+    manager.wait()
+
+    # the two best and the latest
+    assert sorted(path.name for path in tmp_path.glob('*.npz')) == ['weights.001.npz', 'weights.003.npz',
+                                                                    'weights.004.npz']
+    with open(tmp_path / 'checkpoints.json') as f:
+        assert [ckpt['epoch'] for ckpt in json.load(f)] == [1, 3, 4]
+
+    best = manager.restore_best()
+    assert best['epoch'] == 1 and best['loss'] == 1.0
+    for w in model.get_weights():
+        np.testing.assert_array_equal(w, 1)
+    manager.close()
+
+    # a resumed run carries on with the retention of the earlier one
+    manager = AsyncCheckpointManager(model, str(tmp_path), keep_top_k=2, keep_latest=1)
+    manager.save(5, 0.5)
+    manager.close()
+    assert sorted(path.name for path in tmp_path.glob('*.npz')) == ['weights.001.npz', 'weights.005.npz']
+
+
+def test_best_weights_are_saved_as_they_arrive(tmp_path):
+    from Segmentation.train.checkpoint import AsyncCheckpointManager
+
+    model, best_model, loaded = get_model(), get_model(), get_model()
+    bests = []
+    path = str(tmp_path / 'best_weights.tf')
+    manager = AsyncCheckpointManager(model, str(tmp_path / 'checkpoints'), best_model=best_model,
+                                     best_weights_path=path, on_best=lambda epoch, _: bests.append(epoch))
+    for epoch, loss in enumerate([3.0, 1.0, 2.0]):
+        set_weights(model, epoch)
+        manager.save(epoch, loss)
+        manager.wait()
+        loaded.load_weights(path).assert_existing_objects_matched()
+        for w in loaded.get_weights():
+            np.testing.assert_array_equal(w, 1 if epoch else 0)
+    manager.close()
+    assert bests == [0, 1]
+
+
+def test_writer_errors_are_raised_on_the_training_thread(tmp_path):
+    from Segmentation.train.checkpoint import AsyncCheckpointManager
+
+    def on_best(epoch, path):
+        raise OSError("disk full")
+
+    manager = AsyncCheckpointManager(get_model(), str(tmp_path), on_best=on_best)
+    manager.save(0, 1.0)
+    with pytest.raises(RuntimeError, match="Writing a checkpoint failed") as error:
+        manager.wait()
+    assert isinstance(error.value.__cause__, OSError)
+    with pytest.raises(RuntimeError):
+        manager.save(1, 0.5)
+    with pytest.raises(RuntimeError):
+        manager.close()
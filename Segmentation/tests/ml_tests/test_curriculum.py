@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+
+PHASES = [{'epoch': 2, 'crop_size': 16, 'depth_crop_size': 8, 'batch_size': 2},
+          {'epoch': 0, 'crop_size': 8, 'depth_crop_size': 4, 'batch_size': 4}]
+
+
+def test_crop_curriculum_phases():
+    from Segmentation.train.utils import CropCurriculum
+
+    curriculum = CropCurriculum(PHASES, num_train=8, num_valid=4)
+    assert [curriculum.get_phase(e)['crop_size'] for e in range(4)] == [8, 8, 16, 16]
+    assert [curriculum.get_phase(e)['steps_per_epoch'] for e in range(4)] == [2, 2, 4, 4]
+    assert curriculum.get_phase(3)['validation_steps'] == 2
+    assert curriculum.get_steps_before(3) == 2 + 2 + 4
+    with pytest.raises(ValueError):
+        CropCurriculum(PHASES[:1], 8, 4)
+    # fewer validation volumes than a batch of the first phase
+    with pytest.raises(ValueError, match='epoch 0: validation_steps'):
+        CropCurriculum(PHASES, num_train=8, num_valid=3)
+    # a batch of 2 does not split into 2 replicas x 2 micro-batches
+    with pytest.raises(ValueError, match='epoch 2: batch_size 2'):
+        CropCurriculum(PHASES, num_train=8, num_valid=4, num_replicas=2, accum_steps=2)
+    assert CropCurriculum(PHASES, num_train=8, num_valid=4, num_replicas=2).get_phase(0)['batch_size'] == 4
+
+
+def train_curriculum(epochs, log_dir, resume=None):
+    from Segmentation.train.local_cluster import get_synthetic_dataset, set_initial_weights
+    from Segmentation.train.train import Train, build_model
+    from Segmentation.train.utils import CropCurriculum, ConfusionMetric, LearningRateUpdate
+    from Segmentation.train.utils import get_strategy, distribute_dataset
+    from Segmentation.utils.losses import dice_loss
+
+    strategy = get_strategy()
+
+    def dataset_fn(num_examples):
+        def build(phase, start_epoch):
+            shape = (phase['depth_crop_size'] * 2,) + (phase['crop_size'] * 2,) * 2
+            return distribute_dataset(strategy, lambda batch_size, num_shards, shard_index: get_synthetic_dataset(
+                batch_size, num_shards, shard_index, num_examples=num_examples, shape=shape,
+                seed=phase['index'], start_epoch=start_epoch), phase['batch_size'])
+        return build
+
+    with strategy.scope():
+        model = build_model([4, 8], 1, 'curriculum', dropout_rate=0.0)
+        model(tf.zeros((1, 8, 16, 16, 1)), training=False)
+        set_initial_weights(model)
+        trainer = Train(epochs, 4, True, model, tf.keras.optimizers.SGD(0.1), dice_loss,
+                        LearningRateUpdate(0.1, 1.0, 1, warmup=0), False, ConfusionMetric(1),
+                        log_dir=log_dir, keep_top_k=1, keep_latest=0, resume=resume,
+                        curriculum=CropCurriculum(PHASES, num_train=8, num_valid=4))
+        run_dir = trainer.train_model_loop(dataset_fn(8), dataset_fn(4), strategy, False)
+        # the loop ends on the best epoch's weights, the last step's are in the resume state
+        tf.train.Checkpoint(model=model).restore(tf.train.latest_checkpoint(run_dir + '/resume')).expect_partial()
+    return run_dir, [w.numpy() for w in model.weights]
+
+
+def test_resume_within_curriculum(tmp_path):
+    _, weights = train_curriculum(4, str(tmp_path / 'full'))
+    # stops in the second phase and carries on in it
+    run_dir, _ = train_curriculum(3, str(tmp_path / 'resumed'))
+    _, resumed_weights = train_curriculum(4, str(tmp_path / 'resumed'), resume=run_dir)
+
+    for w, resumed in zip(weights, resumed_weights):
+        np.testing.assert_allclose(w, resumed, atol=1e-6)
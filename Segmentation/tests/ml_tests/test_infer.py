@@ -0,0 +1,56 @@
+import h5py
+import numpy as np
+import tensorflow as tf
+
+
+def test_infer_directory_writes_the_masks(tmp_path):
+    from Segmentation.train.infer import infer_directory, infer_volume, load_volume
+    from Segmentation.train.train import build_model
+    from Segmentation.train.validation import get_predict_fn
+
+    input_dir, output_dir = tmp_path / 'volumes', tmp_path / 'masks'
+    input_dir.mkdir()
+    rng = np.random.RandomState(0)
+    for idx in range(3):
+        # (height, width, depth) as the OAI .im files
+        with h5py.File(input_dir / f'train_{idx:03d}_V00.im', 'w') as hf:
+            hf.create_dataset('data', data=rng.rand(40, 40, 24).astype(np.float32))
+
+    model_args = ([4, 8], 7, 'infer')
+    model = build_model(*model_args)
+    model(tf.zeros((1, 16, 16, 16, 1)), training=False)
+    model.save_weights(str(tmp_path / 'best_weights.tf'))
+
+    volumes_per_min = infer_directory(build_model, model_args, None, str(tmp_path / 'best_weights.tf'),
+                                      str(input_dir), str(output_dir), crop_size=8, depth_crop_size=8,
+                                      batch_size=3, num_readers=2, num_writers=2, prefetch=1)
+    assert volumes_per_min > 0
+
+    volume = load_volume(input_dir / 'train_002_V00.im')
+    assert volume.shape == (24, 40, 40, 1)
+    pred = infer_volume(get_predict_fn(model), volume, 7, 8, 8)
+    with h5py.File(output_dir / 'train_002_V00.seg.h5', 'r') as hf:
+        mask = np.array(hf['data'])
+    assert mask.dtype == np.uint8 and mask.shape == (40, 40, 24)
+    np.testing.assert_array_equal(np.rollaxis(mask, 2, 0), np.argmax(pred, axis=-1))
+
+
+def test_select_model_builds_the_trained_vnet(tmp_path):
+    from types import SimpleNamespace
+
+    from select_model import select_model
+    from Segmentation.train.train import build_model
+
+    flags = SimpleNamespace(model_architecture='vnet', num_filters=[4, 8], use_2d=False, num_conv=3, kernel_size=3,
+                            activation='prelu', use_batchnorm=True, dropout_rate=0.3, use_spatial=True,
+                            channel_order='channels_last')
+    model_fn, model_args = select_model(flags, 7)
+    model = model_fn(*model_args)
+    assert model.noise == 0.0 and model.contracting_path[0].num_conv_layers == 3
+
+    # the weights of a run of train.main load into it
+    trained = build_model([4, 8], 7, 'select', num_conv_layers=3, dropout_rate=0.3)
+    trained(tf.zeros((1, 16, 16, 16, 1)), training=False)
+    trained.save_weights(str(tmp_path / 'best_weights.tf'))
+    model(tf.zeros((1, 16, 16, 16, 1)), training=False)
+    model.load_weights(str(tmp_path / 'best_weights.tf')).assert_existing_objects_matched()
@@ -0,0 +1,43 @@
+import numpy as np
+import tensorflow as tf
+
+
+def get_test_batch(batch_size=2, depth=8, width=16, num_classes=7):
+    classes = tf.random.uniform((batch_size, depth, width, width), maxval=num_classes, dtype=tf.int32, seed=1)
+    y_true = tf.one_hot(classes, num_classes)
+    y_pred = tf.nn.softmax(tf.random.normal((batch_size, depth, width, width, num_classes), seed=2) * 3)
+    return y_true, y_pred
+
+
+def test_confusion_scores_match_losses():
+    from Segmentation.train.utils import ConfusionStatistics
+    from Segmentation.utils.losses import dsc, iou_loss, dice_coef_eval_3d, iou_loss_eval_3d
+
+    y_true, y_pred = get_test_batch()
+    stats = ConfusionStatistics(7)
+    # two updates of half the batch accumulate to the statistics of the whole
+    # batch, the tolerance covers the smooth=1 the losses add
+    stats.update_state(y_true[:1], y_pred[:1])
+    stats.update_state(y_true[1:], y_pred[1:])
+    scores = stats.get_scores()
+
+    np.testing.assert_allclose(scores['all']['dice'], dsc(y_true, y_pred), atol=1e-3)
+    np.testing.assert_allclose(scores['all']['mIoU'], iou_loss(y_true, y_pred), atol=1e-3)
+    np.testing.assert_allclose(scores['6ch']['dice'], dice_coef_eval_3d(y_true, y_pred), atol=1e-3)
+    np.testing.assert_allclose(scores['6ch']['mIoU'], iou_loss_eval_3d(y_true, y_pred), atol=1e-3)
+
+
+def test_hard_confusion_counts():
+    from Segmentation.train.utils import ConfusionStatistics
+
+    y_true, y_pred = get_test_batch()
+    stats = ConfusionStatistics(7, hard=True)
+    stats.update_state(y_true, y_pred)
+
+    true_class = np.argmax(y_true, -1).ravel()
+    pred_class = np.argmax(y_pred, -1).ravel()
+    for c in range(7):
+        assert stats.tp.numpy()[c] == np.sum((true_class == c) & (pred_class == c))
+        assert stats.fp.numpy()[c] == np.sum((true_class != c) & (pred_class == c))
+        assert stats.fn.numpy()[c] == np.sum((true_class == c) & (pred_class != c))
+        assert stats.tn.numpy()[c] == np.sum((true_class != c) & (pred_class != c))
@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+import tensorflow as tf
+
+
+def parse_id(example_proto, training, augmentation=None, multi_class=True, use_bfloat16=False, use_RGB=False, seed=None):
+    features = tf.io.parse_single_example(example_proto, {'id': tf.io.FixedLenFeature([], tf.int64)})
+    return features['id'], seed
+
+
+def write_records(tfrecords_dir):
+    """ 4 files of 3 records with the ids 0 to 11 """
+    for f in range(4):
+        with tf.io.TFRecordWriter(os.path.join(tfrecords_dir, f'{f:03d}-of-004.tfrecords')) as writer:
+            for i in range(3):
+                feature = {'id': tf.train.Feature(int64_list=tf.train.Int64List(value=[f * 3 + i]))}
+                writer.write(tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString())
+
+
+def test_read_tfrecord_shards_split_the_files(tmp_path):
+    from Segmentation.utils.data_loader import read_tfrecord_2d
+
+    write_records(tmp_path)
+
+    ids, seeds = [], []
+    for shard_index in range(2):
+        dataset = read_tfrecord_2d(str(tmp_path), 3, 12, None, parse_fn=parse_id, is_training=True,
+                                   num_shards=2, shard_index=shard_index)
+        # two epochs of the shard
+        shard_ids, shard_seeds = zip(*[(i.numpy(), s.numpy()) for i, s in dataset.take(4)])
+        ids.append(np.concatenate(shard_ids).reshape(2, 6))
+        seeds.append(np.concatenate(shard_seeds).reshape(2, 6, 2))
+
+    for epoch in range(2):
+        # every epoch the shards hold disjoint files that add up to all of them
+        assert sorted(np.concatenate([ids[0][epoch], ids[1][epoch]])) == list(range(12))
+        assert set(ids[0][epoch] // 3).isdisjoint(ids[1][epoch] // 3)
+    # and no two samples share an augmentation key
+    keys = np.concatenate(seeds).reshape(-1, 2)
+    assert len(set(map(tuple, keys))) == len(keys)
+
+
+def test_read_tfrecord_starts_at_an_epoch(tmp_path):
+    from Segmentation.utils.data_loader import read_tfrecord_2d
+
+    write_records(tmp_path)
+
+    def read(start_epoch, num_batches):
+        dataset = read_tfrecord_2d(str(tmp_path), 5, 12, None, parse_fn=parse_id, is_training=True,
+                                   start_epoch=start_epoch)
+        return [(i.numpy(), s.numpy()) for i, s in dataset.take(num_batches)]
+
+    # two batches of 5 an epoch, the remainder of 2 is dropped
+    batches = read(0, 6)
+    assert all(len(set(ids)) == 5 for ids, _ in batches)
+    assert len(set(np.concatenate([ids for ids, _ in batches[:2]]))) == 10
+    for (ids, seeds), (start_ids, start_seeds) in zip(batches[4:], read(2, 2)):
+        np.testing.assert_array_equal(start_ids, ids)
+        np.testing.assert_array_equal(start_seeds, seeds)
+
+
+def test_workers_match_mirrored_replicas(tmp_path):
+    from Segmentation.train.local_cluster import launch
+
+    config = {'batch_size': 4, 'epochs': 1, 'steps_per_epoch': 2, 'shape': (16, 32, 32),
+              'num_channels': (4, 8), 'lr': 0.1, 'threads': 1, 'num_replicas': 1}
+    workers = launch(2, config, str(tmp_path / 'workers'))
+    reference = launch(1, dict(config, num_replicas=2), str(tmp_path / 'reference'))[0]
+
+    assert [worker['chief'] for worker in workers] == [True, False]
+    for worker in workers:
+        for w, ref in zip(worker['weights'], reference['weights']):
+            np.testing.assert_allclose(w, ref, atol=1e-5)
+    # only the chief writes the run dir
+    assert len(list((tmp_path / 'workers').glob('*/*/*/*/*'))) == 1
@@ -0,0 +1,37 @@
+import pytest
+
+
+MODEL_ARGS = ([4, 8], 7, 'planner')
+
+
+def test_estimate_grows_with_the_batch_and_crop():
+    from Segmentation.train.planner import estimate_train_step
+    from Segmentation.train.train import build_model
+
+    model = build_model(*MODEL_ARGS)
+    one = estimate_train_step(model, 16, 8, 1)
+    two = estimate_train_step(model, 16, 8, 2)
+    larger = estimate_train_step(model, 32, 8, 1)
+    assert one['peak_mb'] < two['peak_mb'] < 2 * one['peak_mb']
+    assert two['gflops'] == pytest.approx(2 * one['gflops'])
+    # four times the voxels
+    assert larger['gflops'] == pytest.approx(4 * one['gflops'])
+
+
+def test_plan_recommends_the_largest_config_that_fits():
+    from Segmentation.train.planner import plan, choose_batch_size, get_candidates
+    from Segmentation.train.train import build_model
+
+    candidates = get_candidates(crop_sizes=(16, 32), depth_crop_sizes=(8,), batch_sizes=(1, 2, 4))
+    _, rows = plan(build_model, MODEL_ARGS, memory_budget_mb=1e6, candidates=candidates)
+    budget = {(row['crop_size'], row['batch_size']): row['peak_mb'] for row in rows}[(32, 1)]
+
+    best, rows = plan(build_model, MODEL_ARGS, memory_budget_mb=budget, candidates=candidates)
+    assert (best['crop_size'], best['batch_size']) == (32, 1)
+    assert all(row['voxels'] <= best['voxels'] for row in rows if row['fits'])
+
+    batch_size = max(row['batch_size'] for row in rows if row['crop_size'] == 16 and row['fits'])
+    assert choose_batch_size(build_model, MODEL_ARGS, crop_size=16, depth_crop_size=8,
+                             memory_budget_mb=budget, num_replicas=2) == 2 * batch_size
+    with pytest.raises(ValueError):
+        choose_batch_size(build_model, MODEL_ARGS, crop_size=16, depth_crop_size=8, memory_budget_mb=1)
@@ -0,0 +1,83 @@
+import json
+
+import pytest
+import tensorflow as tf
+
+
+def test_step_profiler_writes_a_record_per_step(tmp_path):
+    from Segmentation.train.profiler import StepProfiler
+
+    profiler = StepProfiler(str(tmp_path))
+    strategy = tf.distribute.get_strategy()
+    x = tf.zeros((2, 8, 16, 16, 1))
+    for epoch in range(2):
+        for training, num_steps in ((True, 3), (False, 2)):
+            for _ in range(num_steps):
+                with profiler.phase('data'):
+                    pass
+                with profiler.phase('compute'):
+                    tf.reduce_sum(x).numpy()
+                profiler.end_step(epoch, x, strategy, training)
+        with profiler.phase('checkpoint'):
+            pass
+        assert profiler.end_epoch(epoch).startswith(" - data: ")
+    profiler.close()
+
+    with open(tmp_path / 'profile.jsonl') as f:
+        records = [json.loads(line) for line in f]
+    steps = [record for record in records if 'step' in record]
+    epochs = [record for record in records if 'step' not in record]
+    assert len(steps) == 10 and [record['epoch'] for record in epochs] == [0, 1]
+    # validation steps do not count as global steps
+    assert [record['step'] for record in steps if record['training']] == [0, 1, 2, 3, 4, 5]
+    assert [record['step'] for record in steps if not record['training']] == [3, 3, 6, 6]
+    for record in steps:
+        assert record['examples'] == 2 and record['voxels'] == 2 * 8 * 16 * 16
+        assert set(f'{phase}_s' for phase in StepProfiler.phases) <= set(record)
+        assert record['compute_s'] > 0 and record['visualise_s'] == 0
+    for record in epochs:
+        assert record['checkpoint_s'] >= 0 and record['other_s'] >= 0
+        assert record['epoch_s'] >= record['data_s'] + record['compute_s']
+
+
+def test_disabled_profiler_writes_nothing(tmp_path):
+    from Segmentation.train.profiler import StepProfiler
+
+    profiler = StepProfiler(str(tmp_path), enabled=False)
+    with profiler.phase('compute'):
+        pass
+    profiler.end_step(0, tf.zeros((1, 1)), tf.distribute.get_strategy())
+    assert profiler.end_epoch(0) == ""
+    profiler.close()
+    assert not (tmp_path / 'profile.jsonl').exists()
+
+
+def test_parse_profile_steps():
+    from Segmentation.train.profiler import parse_profile_steps
+
+    assert parse_profile_steps(None) == (None, None)
+    assert parse_profile_steps('') == (None, None)
+    assert parse_profile_steps('3:7') == (3, 7)
+    # a single step
+    assert parse_profile_steps('5') == (5, 6)
+    assert parse_profile_steps(5) == (5, 6)
+    for profile_steps in ('7:3', '4:4', '-1:2', 'a:b', '1:2:3'):
+        with pytest.raises(ValueError):
+            parse_profile_steps(profile_steps)
+
+
+def test_trace_window(tmp_path):
+    from Segmentation.train.profiler import TraceWindow
+
+    assert TraceWindow(None, str(tmp_path)).steps_to_boundary(0) is None
+    assert not TraceWindow('3:7', None).enabled
+
+    trace = TraceWindow('3:7', str(tmp_path / 'trace'))
+    assert [trace.steps_to_boundary(step) for step in (0, 2, 3, 5, 7, 9)] == [3, 1, 4, 2, None, None]
+    for step in range(9):
+        trace.update(step)
+        assert trace.active == (3 <= step < 7)
+        with trace.step_context('train', step):
+            tf.reduce_sum(tf.ones((4, 4))).numpy()
+    trace.close()
+    assert list((tmp_path / 'trace').glob('plugins/profile/*/*'))
@@ -0,0 +1,86 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+
+def post(url, x):
+    from Segmentation.train.serving import from_npy, to_npy
+
+    request = urllib.request.Request(url, data=to_npy(x), headers={'Content-Type': 'application/octet-stream'})
+    with urllib.request.urlopen(request) as response:
+        return from_npy(response.read())
+
+
+def test_micro_batcher_groups_concurrent_requests():
+    from Segmentation.train.serving import MicroBatcher, get_batch_sizes
+
+    assert get_batch_sizes(8) == [1, 2, 4, 8]
+    assert get_batch_sizes(6) == [1, 2, 4, 6]
+
+    calls = []
+
+    def predict_fn(x):
+        calls.append(x.shape)
+        return tf.constant(x * 2)
+
+    batcher = MicroBatcher(predict_fn, max_batch_size=4, max_wait_ms=200)
+    futures = [batcher.submit(np.full((2, 3), i)) for i in range(5)] + [batcher.submit(np.ones((3, 3)))]
+    for i, future in enumerate(futures[:5]):
+        np.testing.assert_array_equal(future.result(5), np.full((2, 3), 2 * i))
+    np.testing.assert_array_equal(futures[5].result(5), np.full((3, 3), 2))
+    batcher.close()
+
+    # a full batch, the one left padded to 1 and the other shape on its own
+    assert sorted(calls) == [(1, 2, 3), (1, 3, 3), (4, 2, 3)]
+    stats = batcher.get_stats()
+    assert stats['requests'] == 6 and stats['mean_batch_size'] == 2
+    assert 0 < stats['p50_ms'] <= stats['p99_ms']
+
+
+def test_inference_service(tmp_path):
+    from Segmentation.train.serving import InferenceService
+    from Segmentation.train.train import build_model
+
+    model_args = ([4, 8], 7, 'serving')
+    model = build_model(*model_args)
+    model(tf.zeros((1, 8, 16, 16, 1)), training=False)
+    model.save_weights(str(tmp_path / 'best_weights.tf'))
+
+    service = InferenceService({'vnet': {'model_fn': build_model, 'model_args': model_args,
+                                         'weights_path': str(tmp_path / 'best_weights.tf'),
+                                         'example_shape': (8, 16, 16, 1)}},
+                               max_batch_size=4, max_wait_ms=50)
+    url = service.start()
+    try:
+        assert url.startswith('http://127.0.0.1:')
+        xs = np.random.RandomState(0).rand(8, 8, 16, 16, 1).astype(np.float32)
+        preds = [None] * len(xs)
+
+        def request(i):
+            preds[i] = post(f'{url}/predict/vnet', xs[i])
+        threads = [threading.Thread(target=request, args=(i,)) for i in range(len(xs))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        np.testing.assert_allclose(np.stack(preds), model(xs, training=False).numpy(), atol=1e-5)
+
+        mask = post(f'{url}/predict/vnet?mask=1', xs[0])
+        assert mask.dtype == np.uint8
+        np.testing.assert_array_equal(mask, np.argmax(preds[0], axis=-1))
+
+        with urllib.request.urlopen(f'{url}/stats') as response:
+            stats = json.loads(response.read())['vnet']
+        assert stats['requests'] == 9 and stats['mean_batch_size'] > 1
+        assert stats['p50_ms'] <= stats['p90_ms'] <= stats['p99_ms']
+
+        with pytest.raises(urllib.error.HTTPError) as error:
+            post(f'{url}/predict/unet', xs[0])
+        assert error.value.code == 404
+    finally:
+        service.close()
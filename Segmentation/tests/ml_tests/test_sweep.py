@@ -0,0 +1,92 @@
+import csv
+import json
+import os
+import subprocess
+import sys
+from time import sleep, time
+
+
+def fake_train(log_dir, epochs, name, lr, sleep_s=0.0):
+    """ Writes the epochs.jsonl of a run whose validation loss is lr / epoch """
+    run_dir = os.path.join(log_dir, name, 'run')
+    os.makedirs(run_dir, exist_ok=True)
+    with open(os.path.join(run_dir, 'epochs.jsonl'), 'a') as f:
+        for e in range(epochs):
+            sleep(sleep_s)
+            f.write(json.dumps({'epoch': e, 'loss': lr, 'val_loss': lr / (e + 1)}) + '\n')
+            f.flush()
+
+
+def fake_train_with_child(log_dir, epochs, name, lr, sleep_s=0.0):
+    """ fake_train that starts a child process first, as the data loaders or
+    the background validation of a run do """
+    os.makedirs(log_dir, exist_ok=True)
+    child = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])
+    with open(os.path.join(log_dir, 'child.pid'), 'w') as f:
+        f.write(str(child.pid))
+    fake_train(log_dir, epochs, name, lr, sleep_s)
+    child.terminate()
+    child.wait()
+
+
+def is_running(pid):
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # zombies are done, only waiting for their parent to reap them
+            return f.read().split(')')[-1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+
+
+def test_successive_halving_keeps_the_best_third():
+    from Segmentation.train.sweep import SuccessiveHalving
+
+    scheduler = SuccessiveHalving(max_epochs=9, min_epochs=1, eta=3)
+    assert scheduler.rungs == [1, 3]
+    # the first trial at a rung has nothing to lose to
+    assert scheduler.report(1, 0.5)
+    assert not scheduler.report(1, 0.6)
+    assert scheduler.report(1, 0.4)
+    assert not scheduler.report(1, float('nan'))
+    # not a rung
+    assert scheduler.report(2, 1.0)
+
+
+def test_sample_configs():
+    from Segmentation.train.sweep import sample_configs
+
+    grid = sample_configs({'crop_size': [64, 96], 'aug': [[], ['flip']]})
+    assert len(grid) == 4 and {'crop_size': 96, 'aug': ['flip']} in grid
+
+    configs = sample_configs({'lr': ('log_uniform', 1e-5, 1e-3), 'num_channels': ('int', 4, 8)}, 20, seed=0)
+    assert configs == sample_configs({'lr': ('log_uniform', 1e-5, 1e-3), 'num_channels': ('int', 4, 8)}, 20, seed=0)
+    assert all(1e-5 <= c['lr'] <= 1e-3 and 4 <= c['num_channels'] <= 8 for c in configs)
+
+
+def test_sweep_stops_poor_trials(tmp_path):
+    from Segmentation.train.sweep import run_sweep
+
+    rows = run_sweep({'lr': [0.1 * i for i in range(1, 10)]},
+                     {'epochs': 9, 'name': 'fake', 'sleep_s': 0.2},
+                     str(tmp_path), max_concurrent=3, eta=3, train_fn=fake_train, poll_interval=0.1)
+
+    statuses = [row['status'] for row in rows]
+    assert statuses[0] == 'completed' and rows[0]['epochs'] == 9
+    assert set(statuses) == {'completed', 'stopped'}
+    assert sum(row['epochs'] for row in rows) < 9 * 9
+    with open(tmp_path / 'results.csv') as f:
+        assert [int(row['trial']) for row in csv.DictReader(f)] == list(range(9))
+
+
+def test_stopped_trials_take_their_children_along(tmp_path):
+    from Segmentation.train.sweep import run_sweep
+
+    rows = run_sweep({'lr': [0.1, 0.9]}, {'epochs': 3, 'name': 'fake', 'sleep_s': 0.5},
+                     str(tmp_path), max_concurrent=1, eta=3, train_fn=fake_train_with_child, poll_interval=0.1)
+    assert [row['status'] for row in rows] == ['completed', 'stopped']
+    with open(tmp_path / 'trial_001' / 'child.pid') as f:
+        pid = int(f.read())
+    deadline = time() + 10
+    while is_running(pid) and time() < deadline:
+        sleep(0.1)
+    assert not is_running(pid)
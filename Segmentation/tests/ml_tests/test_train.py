@@ -0,0 +1,198 @@
+import multiprocessing
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+
+def get_trainer(model, optimizer=None, loss_func=None, batch_size=2, epochs=1, **kwargs):
+    from Segmentation.train.train import Train
+    from Segmentation.train.utils import ConfusionMetric, LearningRateUpdate
+    from Segmentation.utils.losses import dice_loss
+
+    optimizer = optimizer or tf.keras.optimizers.SGD(0.1)
+    kwargs = dict({'steps_per_epoch': 1, 'validation_steps': 1}, **kwargs)
+    return Train(epochs, batch_size, True, model, optimizer, loss_func or dice_loss,
+                 LearningRateUpdate(0.1, 1.0, 1, warmup=0), False, ConfusionMetric(1), **kwargs)
+
+
+def get_models(num=2, name='model', **kwargs):
+    """ num models with the same initial weights """
+    from Segmentation.train.train import build_model
+
+    models = [build_model([4, 8], 1, name, dropout_rate=0.0, **kwargs) for _ in range(num)]
+    for model in models:
+        model(get_batch()[0], training=False)
+    for model in models[1:]:
+        model.set_weights(models[0].get_weights())
+    return models
+
+
+def train_loop(log_dir, epochs=2, steps_per_epoch=4, num_batches=None, starts=None, **kwargs):
+    """ Trains a fixed initial model for epochs on synthetic volumes, returns
+    the model and the run dir. The datasets are functions of the epoch they
+    start at, which are appended to starts. num_batches ends the train stream
+    early, as a crash would. """
+    from Segmentation.train.local_cluster import get_synthetic_dataset, set_initial_weights
+    from Segmentation.train.utils import distribute_dataset
+
+    strategy = tf.distribute.MirroredStrategy(['/cpu:0'])
+
+    def dataset_fn(is_training):
+        def build(start_epoch):
+            if is_training and starts is not None:
+                starts.append(start_epoch)
+
+            def shard_fn(batch_size, num_shards, shard_index):
+                dataset = get_synthetic_dataset(batch_size, num_shards, shard_index, num_examples=8 if is_training else 4,
+                                                shape=(8, 16, 16), start_epoch=start_epoch)
+                return dataset.take(num_batches) if is_training and num_batches else dataset
+            return distribute_dataset(strategy, shard_fn, 2)
+        return build
+
+    with strategy.scope():
+        model, = get_models(num=1, name='loop')
+        set_initial_weights(model)
+        trainer = get_trainer(model, epochs=epochs, log_dir=str(log_dir), steps_per_epoch=steps_per_epoch,
+                              validation_steps=2, keep_top_k=1, keep_latest=0, **kwargs)
+        run_dir = trainer.train_model_loop(dataset_fn(True), dataset_fn(False), strategy, False)
+    return model, run_dir
+
+
+def load_last_state(model, run_dir):
+    """ The loop ends on the best epoch's weights, the last step's are in the resume state """
+    tf.train.Checkpoint(model=model).restore(tf.train.latest_checkpoint(run_dir + '/resume')).expect_partial()
+    return model.get_weights()
+
+
+def mean_squared_error(y_true, y_pred):
+    # the mean of equal micro-batches' losses is the loss of the whole batch
+    return tf.reduce_mean(tf.square(y_true - y_pred))
+
+
+def get_main_train(argv, num_cores):
+    """ The batch of main's Train on num_cores CPU replicas, in a process of its own to set up the devices """
+    from flags import FLAGS
+    from main import get_train
+    from Segmentation.train.train import build_model
+    from Segmentation.train.utils import LearningRateUpdate
+    from Segmentation.utils.losses import dice_loss
+
+    cpu = tf.config.experimental.list_physical_devices('CPU')[0]
+    tf.config.experimental.set_virtual_device_configuration(
+        cpu, [tf.config.experimental.VirtualDeviceConfiguration()] * num_cores)
+    strategy = tf.distribute.MirroredStrategy([f'/cpu:{i}' for i in range(num_cores)])
+    FLAGS(['main', f'--num_cores={num_cores}'] + argv)
+    with strategy.scope():
+        model = build_model([4, 8], 1, 'main')
+    train = get_train(strategy, model, tf.keras.optimizers.SGD(0.1), dice_loss,
+                      LearningRateUpdate(0.1, 1.0, 1, warmup=0), 1, 1, 1)
+    return train.batch_size
+
+
+def get_batch(batch_size=2, shape=(8, 16, 16)):
+    x = np.random.RandomState(0).rand(batch_size, *shape, 1).astype(np.float32)
+    return tf.constant(x), tf.constant((x > 0.5).astype(np.float32))
+
+
+@pytest.mark.parametrize('precision', [None, 'float16'])
+def test_train_step_with_mixed_precision(precision):
+    from Segmentation.train.train import build_model
+    from Segmentation.train.utils import get_loss_scale_optimizer, setup_mixed_precision
+
+    setup_mixed_precision(precision)
+    try:
+        model = build_model([4, 8], 1, 'mixed_precision', dropout_rate=0.0)
+        x, y = get_batch()
+        model(x, training=False)
+        before = [w.numpy() for w in model.trainable_weights]
+        trainer = get_trainer(model, get_loss_scale_optimizer(tf.keras.optimizers.SGD(0.1), precision))
+        assert trainer.loss_scale == (precision == 'float16')
+
+        loss, _ = trainer.train_step(x, y, False)
+        assert np.isfinite(loss.numpy())
+        for w, b in zip(model.trainable_weights, before):
+            # float32 master weights, updated by the unscaled gradients
+            assert w.dtype == tf.float32
+        assert any(not np.allclose(w.numpy(), b) for w, b in zip(model.trainable_weights, before))
+    finally:
+        mixed_precision = tf.keras.mixed_precision
+        set_policy = getattr(mixed_precision, 'set_global_policy', None) or mixed_precision.experimental.set_policy
+        set_policy('float32')
+
+
+def test_gradient_accumulation_matches_the_full_batch():
+    # without batchnorm the micro-batches see the same statistics as the whole batch
+    model, accum_model = get_models(name='accumulation', use_batchnorm=False)
+    x, y = get_batch(batch_size=4)
+    before = model.get_weights()
+
+    trainer = get_trainer(model, loss_func=mean_squared_error, batch_size=4)
+    accum_trainer = get_trainer(accum_model, loss_func=mean_squared_error, batch_size=4, accum_steps=2)
+    loss, _ = trainer.train_step(x, y, False)
+    accum_loss, _ = accum_trainer.train_step(x, y, False)
+
+    np.testing.assert_allclose(accum_loss.numpy(), loss.numpy(), rtol=1e-5)
+    for w, accum_w in zip(model.trainable_weights, accum_model.trainable_weights):
+        np.testing.assert_allclose(accum_w.numpy(), w.numpy(), rtol=1e-4, atol=1e-6)
+    assert any(not np.allclose(w, b) for w, b in zip(model.get_weights(), before))
+
+
+def test_batch_size_must_divide_into_micro_batches():
+    model, = get_models(num=1, name='accumulation')
+    with pytest.raises(ValueError, match='accum_steps'):
+        get_trainer(model, batch_size=3, accum_steps=2)
+
+
+def test_main_takes_the_batch_of_all_the_cores():
+    # a new process for each, the devices are set up once per process
+    with multiprocessing.get_context('spawn').Pool(1, maxtasksperchild=1) as pool:
+        # the batch of 2 per core splits into 2 micro-batches of 4 cores
+        assert pool.apply(get_main_train, (['--batch_size=2', '--accum_steps=2'], 4)) == 8
+        with pytest.raises(ValueError, match='accum_steps'):
+            pool.apply(get_main_train, (['--batch_size=1', '--accum_steps=2'], 4))
+
+
+def test_steps_per_execution_matches_single_steps(tmp_path):
+    model, _ = train_loop(tmp_path / 'single')
+    # 3 steps in one call and the last step of the epoch on its own
+    grouped_model, _ = train_loop(tmp_path / 'grouped', steps_per_execution=3)
+    for w, grouped_w in zip(model.get_weights(), grouped_model.get_weights()):
+        np.testing.assert_allclose(grouped_w, w, rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize('num_steps', [{'steps_per_epoch': None}, {'validation_steps': 0},
+                                       {'steps_per_execution': 0}])
+def test_step_counts_must_be_positive(num_steps):
+    model, = get_models(num=1, name='steps')
+    with pytest.raises(ValueError, match=list(num_steps)[0]):
+        get_trainer(model, **num_steps)
+
+
+def test_resume_mid_epoch(tmp_path):
+    model, run_dir = train_loop(tmp_path / 'full', epochs=3, checkpoint_steps=3)
+    weights = load_last_state(model, run_dir)
+
+    # stops in step 8, the last state was saved after step 6 in the middle of the second epoch
+    with pytest.raises((tf.errors.OutOfRangeError, StopIteration)):
+        train_loop(tmp_path / 'resumed', epochs=3, checkpoint_steps=3, num_batches=7)
+    run_dir, = (tmp_path / 'resumed').glob('*/*/*/*/*')
+    starts = []
+    model, run_dir = train_loop(tmp_path / 'resumed', epochs=3, checkpoint_steps=3, resume=str(run_dir),
+                                starts=starts)
+    # the stream starts at the second epoch rather than replaying the first
+    assert starts == [1]
+    for w, resumed in zip(weights, load_last_state(model, run_dir)):
+        np.testing.assert_allclose(resumed, w, atol=1e-6)
+
+
+def test_jit_compiled_step_matches_the_plain_step():
+    model, jit_model = get_models(name='jit')
+    x, y = get_batch()
+
+    loss, _ = get_trainer(model).train_step(x, y, False)
+    jit_loss, _ = get_trainer(jit_model, jit_compile=True).train_step(x, y, False)
+
+    np.testing.assert_allclose(jit_loss.numpy(), loss.numpy(), rtol=1e-4)
+    for w, jit_w in zip(model.weights, jit_model.weights):
+        np.testing.assert_allclose(jit_w.numpy(), w.numpy(), rtol=1e-3, atol=1e-5, err_msg=w.name)
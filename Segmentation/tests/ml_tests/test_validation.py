@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+
+def get_model_and_volume(shape=(1, 32, 48, 40, 1)):
+    from Segmentation.train.train import build_model
+
+    tf.random.set_seed(0)
+    model = build_model([4, 8], 7, 'validation')
+    x = tf.random.uniform(shape)
+    return model, x
+
+
+def test_batched_windows_match_one_window_at_a_time():
+    from Segmentation.train.validation import get_paddings, predict_whole_volume
+    from Segmentation.utils.augmentation import crop_3d
+
+    model, x = get_model_and_volume()
+    output_shape = x.shape[:4] + (7,)
+    paddings, coords = get_paddings(8, 4, tuple(x.shape[1:4]))
+    assert len(coords) > 5
+
+    expected, counter = np.zeros(output_shape), np.zeros(output_shape)
+    for pad, centre in zip(paddings, coords):
+        pred = model(crop_3d(x, 8, 4, centre, False), training=False).numpy()
+        expected += np.pad(pred, pad, "constant")
+        counter += np.pad(np.ones(pred.shape), pad, "constant")
+    expected /= counter
+
+    for batch_size in (1, 4, len(coords)):
+        mean_pred = predict_whole_volume(model, x, output_shape, coords, 8, 4, False, batch_size=batch_size)
+        np.testing.assert_allclose(mean_pred, expected, atol=1e-5)
+
+
+def test_gaussian_weighting():
+    from Segmentation.train.validation import get_gaussian_weights, get_paddings, predict_whole_volume
+
+    weights = get_gaussian_weights((1, 8, 6))
+    assert weights.max() == 1.0 and weights.min() > 0
+    assert weights[0, 0, 0] < weights[0, 3, 2]
+    np.testing.assert_allclose(weights, weights[:, ::-1, ::-1])
+
+    model, x = get_model_and_volume()
+    output_shape = x.shape[:4] + (7,)
+    _, coords = get_paddings(8, 4, tuple(x.shape[1:4]))
+    mean_pred = predict_whole_volume(model, x, output_shape, coords, 8, 4, False, gaussian=True)
+    uniform = predict_whole_volume(model, x, output_shape, coords, 8, 4, False)
+    # still a weighted mean of softmax outputs
+    np.testing.assert_allclose(mean_pred.sum(axis=-1), 1.0, atol=1e-5)
+    assert not np.allclose(mean_pred, uniform)
+
+
+def test_slice_windows_are_views_of_the_padded_volume():
+    from Segmentation.train.validation import get_slabs, get_slice_paddings, predict_whole_volume
+
+    x = np.random.RandomState(0).rand(1, 12, 32, 32, 1).astype(np.float32)
+    slabs = get_slabs(x, 3, 'edge')
+    assert slabs.shape == (1, 12, 7, 32, 32, 1)
+    np.testing.assert_array_equal(slabs[:, 0, :4], np.repeat(x[:, :1], 4, axis=1))
+    np.testing.assert_array_equal(slabs[:, 5], x[:, 2:9])
+    assert np.shares_memory(slabs[:, 4], slabs[:, 5])
+    np.testing.assert_array_equal(get_slabs(x, 3, 'reflect')[:, 0, :3], x[:, 3:0:-1])
+
+    # the centre slice, so the stitched volume is the input
+    _, coords = get_slice_paddings(8, 3, (12, 32, 32))
+    mean_pred = predict_whole_volume(None, tf.constant(x), x.shape, coords, 8, 3, True, batch_size=8,
+                                     predict_fn=lambda slab: tf.constant(slab)[:, 3:4])
+    np.testing.assert_allclose(mean_pred, x)
+
+
+# 36 windows, in whole batches and with the last batch padded
+@pytest.mark.parametrize('batch_size', [4, 5])
+def test_in_graph_sliding_window(batch_size):
+    from Segmentation.train.validation import get_gaussian_weights, get_sliding_window_fn, get_window_starts
+    from Segmentation.train.validation import predict_distributed
+
+    model, x = get_model_and_volume(shape=(2, 32, 48, 40, 1))
+    window, strides = (16, 16, 16), (8, 12, 16)
+    assert get_window_starts(40, 16, 16) == [0, 16, 24]
+
+    weights = get_gaussian_weights(window)[..., np.newaxis]
+    expected, counter = np.zeros(x.shape[:4] + (7,)), np.zeros(x.shape[:4] + (1,))
+    for d in get_window_starts(32, 16, 8):
+        for h in get_window_starts(48, 16, 12):
+            for w in get_window_starts(40, 16, 16):
+                region = (slice(None), slice(d, d + 16), slice(h, h + 16), slice(w, w + 16))
+                expected[region] += model(x[region], training=False).numpy() * weights
+                counter[region] += weights
+    expected /= counter
+
+    sliding_window_fn = get_sliding_window_fn(model, window, strides, batch_size=batch_size, gaussian=True)
+    np.testing.assert_allclose(sliding_window_fn(x).numpy(), expected, atol=1e-5)
+
+    strategy = tf.distribute.MirroredStrategy(['/cpu:0'])
+    dist_x = next(iter(strategy.experimental_distribute_dataset(tf.data.Dataset.from_tensors(x))))
+    np.testing.assert_allclose(predict_distributed(strategy, sliding_window_fn, dist_x).numpy(), expected, atol=1e-5)
+
+
+def test_tta_averages_the_inverted_predictions():
+    from Segmentation.train.validation import TTA_TRANSFORMS, get_predict_fn
+
+    model, x = get_model_and_volume(shape=(2, 16, 16, 16, 1))
+    for name, (forward, inverse) in TTA_TRANSFORMS.items():
+        assert not np.allclose(forward(x), x), name
+        np.testing.assert_array_equal(inverse(forward(x)), x)
+    np.testing.assert_array_equal(TTA_TRANSFORMS['rot90'][0](x), np.rot90(x.numpy(), axes=(2, 3)))
+
+    tta = ('flip_width', 'rot90')
+    expected = np.mean([model(x, training=False).numpy()] +
+                       [TTA_TRANSFORMS[name][1](model(TTA_TRANSFORMS[name][0](x), training=False)).numpy()
+                        for name in tta], axis=0)
+    np.testing.assert_allclose(get_predict_fn(model, tta=tta)(x).numpy(), expected, atol=1e-5)
@@ -0,0 +1,54 @@
+import threading
+
+import numpy as np
+import tensorflow as tf
+
+
+def test_pool_drops_when_full():
+    from Segmentation.utils.visualise_utils import VisualisationPool
+
+    started, release = threading.Event(), threading.Event()
+    done = []
+
+    def block():
+        started.set()
+        release.wait(10)
+        done.append('block')
+
+    pool = VisualisationPool(num_workers=1, max_pending=2)
+    assert pool.submit(block)
+    assert started.wait(10)
+    # the worker is busy, two wait and the rest are dropped
+    results = [pool.submit(done.append, i) for i in range(4)]
+    assert results == [True, True, False, False] and pool.dropped == 2
+    release.set()
+    pool.close()
+    assert done == ['block', 0, 1]
+
+
+def test_write_sample_summaries(tmp_path):
+    from Segmentation.utils.visualise_utils import write_sample_summaries
+
+    rs = np.random.RandomState(0)
+    x = rs.rand(1, 1, 16, 16, 1).astype(np.float32)
+    slices = [x, (x > 0.5).astype(np.float32), x]
+    y = (rs.rand(1, 8, 8, 8, 1) > 0.5).astype(np.float32)
+    pred = rs.rand(1, 8, 8, 8, 1).astype(np.float32)
+    slice_writer = tf.summary.create_file_writer(str(tmp_path / 'slice'))
+    vol_writer = tf.summary.create_file_writer(str(tmp_path / 'vol'))
+
+    write_sample_summaries(slices, [y, pred], slice_writer, vol_writer, 'Train', 3, False, 4)
+    # an empty sub-volume is not written
+    write_sample_summaries(slices, None, slice_writer, vol_writer, 'Validation', 4, False, 4)
+    slice_writer.close()
+    vol_writer.close()
+
+    def read_images(log_dir):
+        images = []
+        for path in tf.io.gfile.glob(str(log_dir / 'events.*')):
+            for event in tf.compat.v1.train.summary_iterator(path):
+                images += [(value.tag, event.step) for value in event.summary.value]
+        return sorted(images)
+
+    assert read_images(tmp_path / 'slice') == [('Train - Slice', 3), ('Validation - Slice', 4)]
+    assert read_images(tmp_path / 'vol') == [('Train - Volume', 3)]
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+
+def test_recompute_policy():
+    from Segmentation.model.unet_build_blocks import get_recompute_policy
+
+    assert get_recompute_policy(True, 3) == [True, True, True]
+    assert get_recompute_policy(False, 2) == [False, False]
+    assert get_recompute_policy((False, True), 2) == [False, True]
+    with pytest.raises(AssertionError):
+        get_recompute_policy([True, False], 3)
+
+
+@pytest.mark.parametrize('enable_function', [False, True])
+def test_recompute_matches_the_plain_step(enable_function):
+    from Segmentation.model.vnet import VNet
+
+    x = tf.constant(np.random.RandomState(0).rand(2, 8, 16, 16, 1).astype(np.float32))
+    y = tf.cast(x > 0.5, tf.float32)
+    models = [VNet([4, 8], 1, dropout_rate=0.0, recompute=recompute, name=f'recompute_{recompute}')
+              for recompute in (False, True)]
+    for model in models:
+        model(x, training=False)
+    models[1].set_weights(models[0].get_weights())
+
+    def train_step(model, optimizer):
+        with tf.GradientTape() as tape:
+            loss = tf.reduce_mean(tf.square(y - model(x, training=True)))
+        grads = tape.gradient(loss, model.trainable_variables)
+        optimizer.apply_gradients(zip(grads, model.trainable_variables))
+        return grads
+
+    results = []
+    for model in models:
+        step = tf.function(train_step) if enable_function else train_step
+        results.append(step(model, tf.keras.optimizers.SGD(0.1)))
+
+    for grad, recompute_grad in zip(*results):
+        np.testing.assert_allclose(recompute_grad.numpy(), grad.numpy(), rtol=1e-4, atol=1e-6)
+    plain, recompute = models
+    assert plain.non_trainable_weights, "the moving statistics of the batchnorm layers"
+    # the moving statistics are updated once by both
+    for w, recompute_w in zip(plain.weights, recompute.weights):
+        np.testing.assert_allclose(recompute_w.numpy(), w.numpy(), rtol=1e-5, atol=1e-6, err_msg=w.name)
+
+
+@pytest.mark.parametrize('enable_function', [False, True])
+def test_recompute_keeps_the_dropout_mask(enable_function):
+    from Segmentation.model.unet_build_blocks import Conv_Block
+
+    tf.random.set_seed(0)
+    x = tf.constant(np.random.RandomState(0).rand(2, 8, 8, 8, 1).astype(np.float32))
+    block = Conv_Block(4, use_2d=False, num_conv_layers=1, nonlinearity='linear', use_dropout=True,
+                       dropout_rate=0.5, use_spatial_dropout=False, recompute=True)
+    block(x, training=False)
+    kernel = block.layers[0].kernel
+    weights = tf.constant(np.random.RandomState(1).rand(2, 8, 8, 8, 4).astype(np.float32))
+
+    def get_gradient():
+        with tf.GradientTape() as tape:
+            outputs = block(x, training=True)
+            loss = tf.reduce_sum(outputs * weights)
+        return outputs, tape.gradient(loss, kernel)
+    outputs, grad = (tf.function(get_gradient) if enable_function else get_gradient)()
+
+    # the gradient of the same mask, read from the forward pass
+    with tf.GradientTape() as tape:
+        pre_dropout = block.layers[0](x)
+        scale = tf.stop_gradient(tf.math.divide_no_nan(outputs, pre_dropout))
+        loss = tf.reduce_sum(pre_dropout * scale * weights)
+    assert 0 < np.mean(scale.numpy() == 0) < 1
+    np.testing.assert_allclose(grad.numpy(), tape.gradient(loss, kernel).numpy(), rtol=1e-4, atol=1e-4)
+
+
+def test_recompute_refuses_a_dropout_inside():
+    from Segmentation.model.unet_build_blocks import recompute_call
+
+    model = tf.keras.Sequential([tf.keras.layers.Dense(2), tf.keras.layers.Dropout(0.5)])
+    x = tf.ones((1, 2))
+    model(x)
+    with pytest.raises(ValueError, match='dropout'):
+        recompute_call(model, lambda x: model(x, training=True), x)
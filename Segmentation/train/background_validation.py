@@ -0,0 +1,151 @@
+import multiprocessing
+import os
+import queue
+import traceback
+from time import time
+
+import tensorflow as tf
+
+from Segmentation.train.checkpoint import load_npz_weights
+from Segmentation.train.utils import ConfusionMetric
+from Segmentation.train.validation import get_whole_val_dataset, get_whole_val_paddings
+from Segmentation.train.validation import crop_whole_volume, predict_whole_volume, get_predict_fn
+from Segmentation.utils.losses import dice_loss
+
+
+class BackgroundValidator:
+    """ Runs the whole-volume sliding window validation of every new best
+    checkpoint in a separate process while training carries on.
+
+    submit() only puts the checkpoint on a queue. The worker builds its own
+    copy of the model with model_fn(**model_kwargs), skips to the newest
+    checkpoint waiting so a slow validation never falls behind, and writes
+    the dice loss and the per class scores to log_dir/whole_val_metrics with
+    the epoch as the step. gpu is the index of the GPU the worker runs on,
+    None keeps it on the CPU so it does not take device memory from training.
+    """
+
+    def __init__(self,
+                 model_fn,
+                 model_kwargs,
+                 tfrec_dir,
+                 multi_class,
+                 crop_size,
+                 depth_crop_size,
+                 predict_slice=False,
+                 val_batch_size=1,
+                 buffer_size=1,
+                 num_volumes=None,
+                 gpu=None,
+                 inference_batch_size=4,
+                 gaussian=False,
+                 tta=()):
+        self.config = {
+            'model_fn': model_fn,
+            'model_kwargs': model_kwargs,
+            'tfrec_dir': tfrec_dir,
+            'multi_class': multi_class,
+            'crop_size': crop_size,
+            'depth_crop_size': depth_crop_size,
+            'predict_slice': predict_slice,
+            'val_batch_size': val_batch_size,
+            'buffer_size': buffer_size,
+            'num_volumes': num_volumes,
+            'gpu': gpu,
+            'inference_batch_size': inference_batch_size,
+            'gaussian': gaussian,
+            'tta': tta,
+        }
+        # a forked child would inherit the initialised TensorFlow runtime
+        self.ctx = multiprocessing.get_context('spawn')
+        self.process = None
+
+    def start(self, log_dir):
+        self.queue = self.ctx.Queue()
+        self.process = self.ctx.Process(target=whole_validation_worker,
+                                        args=(self.queue, log_dir, self.config),
+                                        daemon=True)
+        self.process.start()
+
+    def submit(self, epoch, path):
+        """ Safe to call from any thread, e.g. as the on_best of an AsyncCheckpointManager """
+        self.queue.put((epoch, path))
+
+    def close(self):
+        """ Waits for the newest submitted checkpoint to be validated """
+        if self.process is None:
+            return
+        self.queue.put(None)
+        self.process.join()
+        exitcode, self.process = self.process.exitcode, None
+        if exitcode != 0:
+            raise RuntimeError(f"Background validation exited with code {exitcode}")
+
+
+def whole_validation_worker(requests, log_dir, config):
+    gpus = tf.config.experimental.list_physical_devices('GPU')
+    visible = [] if config['gpu'] is None else gpus[config['gpu']:config['gpu'] + 1]
+    tf.config.experimental.set_visible_devices(visible, 'GPU')
+    for gpu in visible:
+        tf.config.experimental.set_memory_growth(gpu, True)
+
+    num_classes = 7 if config['multi_class'] else 1
+    depth = config['depth_crop_size'] * 2 + (1 if config['predict_slice'] else 0)
+    width = config['crop_size'] * 2
+    model = config['model_fn'](**config['model_kwargs'])
+    model(tf.zeros((1, depth, width, width, 1)), training=False)
+    predict_fn = get_predict_fn(model, tta=config['tta'])
+    metrics = ConfusionMetric(num_classes)
+    writer = tf.summary.create_file_writer(os.path.join(log_dir, 'whole_val_metrics'))
+
+    stop = False
+    while not stop:
+        pending = [requests.get()]
+        while True:
+            try:
+                pending.append(requests.get_nowait())
+            except queue.Empty:
+                break
+        stop = None in pending
+        pending = [request for request in pending if request is not None]
+        if not pending:
+            continue
+        epoch, path = pending[-1]
+        try:
+            validate_checkpoint(model, predict_fn, epoch, path, metrics, writer, config)
+        except Exception:
+            # a failed validation must not take the next best checkpoint down with it
+            traceback.print_exc()
+    writer.close()
+
+
+def validate_checkpoint(model, predict_fn, epoch, path, metrics, writer, config):
+    if not tf.io.gfile.exists(path):
+        # retention already dropped it for a better one, which is queued
+        return
+    t0 = time()
+    load_npz_weights(model, path)
+
+    valid_ds = get_whole_val_dataset(config['tfrec_dir'], config['val_batch_size'], config['buffer_size'],
+                                     config['multi_class'], config['num_volumes'])
+    total_loss, total_count = 0.0, 0
+    for x, y in valid_ds:
+        x_crop, y_crop = crop_whole_volume(x, y)
+        _, val_coord = get_whole_val_paddings(config['crop_size'], config['depth_crop_size'],
+                                              config['predict_slice'], tuple(y_crop.shape[1:4]))
+        mean_pred = predict_whole_volume(model, x_crop, tf.shape(y_crop), val_coord,
+                                         config['crop_size'], config['depth_crop_size'], config['predict_slice'],
+                                         config['inference_batch_size'], config['gaussian'], predict_fn)
+        total_loss += float(dice_loss(y_crop, mean_pred))
+        total_count += 1
+        metrics.store_metric(y_crop, mean_pred)
+
+    scalars = metrics.get_scalars(training=False)
+    metrics.stats[1].reset_states()
+    with writer.as_default():
+        tf.summary.scalar('loss', total_loss / total_count, step=epoch)
+        for metric, value in scalars.items():
+            tf.summary.scalar(metric, value, step=epoch)
+    writer.flush()
+    print(f"Whole validation of epoch {epoch + 1} - {time() - t0:.0f}s - loss: {total_loss / total_count:.05f}"
+          + "".join(f" - {metric}: {value:.06f}" for metric, value in scalars.items() if metric.startswith('dice')))
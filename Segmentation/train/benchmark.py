@@ -0,0 +1,151 @@
+import multiprocessing
+import resource
+from time import time
+
+import tensorflow as tf
+
+from Segmentation.model.unet import UNet
+from Segmentation.model.vnet import VNet
+from Segmentation.train.utils import setup_compile_cache
+from Segmentation.utils.losses import tversky_loss
+
+
+def build_benchmark_model(model_name, num_channels, num_classes, recompute):
+    if model_name == 'vnet':
+        return VNet(num_channels, num_classes, recompute=recompute)
+    if model_name == 'unet':
+        return UNet(num_channels, num_classes, use_2d=False, recompute=recompute)
+    raise NotImplementedError(f"Model: {model_name} not implemented.")
+
+
+def get_peak_memory(rss_before):
+    """ Peak bytes on the first GPU when TensorFlow reports it, otherwise the
+    growth of the peak resident set size of this process (Linux reports KiB) """
+    if tf.config.experimental.list_physical_devices('GPU') and hasattr(tf.config.experimental, 'get_memory_info'):
+        return tf.config.experimental.get_memory_info('GPU:0')['peak']
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) * 1024
+
+
+def measure_train_step(model_name,
+                       crop_size,
+                       depth_crop_size,
+                       recompute,
+                       batch_size=1,
+                       num_channels=(16, 32, 64, 128),
+                       num_classes=7,
+                       num_steps=5,
+                       jit_compile=False,
+                       compile_cache_dir=None):
+    """ Peak memory and mean time of a training step on a random batch of the
+    shape read_tfrecord_3d produces for crop_size and depth_crop_size, and the
+    time of the first step, which traces and compiles it. jit_compile
+    compiles the forward and backward pass with XLA as Train does. """
+    setup_compile_cache(compile_cache_dir)
+    for gpu in tf.config.experimental.list_physical_devices('GPU'):
+        tf.config.experimental.set_memory_growth(gpu, True)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    shape = (batch_size, depth_crop_size * 2, crop_size * 2, crop_size * 2)
+    x = tf.random.uniform(shape + (1,))
+    y = tf.one_hot(tf.random.uniform(shape, maxval=num_classes, dtype=tf.int32), num_classes)
+
+    model = build_benchmark_model(model_name, list(num_channels), num_classes, recompute)
+    first_step_time, step_time = time_train_step(model, x, y, num_steps, jit_compile)
+
+    return {
+        'model': model_name,
+        'crop_size': crop_size,
+        'depth_crop_size': depth_crop_size,
+        'recompute': recompute,
+        'jit_compile': jit_compile,
+        'peak_mb': get_peak_memory(rss_before) / 2 ** 20,
+        'first_step_s': first_step_time,
+        'step_s': step_time,
+    }
+
+
+def time_train_step(model, x, y, num_steps=5, jit_compile=False):
+    """ (first, mean) time of an Adam training step of model on the batch x, y """
+    optimizer = tf.keras.optimizers.Adam()
+    model(x, training=False)
+
+    def compute_gradients(x, y):
+        with tf.GradientTape() as tape:
+            predictions = model(x, training=True)
+            loss = tversky_loss(y, predictions)
+        return loss, tape.gradient(loss, model.trainable_variables)
+
+    if jit_compile:
+        compute_gradients = tf.function(compute_gradients, experimental_compile=True)
+
+    @tf.function
+    def train_step(x, y):
+        loss, grads = compute_gradients(x, y)
+        optimizer.apply_gradients(zip(grads, model.trainable_variables))
+        return loss
+
+    t0 = time()
+    train_step(x, y).numpy()
+    first_step_time = time() - t0
+    t0 = time()
+    for _ in range(num_steps):
+        train_step(x, y).numpy()
+    return first_step_time, (time() - t0) / num_steps
+
+
+def benchmark_recompute(model_name='vnet',
+                        crop_sizes=((32, 16), (64, 32), (96, 48)),
+                        recompute_policies=(False, True),
+                        **kwargs):
+    """ Measures every (crop_size, depth_crop_size) with every recompute policy,
+    each in a fresh process so the peak memory of one run does not hide the next """
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    for crop_size, depth_crop_size in crop_sizes:
+        for recompute in recompute_policies:
+            with ctx.Pool(1) as pool:
+                result = pool.apply(measure_train_step, (model_name, crop_size, depth_crop_size, recompute), kwargs)
+            print(f"{result['model']} crop {crop_size}x{depth_crop_size} - recompute: {str(recompute):<24} - "
+                  f"peak: {result['peak_mb']:.0f}MB - step: {result['step_s']:.03f}s")
+            results.append(result)
+    return results
+
+
+def benchmark_jit(model_names=('unet', 'vnet'),
+                  crop_size=32,
+                  depth_crop_size=16,
+                  compile_cache_dir=None,
+                  **kwargs):
+    """ Step times of every model with and without XLA, each in a fresh
+    process so the first step pays the whole tracing and compilation. With a
+    compile_cache_dir and a GPU the XLA run is repeated with the cache the
+    first one filled, without a GPU there is no cache to fill. """
+    ctx = multiprocessing.get_context('spawn')
+    runs = [('tf.function', False, None), ('xla', True, None)]
+    if compile_cache_dir is not None and tf.config.experimental.list_physical_devices('GPU'):
+        runs += [('xla cold cache', True, compile_cache_dir), ('xla warm cache', True, compile_cache_dir)]
+    elif compile_cache_dir is not None:
+        print("No GPU, the compile cache runs are skipped")
+    results = []
+    for model_name in model_names:
+        base_step = None
+        for label, jit_compile, cache_dir in runs:
+            with ctx.Pool(1) as pool:
+                result = pool.apply(measure_train_step, (model_name, crop_size, depth_crop_size, False),
+                                    dict(kwargs, jit_compile=jit_compile, compile_cache_dir=cache_dir))
+            base_step = base_step or result['step_s']
+            print(f"{result['model']} crop {crop_size}x{depth_crop_size} - {label:<14} - "
+                  f"first step: {result['first_step_s']:.02f}s - step: {result['step_s']:.03f}s - "
+                  f"speedup: {base_step / result['step_s']:.02f}x - peak: {result['peak_mb']:.0f}MB")
+            results.append(dict(result, run=label))
+    return results
+
+
+if __name__ == "__main__":
+    import sys
+    import os
+    sys.path.insert(0, os.getcwd())
+
+    benchmark_recompute('vnet', recompute_policies=(False, [True, True, False, False], True))
+    benchmark_recompute('unet', recompute_policies=(False, [True, True, False, False], True))
+    benchmark_jit(('unet', 'vnet'), num_channels=(8, 16, 32), num_steps=10)
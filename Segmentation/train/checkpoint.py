@@ -0,0 +1,145 @@
+import io
+import json
+import os
+import queue
+import threading
+
+import numpy as np
+import tensorflow as tf
+
+
+class AsyncCheckpointManager:
+    """ Keeps the top-k checkpoints by validation loss plus the latest N.
+
+    save() copies the model variables to host memory and returns, a background
+    thread writes the copy as an .npz (through tf.io.gfile, so gs:// works too),
+    deletes the checkpoints that fell out of both sets and rewrites
+    checkpoints.json. At most max_pending snapshots wait to be written, after
+    that save() blocks until the writer catches up.
+
+    on_best(epoch, path) is called from the writer thread once a checkpoint
+    that is the best so far is on disk.
+
+    best_model is a second built model of the same architecture, the writer
+    thread loads every new best into it and saves it as best_weights_path in
+    the TensorFlow format, so the best weights are there while training goes
+    on and after a crash.
+    """
+
+    def __init__(self, model, directory, keep_top_k=3, keep_latest=1, max_pending=2, on_best=None,
+                 best_model=None, best_weights_path=None):
+        self.model = model
+        self.on_best = on_best
+        self.best_model = best_model
+        self.best_weights_path = best_weights_path
+        self.directory = directory
+        self.keep_top_k = keep_top_k
+        self.keep_latest = keep_latest
+        self.checkpoints = []
+        self.error = None
+
+        tf.io.gfile.makedirs(directory)
+        index = os.path.join(directory, 'checkpoints.json')
+        if tf.io.gfile.exists(index):
+            # a resumed run carries on with the retention of the earlier one
+            with tf.io.gfile.GFile(index, 'r') as f:
+                self.checkpoints = json.load(f)
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.thread.start()
+
+    def save(self, epoch, loss):
+        self.raise_error()
+        snapshot = {f'{i:04d}/{v.name}': v.numpy() for i, v in enumerate(self.model.weights)}
+        self.queue.put((epoch, float(loss), snapshot))
+
+    def write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            try:
+                if self.error is None:
+                    self.write(*item)
+            except Exception as e:  # re-raised on the training thread
+                self.error = e
+            self.queue.task_done()
+
+    def write(self, epoch, loss, snapshot):
+        path = os.path.join(self.directory, f'weights.{epoch:03d}.npz')
+        buffer = io.BytesIO()
+        np.savez(buffer, **snapshot)
+        with tf.io.gfile.GFile(path + '.tmp', 'wb') as f:
+            f.write(buffer.getvalue())
+        tf.io.gfile.rename(path + '.tmp', path, overwrite=True)
+        ckpt = {'epoch': epoch, 'loss': loss, 'path': path}
+        self.checkpoints.append(ckpt)
+
+        keep = self.get_kept(self.checkpoints)
+        for old in self.checkpoints:
+            if old['path'] not in keep:
+                tf.io.gfile.remove(old['path'])
+        self.checkpoints = [old for old in self.checkpoints if old['path'] in keep]
+
+        with tf.io.gfile.GFile(os.path.join(self.directory, 'checkpoints.json'), 'w') as f:
+            json.dump(self.checkpoints, f, indent=2)
+        if self.best is ckpt:
+            if self.best_model is not None:
+                assign_weights(self.best_model, [snapshot[key] for key in sorted(snapshot)], path)
+                self.best_model.save_weights(self.best_weights_path)
+            if self.on_best is not None:
+                self.on_best(epoch, path)
+
+    def get_kept(self, checkpoints):
+        top_k = sorted(checkpoints, key=lambda ckpt: ckpt['loss'])[:self.keep_top_k]
+        latest = sorted(checkpoints, key=lambda ckpt: ckpt['epoch'])[-self.keep_latest:] if self.keep_latest else []
+        return set(ckpt['path'] for ckpt in top_k + latest)
+
+    def wait(self):
+        """ Blocks until every snapshot so far is on disk """
+        self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.raise_error()
+
+    def raise_error(self):
+        if self.error is not None:
+            raise RuntimeError("Writing a checkpoint failed") from self.error
+
+    @property
+    def best(self):
+        if not self.checkpoints:
+            return None
+        return min(self.checkpoints, key=lambda ckpt: ckpt['loss'])
+
+    def restore(self, path):
+        load_npz_weights(self.model, path)
+
+    def restore_best(self):
+        self.wait()
+        best = self.best
+        if best is not None:
+            self.restore(best['path'])
+        return best
+
+
+def load_npz_weights(model, path):
+    """ Assigns the variables saved in path to the built model, matched by
+    order (layer names depend on what else the process built) and checked by shape """
+    with tf.io.gfile.GFile(path, 'rb') as f:
+        snapshot = np.load(io.BytesIO(f.read()))
+        values = [snapshot[key] for key in sorted(snapshot.files)]
+    assign_weights(model, values, path)
+
+
+def assign_weights(model, values, path):
+    """ Assigns values, the snapshot of path, to the weights of model in order """
+    weights = model.weights
+    assert len(values) == len(weights), f"{path} has {len(values)} variables, the model {len(weights)}"
+    for v, value in zip(weights, values):
+        assert v.shape == value.shape, f"{v.name} has shape {v.shape}, {path} {value.shape}"
+        v.assign(value)
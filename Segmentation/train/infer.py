@@ -0,0 +1,129 @@
+import collections
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from time import time
+
+import h5py
+import numpy as np
+import tensorflow as tf
+
+from Segmentation.train.validation import get_predict_fn, get_validation_spots, predict_whole_volume
+
+
+def load_volume(path):
+    """ The (depth, height, width, 1) image of a .im file, as create_OAI_dataset stores it """
+    with h5py.File(path, 'r') as hf:
+        volume = np.array(hf['data'], np.float32)
+    return np.rollaxis(volume, 2, 0)[..., np.newaxis]
+
+
+def get_mask(pred):
+    """ uint8 class of every voxel, or 0/1 for a single class """
+    if pred.shape[-1] == 1:
+        return (pred[..., 0] > 0.5).astype(np.uint8)
+    return np.argmax(pred, axis=-1).astype(np.uint8)
+
+
+def save_mask(path, mask):
+    """ Writes the mask in the (height, width, depth) layout of the .im files, compressed """
+    with h5py.File(path, 'w') as hf:
+        hf.create_dataset('data', data=np.rollaxis(mask, 0, 3), compression='gzip', chunks=True)
+
+
+def infer_volume(predict_fn, volume, num_classes, crop_size, depth_crop_size, predict_slice=False,
+                 batch_size=4, gaussian=False, slice_padding='edge'):
+    """ Sliding window prediction of a (depth, height, width, 1) volume, the
+    windows placed as in the whole-volume validation """
+    coords = get_validation_spots(crop_size, depth_crop_size, volume.shape[:3], predict_slice,
+                                  iterator_increase=0 if predict_slice else 1)
+    output_shape = (1,) + volume.shape[:3] + (num_classes,)
+    pred = predict_whole_volume(None, tf.constant(volume[np.newaxis]), output_shape, coords, crop_size,
+                                depth_crop_size, predict_slice, batch_size, gaussian, predict_fn, slice_padding)
+    return pred[0]
+
+
+def read_volumes(paths, volumes, num_readers):
+    """ Puts (path, volume) on volumes in the order of paths, then None, or
+    the error of a failed read """
+    try:
+        with ThreadPoolExecutor(num_readers) as pool:
+            # only num_readers reads ahead of the queue, so a slow inference bounds the memory
+            reading = collections.deque()
+            for path in paths:
+                reading.append((path, pool.submit(load_volume, path)))
+                if len(reading) == num_readers:
+                    path, future = reading.popleft()
+                    volumes.put((path, future.result()))
+            for path, future in reading:
+                volumes.put((path, future.result()))
+    except Exception as e:
+        volumes.put(e)
+        return
+    volumes.put(None)
+
+
+def infer_directory(model_fn,
+                    model_args,
+                    model_kwargs,
+                    weights_path,
+                    input_dir,
+                    output_dir,
+                    crop_size=144,
+                    depth_crop_size=80,
+                    predict_slice=False,
+                    batch_size=4,
+                    gaussian=False,
+                    tta=(),
+                    jit_compile=False,
+                    num_readers=2,
+                    num_writers=2,
+                    prefetch=2):
+    """ Segments every .im file of input_dir into a uint8 mask of the same
+    name with the .seg.h5 extension in output_dir.
+
+    model_fn(*model_args, **model_kwargs) builds the model, e.g. the
+    model_fn, model_args select_model returns or build_model with its
+    arguments, and weights_path is the best_weights.tf of its run. The
+    volumes are read by num_readers threads, at most prefetch + num_readers
+    ahead of the inference, and the masks are compressed and written by num_writers
+    threads while the next volume is predicted. Returns the volumes per minute.
+    """
+    paths = sorted(glob(os.path.join(input_dir, '*.im')))
+    if not paths:
+        raise ValueError(f"No .im files in {input_dir}")
+    os.makedirs(output_dir, exist_ok=True)
+
+    model = model_fn(*model_args, **(model_kwargs or {}))
+    depth = depth_crop_size * 2 + (1 if predict_slice else 0)
+    num_classes = model(tf.zeros((1, depth, crop_size * 2, crop_size * 2, 1)), training=False).shape[-1]
+    model.load_weights(weights_path).assert_existing_objects_matched()
+    predict_fn = get_predict_fn(model, jit_compile, tta)
+
+    volumes = queue.Queue(maxsize=prefetch)
+    reader = threading.Thread(target=read_volumes, args=(paths, volumes, num_readers), daemon=True)
+    reader.start()
+
+    t0 = time()
+    writes = []
+    with ThreadPoolExecutor(num_writers) as writers:
+        for idx, item in enumerate(iter(volumes.get, None)):
+            if isinstance(item, Exception):
+                raise item
+            path, volume = item
+            t1 = time()
+            mask = get_mask(infer_volume(predict_fn, volume, num_classes, crop_size, depth_crop_size,
+                                         predict_slice, batch_size, gaussian))
+            name = os.path.splitext(os.path.basename(path))[0]
+            writes.append(writers.submit(save_mask, os.path.join(output_dir, f'{name}.seg.h5'), mask))
+            print(f"{idx + 1}/{len(paths)} {name} - {time() - t1:.1f}s")
+        for write in writes:
+            # raises the error of a failed write
+            write.result()
+    reader.join()
+
+    volumes_per_min = len(paths) / (time() - t0) * 60
+    print(f"Segmented {len(paths)} volumes - {volumes_per_min:.2f} vols/min")
+    return volumes_per_min
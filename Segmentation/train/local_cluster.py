@@ -0,0 +1,178 @@
+import json
+import multiprocessing
+import os
+import queue
+import socket
+import tempfile
+from functools import partial
+from glob import glob
+from time import time
+
+import numpy as np
+import tensorflow as tf
+
+from Segmentation.train.train import Train, build_model
+from Segmentation.train.utils import LearningRateUpdate, ConfusionMetric
+from Segmentation.train.utils import get_strategy, distribute_dataset, is_chief
+from Segmentation.utils.losses import dice_loss
+
+
+def get_free_ports(num_ports):
+    sockets = [socket.socket() for _ in range(num_ports)]
+    for s in sockets:
+        s.bind(('localhost', 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+def get_tf_config(ports, index):
+    return json.dumps({'cluster': {'worker': [f'localhost:{port}' for port in ports]},
+                       'task': {'type': 'worker', 'index': index}})
+
+
+def get_synthetic_dataset(batch_size, num_shards, shard_index, num_examples=32, shape=(32, 64, 64), seed=0,
+                          start_epoch=0):
+    """ Fixed random volumes and labels, shuffled by epoch from start_epoch on.
+    The dataset is sharded by replica batch, so batch k of worker w holds the
+    same volumes as the w-th replica slice of global batch k on a single worker """
+    rs = np.random.RandomState(seed)
+    x = rs.rand(num_examples, *shape, 1).astype(np.float32)
+    y = (x > 0.5).astype(np.float32)
+
+    def epoch_dataset(epoch):
+        dataset = tf.data.Dataset.from_tensor_slices((x, y)).shuffle(num_examples, seed=epoch)
+        return dataset.batch(batch_size, drop_remainder=True)
+
+    dataset = tf.data.experimental.Counter(start=start_epoch).flat_map(epoch_dataset)
+    return dataset.shard(num_shards, shard_index)
+
+
+def run_worker(num_workers, index, ports, log_dir, config, results):
+    """ One process of the local cluster, num_workers == 1 trains on
+    config['num_replicas'] CPU devices of this process instead """
+    if num_workers > 1:
+        os.environ['TF_CONFIG'] = get_tf_config(ports, index)
+    tf.config.experimental.set_visible_devices([], 'GPU')
+    tf.config.threading.set_intra_op_parallelism_threads(config['threads'])
+    tf.config.threading.set_inter_op_parallelism_threads(config['threads'])
+    if num_workers == 1 and config['num_replicas'] > 1:
+        cpu = tf.config.experimental.list_physical_devices('CPU')[0]
+        tf.config.experimental.set_virtual_device_configuration(
+            cpu, [tf.config.experimental.VirtualDeviceConfiguration()] * config['num_replicas'])
+        strategy = tf.distribute.MirroredStrategy([f'/cpu:{i}' for i in range(config['num_replicas'])])
+    else:
+        strategy = get_strategy(multi_worker=num_workers > 1)
+
+    batch_size = config['batch_size']
+    dataset_fn = partial(get_synthetic_dataset, shape=config['shape'])
+    with strategy.scope():
+        # no dropout and the same initial weights in every process, so the runs can be compared
+        model = build_model(list(config['num_channels']), 1, 'local_cluster', dropout_rate=0.0)
+        model(tf.zeros((1,) + tuple(config['shape']) + (1,)), training=False)
+        set_initial_weights(model)
+        trainer = Train(config['epochs'], batch_size, True, model,
+                        tf.keras.optimizers.SGD(config['lr']), dice_loss,
+                        LearningRateUpdate(config['lr'], 1.0, 1, warmup=0), False, ConfusionMetric(1),
+                        log_dir=log_dir, steps_per_epoch=config['steps_per_epoch'], validation_steps=1,
+                        keep_top_k=1, keep_latest=0)
+        train_ds = distribute_dataset(strategy, dataset_fn, batch_size)
+        valid_ds = distribute_dataset(strategy, dataset_fn, batch_size)
+        t0 = time()
+        trainer.train_model_loop(train_ds, valid_ds, strategy, False)
+        train_time = time() - t0
+
+    results.put({'index': index, 'chief': is_chief(), 'time': train_time,
+                 'weights': [w.numpy() for w in model.weights]})
+
+
+def set_initial_weights(model, seed=1):
+    """ Uniform kernels with the variance of a fan-in initialiser, the
+    vectors (biases, scales) keep their constant initialisers """
+    rs = np.random.RandomState(seed)
+    for v in model.trainable_variables:
+        if len(v.shape) > 1:
+            limit = np.sqrt(3 / np.prod(v.shape[:-1]))
+            v.assign(rs.uniform(-limit, limit, v.shape).astype(np.float32))
+
+
+def launch(num_workers, config, log_dir):
+    """ Trains in num_workers localhost processes, returns their results by index """
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    ports = get_free_ports(num_workers)
+    processes = [ctx.Process(target=run_worker, args=(num_workers, i, ports, log_dir, config, results))
+                 for i in range(num_workers)]
+    for p in processes:
+        p.start()
+    # read before joining, a process does not exit while its results sit in the pipe
+    worker_results = []
+    while len(worker_results) < num_workers:
+        try:
+            worker_results.append(results.get(timeout=1))
+        except queue.Empty:
+            if any(p.exitcode not in (None, 0) for p in processes):
+                # the others would wait for it in their collectives forever
+                for p in processes:
+                    p.terminate()
+                raise RuntimeError("A worker of the local cluster failed")
+    for p in processes:
+        p.join()
+        if p.exitcode != 0:
+            raise RuntimeError(f"Worker exited with code {p.exitcode}")
+    return sorted(worker_results, key=lambda result: result['index'])
+
+
+def check_multi_worker(worker_counts=(1, 2, 4),
+                       batch_size_per_worker=2,
+                       epochs=2,
+                       steps_per_epoch=8,
+                       shape=(32, 64, 64),
+                       num_channels=(4, 8, 16),
+                       lr=0.1,
+                       threads=1):
+    """ Trains a small VNet on synthetic volumes with every number of localhost
+    CPU workers in worker_counts, batch_size_per_worker each.
+
+    Scaling efficiency is the examples/s of N workers over N times the
+    examples/s of one. For correctness the weights of every worker are
+    compared with one process training the same global batches on N
+    replicas with MirroredStrategy, and only the chief may leave a run dir.
+    """
+    results = []
+    base_throughput = None
+    for num_workers in worker_counts:
+        config = {'batch_size': batch_size_per_worker * num_workers, 'epochs': epochs,
+                  'steps_per_epoch': steps_per_epoch, 'shape': shape, 'num_channels': num_channels,
+                  'lr': lr, 'threads': threads, 'num_replicas': 1}
+        log_dir = tempfile.mkdtemp(prefix='local_cluster_')
+        worker_results = launch(num_workers, config, log_dir)
+        examples = config['batch_size'] * steps_per_epoch * epochs
+        throughput = examples / max(result['time'] for result in worker_results)
+        base_throughput = base_throughput or throughput / num_workers
+
+        reference = launch(1, dict(config, num_replicas=num_workers), tempfile.mkdtemp(prefix='local_cluster_'))[0]
+        max_diff = max(float(np.max(np.abs(w - ref)))
+                       for result in worker_results
+                       for w, ref in zip(result['weights'], reference['weights']))
+        run_dirs = glob(os.path.join(log_dir, '*', '*', '*', '*', '*'))
+
+        result = {'workers': num_workers,
+                  'examples_per_s': throughput,
+                  'efficiency': throughput / (num_workers * base_throughput),
+                  'max_weight_diff': max_diff,
+                  'chiefs': sum(result['chief'] for result in worker_results),
+                  'run_dirs': len(run_dirs)}
+        print(f"{num_workers} workers - {throughput:.02f} examples/s - efficiency: {result['efficiency']:.02f} - "
+              f"max weight diff to {num_workers} replicas: {max_diff:.3g} - chiefs: {result['chiefs']} - "
+              f"run dirs: {result['run_dirs']}")
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    import sys
+    sys.path.insert(0, os.getcwd())
+
+    check_multi_worker()
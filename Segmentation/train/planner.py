@@ -0,0 +1,184 @@
+import multiprocessing
+import resource
+
+import numpy as np
+import tensorflow as tf
+
+from Segmentation.train.benchmark import get_peak_memory, time_train_step
+
+# ops whose output is a view of their input or holds no activation
+ALIASING_OPS = ('Identity', 'ReadVariableOp', 'Const', 'Reshape', 'Squeeze', 'ExpandDims',
+                'VarHandleOp', 'NoOp', 'StopGradient')
+
+
+def get_candidates(crop_sizes=(32, 48, 64, 96, 144),
+                   depth_crop_sizes=(16, 32, 48, 80),
+                   batch_sizes=(1, 2, 4, 8, 16)):
+    return [{'crop_size': crop_size, 'depth_crop_size': depth_crop_size, 'batch_size': batch_size}
+            for crop_size in crop_sizes for depth_crop_size in depth_crop_sizes for batch_size in batch_sizes]
+
+
+def get_input_shape(crop_size, depth_crop_size):
+    """ The example shape read_tfrecord_3d produces for the crop """
+    return (depth_crop_size * 2, crop_size * 2, crop_size * 2, 1)
+
+
+def get_op_flops(op):
+    """ Multiply-adds times two of the convolutions, the rest is negligible """
+    if op.type in ('Conv2D', 'Conv3D'):
+        return 2 * op.outputs[0].shape.num_elements() * int(np.prod(op.inputs[1].shape[:-1]))
+    if op.type in ('Conv2DBackpropInput', 'Conv3DBackpropInputV2'):
+        # a transposed convolution, every input element is spread over a kernel of the outputs
+        return 2 * op.inputs[2].shape.num_elements() * int(np.prod(op.inputs[1].shape[:-1]))
+    return 0
+
+
+def trace_example(model, crop_size, depth_crop_size, optimizer_slots=2):
+    """ The memory of a training step of one example of the crop, estimated
+    from the forward graph of the model without running it.
+
+    The tape keeps every forward output for the backward pass, which at
+    worst holds the gradients of the two largest at once, and the labels are
+    one-hot. Recomputed levels are counted as if they were kept, so the
+    estimate is an upper bound for them. The state is the weights with their
+    gradients and optimizer_slots copies (2 for Adam), it does not grow with
+    the batch.
+    """
+    forward = tf.function(lambda x: model(x, training=True))
+    graph = forward.get_concrete_function(
+        tf.TensorSpec((1,) + get_input_shape(crop_size, depth_crop_size), tf.float32)).graph
+
+    activations, flops = [], 0
+    for op in graph.get_operations():
+        flops += get_op_flops(op)
+        if op.type in ALIASING_OPS:
+            continue
+        for t in op.outputs:
+            if t.dtype.is_floating and t.shape.is_fully_defined():
+                activations.append(t.shape.num_elements() * t.dtype.size)
+    output = graph.outputs[0]
+    label_bytes = output.shape.num_elements() * 4
+    param_bytes = sum(v.shape.num_elements() * v.dtype.size for v in model.weights)
+
+    return {
+        'state_mb': param_bytes * (2 + optimizer_slots) / 2 ** 20,
+        'example_mb': (sum(activations) + 2 * max(activations) + label_bytes) / 2 ** 20,
+        # the forward pass and the two of the backward pass
+        'gflops': 3 * flops / 1e9,
+    }
+
+
+def estimate_train_step(model, crop_size, depth_crop_size, batch_size, optimizer_slots=2):
+    """ Estimated peak memory (MB) and GFLOPs of a training step on batch_size crops """
+    example = trace_example(model, crop_size, depth_crop_size, optimizer_slots)
+    return {'peak_mb': example['state_mb'] + batch_size * example['example_mb'],
+            'gflops': batch_size * example['gflops']}
+
+
+def measure_candidate(model_fn, model_args, model_kwargs, candidate, num_steps=3):
+    """ Runs in a fresh process, so its peak memory is the candidate's own """
+    for gpu in tf.config.experimental.list_physical_devices('GPU'):
+        tf.config.experimental.set_memory_growth(gpu, True)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    model = model_fn(*model_args, **model_kwargs)
+    shape = (candidate['batch_size'],) + get_input_shape(candidate['crop_size'], candidate['depth_crop_size'])
+    x = tf.random.uniform(shape)
+    num_classes = model(x[:1], training=False).shape[-1]
+    y = tf.one_hot(tf.random.uniform(shape[:-1], maxval=num_classes, dtype=tf.int32), num_classes)
+    try:
+        _, step_time = time_train_step(model, x, y, num_steps)
+    except tf.errors.ResourceExhaustedError:
+        return {'measured_peak_mb': None, 'step_s': None}
+    return {'measured_peak_mb': get_peak_memory(rss_before) / 2 ** 20, 'step_s': step_time}
+
+
+def plan(model_fn,
+         model_args=(),
+         model_kwargs=None,
+         memory_budget_mb=8000,
+         candidates=None,
+         measure=False,
+         num_steps=3):
+    """ Recommends the candidate crop and batch (see get_candidates) with the
+    most voxels per step whose peak memory fits memory_budget_mb.
+
+    model_fn(*model_args, **model_kwargs) builds the model, e.g. build_model
+    with its arguments or the model_fn, model_args select_model returns. Every
+    candidate gets an estimate as in estimate_train_step. measure=True also
+    runs the ones the estimate lets through, largest first and each in its
+    own process, until one really fits, and reports its step time.
+
+    Returns the recommended candidate (None if nothing fits) and the rows of
+    all candidates.
+    """
+    model_kwargs = model_kwargs or {}
+    candidates = candidates if candidates is not None else get_candidates()
+    model = model_fn(*model_args, **model_kwargs)
+
+    rows, examples = [], {}
+    for candidate in candidates:
+        crop = (candidate['crop_size'], candidate['depth_crop_size'])
+        if crop not in examples:
+            # one trace per crop, the batch only scales it
+            examples[crop] = trace_example(model, *crop)
+        example = examples[crop]
+        batch_size = candidate['batch_size']
+        peak_mb = example['state_mb'] + batch_size * example['example_mb']
+        rows.append(dict(candidate,
+                         voxels=batch_size * int(np.prod(get_input_shape(*crop))),
+                         peak_mb=peak_mb,
+                         gflops=batch_size * example['gflops'],
+                         fits=peak_mb <= memory_budget_mb))
+
+    rows.sort(key=lambda row: (row['voxels'], row['crop_size'], row['depth_crop_size']), reverse=True)
+    best = None
+    if measure:
+        ctx = multiprocessing.get_context('spawn')
+        for row in rows:
+            if not row['fits']:
+                continue
+            with ctx.Pool(1) as pool:
+                row.update(pool.apply(measure_candidate, (model_fn, model_args, model_kwargs, row, num_steps)))
+            row['fits'] = row['measured_peak_mb'] is not None and row['measured_peak_mb'] <= memory_budget_mb
+            if row['fits']:
+                best = row
+                break
+    else:
+        best = next((row for row in rows if row['fits']), None)
+
+    for row in rows[::-1]:
+        measured = f" - measured: {row['measured_peak_mb']:.0f}MB, {row['step_s']:.03f}s/step" \
+            if row.get('measured_peak_mb') is not None else ""
+        print(f"crop {row['crop_size']}x{row['depth_crop_size']} batch {row['batch_size']:>3} - "
+              f"estimated: {row['peak_mb']:.0f}MB, {row['gflops']:.1f} GFLOPs{measured}"
+              f"{' - fits' if row['fits'] else ''}{' <- recommended' if row is best else ''}")
+    return best, rows
+
+
+def choose_batch_size(model_fn,
+                      model_args=(),
+                      model_kwargs=None,
+                      crop_size=144,
+                      depth_crop_size=80,
+                      memory_budget_mb=8000,
+                      max_batch_size=64,
+                      num_replicas=1):
+    """ The largest power of two per replica batch whose estimated peak fits
+    memory_budget_mb on each replica, times num_replicas """
+    batch_sizes = [2 ** i for i in range(int(np.log2(max_batch_size)) + 1)]
+    candidates = [{'crop_size': crop_size, 'depth_crop_size': depth_crop_size, 'batch_size': batch_size}
+                  for batch_size in batch_sizes]
+    best, _ = plan(model_fn, model_args, model_kwargs, memory_budget_mb, candidates)
+    if best is None:
+        raise ValueError(f"Not even a batch of 1 crop {crop_size}x{depth_crop_size} fits in {memory_budget_mb}MB")
+    return best['batch_size'] * num_replicas
+
+
+if __name__ == "__main__":
+    import sys
+    import os
+    sys.path.insert(0, os.getcwd())
+    from Segmentation.train.train import build_model
+
+    plan(build_model, ([16, 32, 64, 128], 7, 'vnet'), memory_budget_mb=16000,
+         candidates=get_candidates(batch_sizes=(1, 2, 4)))
@@ -0,0 +1,172 @@
+import json
+import os
+from contextlib import contextmanager
+from time import time
+
+import numpy as np
+import tensorflow as tf
+
+
+class StepProfiler:
+    """ Splits the wall-clock time of the training loop into phases (waiting on
+    the input iterator, device compute, metric updates, visualisation and
+    checkpointing) and reports examples/s and voxels/s.
+
+    Every step is written as a line of log_dir/profile.jsonl and every epoch
+    as TensorBoard scalars under log_dir/profile. A disabled profiler times
+    nothing, so the loop can call it unconditionally.
+    """
+
+    phases = ('data', 'compute', 'metrics', 'visualise', 'checkpoint')
+
+    def __init__(self, log_dir=None, enabled=True):
+        self.enabled = enabled and log_dir is not None
+        if self.enabled:
+            os.makedirs(log_dir, exist_ok=True)
+            self.log_file = open(os.path.join(log_dir, 'profile.jsonl'), 'a')
+            self.writer = tf.summary.create_file_writer(os.path.join(log_dir, 'profile'))
+        self.global_step = 0
+        self.reset_step()
+        self.reset_epoch()
+
+    def reset_step(self):
+        self.step_times = dict.fromkeys(self.phases, 0.0)
+
+    def reset_epoch(self):
+        self.epoch_times = dict.fromkeys(self.phases, 0.0)
+        self.epoch_examples = 0
+        self.epoch_voxels = 0
+        self.epoch_train_time = 0.0
+        self.epoch_start = time()
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        t0 = time()
+        yield
+        elapsed = time() - t0
+        self.step_times[name] += elapsed
+        self.epoch_times[name] += elapsed
+
+    def end_step(self, epoch, x, strategy, training=True):
+        """ Logs the phases timed since the last step, x is the (possibly
+        distributed) input batch and gives the examples and voxels """
+        if not self.enabled:
+            return
+        shapes = [t.shape for t in strategy.experimental_local_results(x)]
+        num_examples = int(sum(shape[0] for shape in shapes))
+        num_voxels = int(sum(np.prod(shape[:-1]) for shape in shapes))
+        step_time = sum(self.step_times.values())
+        if training:
+            self.epoch_examples += num_examples
+            self.epoch_voxels += num_voxels
+            self.epoch_train_time += step_time
+
+        record = {'step': self.global_step, 'epoch': epoch, 'training': training,
+                  'examples': num_examples, 'voxels': num_voxels}
+        record.update({f'{name}_s': t for name, t in self.step_times.items()})
+        record['examples_per_s'] = num_examples / step_time if step_time else 0.0
+        record['voxels_per_s'] = num_voxels / step_time if step_time else 0.0
+        self.log_file.write(json.dumps(record) + '\n')
+
+        if training:
+            self.global_step += 1
+        self.reset_step()
+
+    def end_epoch(self, epoch):
+        """ Writes the epoch totals to TensorBoard and returns them as a string
+        for the epoch print out """
+        if not self.enabled:
+            return ""
+        epoch_time = time() - self.epoch_start
+        totals = dict(self.epoch_times)
+        totals['other'] = max(epoch_time - sum(totals.values()), 0.0)
+        # throughput of the train steps, validation is only in the phase totals
+        train_time = self.epoch_train_time or epoch_time
+        examples_per_s = self.epoch_examples / train_time
+        voxels_per_s = self.epoch_voxels / train_time
+
+        with self.writer.as_default():
+            for name, t in totals.items():
+                tf.summary.scalar(f'time/{name}', t, step=epoch)
+            tf.summary.scalar('examples_per_s', examples_per_s, step=epoch)
+            tf.summary.scalar('voxels_per_s', voxels_per_s, step=epoch)
+        self.log_file.write(json.dumps({'epoch': epoch, 'epoch_s': epoch_time,
+                                        'examples_per_s': examples_per_s, 'voxels_per_s': voxels_per_s,
+                                        **{f'{name}_s': t for name, t in totals.items()}}) + '\n')
+        self.log_file.flush()
+
+        profile_str = "".join(f" - {name}: {t:.02f}s" for name, t in totals.items())
+        profile_str += f" - {examples_per_s:.02f} examples/s - {voxels_per_s:.3g} voxels/s"
+        self.reset_step()
+        self.reset_epoch()
+        return profile_str
+
+    def close(self):
+        if self.enabled:
+            self.log_file.close()
+            self.writer.close()
+
+
+class TraceWindow:
+    """ Captures a tf.profiler trace of the global steps [start, stop) given as
+    profile_steps="start:stop", written to profile_dir for TensorBoard's
+    profile plugin """
+
+    def __init__(self, profile_steps=None, profile_dir=None):
+        self.start, self.stop = parse_profile_steps(profile_steps)
+        self.profile_dir = profile_dir
+        self.active = False
+
+    @property
+    def enabled(self):
+        return self.start is not None and self.profile_dir is not None
+
+    def steps_to_boundary(self, global_step):
+        """ Steps until the trace has to start or stop, None when it never will """
+        if not self.enabled:
+            return None
+        for boundary in (self.start, self.stop):
+            if global_step < boundary:
+                return boundary - global_step
+        return None
+
+    def update(self, global_step):
+        """ Starts or stops the trace when global_step reaches a boundary """
+        if not self.enabled:
+            return
+        if not self.active and self.start <= global_step < self.stop:
+            tf.profiler.experimental.start(self.profile_dir)
+            self.active = True
+        elif self.active and global_step >= self.stop:
+            tf.profiler.experimental.stop()
+            self.active = False
+
+    @contextmanager
+    def step_context(self, name, global_step):
+        """ Marks a step in the trace so the trace viewer can split it by step """
+        if not self.active:
+            yield
+            return
+        with tf.profiler.experimental.Trace(name, step_num=global_step, _r=1):
+            yield
+
+    def close(self):
+        if self.active:
+            tf.profiler.experimental.stop()
+            self.active = False
+
+
+def parse_profile_steps(profile_steps):
+    """ "100:120" -> (100, 120), a single "100" traces that one step """
+    if not profile_steps:
+        return None, None
+    steps = [int(step) for step in str(profile_steps).split(':')]
+    if len(steps) == 1:
+        steps.append(steps[0] + 1)
+    start, stop = steps
+    if not 0 <= start < stop:
+        raise ValueError(f"profile_steps needs 0 <= start < stop, got {profile_steps}")
+    return start, stop
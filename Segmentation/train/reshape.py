@@ -5,13 +5,15 @@ import numpy as np
 # TODO: Replace all tf.slice operations with more Pythonic expressions
 # TODO: colour maps should be consistent with the ones for 2D
 
+# numpy, a tf.constant at import would start the TensorFlow runtime before a
+# MultiWorkerMirroredStrategy can be created
 colour_maps = {
-    1: [tf.constant([1, 1, 1], dtype=tf.float32), tf.constant([[[[255, 255, 0]]]], dtype=tf.float32)],  # background / black
-    2: [tf.constant([2, 2, 2], dtype=tf.float32), tf.constant([[[[0, 255, 255]]]], dtype=tf.float32)],
-    3: [tf.constant([3, 3, 3], dtype=tf.float32), tf.constant([[[[255, 0, 255]]]], dtype=tf.float32)],
-    4: [tf.constant([4, 4, 4], dtype=tf.float32), tf.constant([[[[255, 255, 255]]]], dtype=tf.float32)],
-    5: [tf.constant([5, 5, 5], dtype=tf.float32), tf.constant([[[[120, 120, 120]]]], dtype=tf.float32)],
-    6: [tf.constant([6, 6, 6], dtype=tf.float32), tf.constant([[[[255, 165, 0]]]], dtype=tf.float32)],
+    1: [np.array([1, 1, 1], dtype=np.float32), np.array([[[[255, 255, 0]]]], dtype=np.float32)],  # background / black
+    2: [np.array([2, 2, 2], dtype=np.float32), np.array([[[[0, 255, 255]]]], dtype=np.float32)],
+    3: [np.array([3, 3, 3], dtype=np.float32), np.array([[[[255, 0, 255]]]], dtype=np.float32)],
+    4: [np.array([4, 4, 4], dtype=np.float32), np.array([[[[255, 255, 255]]]], dtype=np.float32)],
+    5: [np.array([5, 5, 5], dtype=np.float32), np.array([[[[120, 120, 120]]]], dtype=np.float32)],
+    6: [np.array([6, 6, 6], dtype=np.float32), np.array([[[[255, 165, 0]]]], dtype=np.float32)],
 }
 
 def replace_vector(img, search, replace):
@@ -91,7 +93,7 @@ def get_mid_vol(y, pred, multi_class, rad=12, check_empty=False):
 def plot_through_slices(batch_idx, x_crop, y_crop, mean_pred, writer, multi_class=False):
     imgs = []
     slice_size = [1, 1, -1, -1, -1]
-    for i in range(160):
+    for i in range(x_crop.shape[1]):
         slice_start = [batch_idx, i, 0, 0, 0]
         x_slice = tf.slice(x_crop, slice_start, slice_size)
         y_slice = tf.slice(y_crop, slice_start, slice_size)
@@ -0,0 +1,238 @@
+import collections
+import io
+import json
+import queue
+import socketserver
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from time import time
+
+import numpy as np
+import tensorflow as tf
+
+from Segmentation.train.validation import get_predict_fn
+
+
+def get_batch_sizes(max_batch_size):
+    """ The powers of two up to max_batch_size (and max_batch_size) a batch is padded to,
+    so the model is only traced for these """
+    batch_sizes = [2 ** i for i in range(int(np.log2(max_batch_size)) + 1)]
+    return batch_sizes if batch_sizes[-1] == max_batch_size else batch_sizes + [max_batch_size]
+
+
+class MicroBatcher:
+    """ Groups the examples submitted from many threads into batches for predict_fn.
+
+    A batch starts with the oldest waiting example and takes the examples of
+    the same shape that arrive within max_wait_ms of it, up to
+    max_batch_size, the others wait for the next batch. It is padded to the
+    next of get_batch_sizes so predict_fn sees a few shapes only. The
+    latency of every request, from submit() to its prediction, is kept for
+    get_stats().
+    """
+
+    def __init__(self, predict_fn, max_batch_size=8, max_wait_ms=5.0, num_latencies=10000):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.batch_sizes = get_batch_sizes(max_batch_size)
+        self.requests = queue.Queue()
+        self.deferred = collections.deque()
+        self.latencies = collections.deque(maxlen=num_latencies)
+        self.num_requests, self.num_batches = 0, 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def submit(self, x):
+        """ Future of the prediction of the example x (without the batch dimension) """
+        future = Future()
+        self.requests.put((np.asarray(x, np.float32), future, time()))
+        return future
+
+    def predict(self, x, timeout=None):
+        return self.submit(x).result(timeout)
+
+    def warm_up(self, example_shape):
+        """ Traces predict_fn for every padded batch size of examples of example_shape """
+        for batch_size in self.batch_sizes:
+            self.predict_fn(np.zeros((batch_size,) + tuple(example_shape), np.float32))
+
+    def get_batch(self):
+        """ The next batch of requests, None once closed """
+        first = self.deferred.popleft() if self.deferred else self.requests.get()
+        if first is None:
+            return None
+        batch, deferred = [first], collections.deque()
+        while self.deferred and len(batch) < self.max_batch_size:
+            item = self.deferred.popleft()
+            (batch if item is not None and item[0].shape == first[0].shape else deferred).append(item)
+        deadline = first[2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            try:
+                item = self.requests.get(timeout=max(0.0, deadline - time()))
+            except queue.Empty:
+                break
+            if item is None:
+                # close() once the waiting requests are done
+                deferred.append(None)
+                break
+            (batch if item[0].shape == first[0].shape else deferred).append(item)
+        self.deferred.extend(deferred)
+        return batch
+
+    def work(self):
+        while True:
+            batch = self.get_batch()
+            if batch is None:
+                return
+            xs, futures, starts = zip(*batch)
+            padded_size = next(size for size in self.batch_sizes if size >= len(xs))
+            x = np.stack(xs + (np.zeros_like(xs[0]),) * (padded_size - len(xs)))
+            try:
+                preds = self.predict_fn(x).numpy()
+            except Exception as e:  # fails the requests of this batch, not the service
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            end = time()
+            for future, pred in zip(futures, preds):
+                future.set_result(pred)
+            with self.lock:
+                self.latencies.extend(end - start for start in starts)
+                self.num_requests += len(batch)
+                self.num_batches += 1
+
+    def get_stats(self):
+        """ Request count, mean batch size and latency percentiles in ms """
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            stats = {'requests': self.num_requests,
+                     'mean_batch_size': self.num_requests / max(self.num_batches, 1)}
+        for percentile in (50, 90, 99):
+            stats[f'p{percentile}_ms'] = float(np.percentile(latencies, percentile)) if len(latencies) else None
+        return stats
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+
+def to_npy(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def from_npy(data):
+    return np.load(io.BytesIO(data), allow_pickle=False)
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    """ POST /predict/<model> with the .npy of a slice or patch (without the
+    batch dimension) answers the .npy of its probabilities, or of its uint8
+    classes with ?mask=1. GET /stats answers the MicroBatcher stats of every
+    model as JSON, GET /health an empty 200. """
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send(200, b'', 'text/plain')
+        elif self.path == '/stats':
+            stats = {name: batcher.get_stats() for name, batcher in self.server.batchers.items()}
+            self.send(200, json.dumps(stats).encode(), 'application/json')
+        else:
+            self.send(404, b'Not found', 'text/plain')
+
+    def do_POST(self):
+        path, _, query = self.path.partition('?')
+        name = path[len('/predict/'):] if path.startswith('/predict/') else None
+        if name not in self.server.batchers:
+            self.send(404, f"No model {name}".encode(), 'text/plain')
+            return
+        try:
+            x = from_npy(self.rfile.read(int(self.headers['Content-Length'])))
+            pred = self.server.batchers[name].predict(x, self.server.timeout_s)
+        except Exception as e:
+            self.send(400, str(e).encode(), 'text/plain')
+            return
+        if 'mask=1' in query.split('&'):
+            pred = (pred[..., 0] > 0.5) if pred.shape[-1] == 1 else np.argmax(pred, axis=-1)
+            pred = pred.astype(np.uint8)
+        self.send(200, to_npy(pred), 'application/octet-stream')
+
+    def send(self, code, body, content_type):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """ An HTTPServer with a thread per request, http.server has one from Python 3.7 """
+    daemon_threads = True
+
+
+class InferenceService:
+    """ Serves the models over HTTP on host:port (port 0 picks a free one).
+
+    models maps the name of each model to a dict of model_fn, model_args,
+    model_kwargs (optional), weights_path (e.g. the best_weights.tf of its
+    run, None keeps the initial weights) and example_shape, the shape of a
+    request without the batch dimension. Every model is built and loaded
+    once and traced for each padded batch size before start() returns, so
+    no request waits on a trace. See MicroBatcher for max_batch_size and
+    max_wait_ms.
+    """
+
+    def __init__(self, models, host='127.0.0.1', port=0, max_batch_size=8, max_wait_ms=5.0,
+                 jit_compile=False, timeout_s=60):
+        self.batchers = {}
+        for name, config in models.items():
+            model = config['model_fn'](*config.get('model_args', ()), **(config.get('model_kwargs') or {}))
+            model(tf.zeros((1,) + tuple(config['example_shape'])), training=False)
+            if config.get('weights_path'):
+                model.load_weights(config['weights_path']).assert_existing_objects_matched()
+            batcher = MicroBatcher(get_predict_fn(model, jit_compile), max_batch_size, max_wait_ms)
+            batcher.warm_up(config['example_shape'])
+            self.batchers[name] = batcher
+        self.server = ThreadingHTTPServer((host, port), InferenceHandler)
+        self.server.batchers = self.batchers
+        self.server.timeout_s = timeout_s
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self.url
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for batcher in self.batchers.values():
+            batcher.close()
+
+
+if __name__ == "__main__":
+    import sys
+    import os
+    sys.path.insert(0, os.getcwd())
+    from Segmentation.train.train import build_model
+
+    # python Segmentation/train/serving.py logs/.../best_weights.tf
+    service = InferenceService({'vnet': {'model_fn': build_model,
+                                         'model_args': ([16, 32, 64, 128], 7, 'vnet'),
+                                         'weights_path': sys.argv[1] if len(sys.argv) > 1 else None,
+                                         'example_shape': (32, 64, 64, 1)}},
+                               port=8080, max_batch_size=8, max_wait_ms=10)
+    print(f"Serving on {service.start()}")
+    service.thread.join()
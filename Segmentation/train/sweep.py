@@ -0,0 +1,265 @@
+import csv
+import importlib
+import itertools
+import json
+import multiprocessing
+import os
+import signal
+from glob import glob
+from time import sleep, time
+
+import numpy as np
+
+# TensorFlow is only imported by the trial processes, after their devices are pinned
+
+
+def sample_configs(search_space, num_trials=None, seed=0):
+    """ Every value of search_space is a list of choices or a distribution
+    ('uniform', low, high), ('log_uniform', low, high) or ('int', low, high)
+    with high inclusive. num_trials=None returns the full grid of the lists,
+    otherwise num_trials random samples.
+    """
+    if num_trials is None:
+        for key, values in search_space.items():
+            if not isinstance(values, list):
+                raise ValueError(f"A grid needs a list of choices for {key}, got {values}")
+        keys = list(search_space)
+        return [dict(zip(keys, values)) for values in itertools.product(*search_space.values())]
+
+    rs = np.random.RandomState(seed)
+    configs = []
+    for _ in range(num_trials):
+        config = {}
+        for key, values in search_space.items():
+            if isinstance(values, list):
+                config[key] = values[rs.randint(len(values))]
+            elif values[0] == 'uniform':
+                config[key] = float(rs.uniform(values[1], values[2]))
+            elif values[0] == 'log_uniform':
+                config[key] = float(np.exp(rs.uniform(np.log(values[1]), np.log(values[2]))))
+            elif values[0] == 'int':
+                config[key] = int(rs.randint(values[1], values[2] + 1))
+            else:
+                raise ValueError(f"Unknown distribution {values[0]} for {key}")
+        configs.append(config)
+    return configs
+
+
+class SuccessiveHalving:
+    """ Asynchronous successive halving. The rungs are at min_epochs * eta**k
+    epochs below max_epochs, a trial reaching a rung carries on only if its
+    best validation loss so far is among the best 1 / eta of the trials that
+    reached that rung before it, so no trial waits for the others.
+    """
+
+    def __init__(self, max_epochs, min_epochs=1, eta=3):
+        self.eta = eta
+        self.rungs = []
+        rung = min_epochs
+        while rung < max_epochs:
+            self.rungs.append(rung)
+            rung *= eta
+        self.rung_losses = {rung: [] for rung in self.rungs}
+
+    def report(self, epochs_done, best_loss):
+        """ Returns whether a trial that finished epochs_done epochs carries on """
+        if epochs_done not in self.rung_losses:
+            return True
+        best_loss = best_loss if np.isfinite(best_loss) else np.inf
+        losses = self.rung_losses[epochs_done]
+        losses.append(best_loss)
+        num_kept = max(1, len(losses) // self.eta)
+        return np.isfinite(best_loss) and best_loss <= sorted(losses)[num_kept - 1]
+
+
+def get_slots(max_concurrent, gpus=None, gpus_per_trial=1, cpus_per_trial=None):
+    """ The (gpus, cpus) each concurrent trial is pinned to, None leaves that
+    device type unpinned """
+    gpu_slots = [None] * max_concurrent
+    if gpus and gpus_per_trial:
+        gpu_slots = [list(gpus[i:i + gpus_per_trial])
+                     for i in range(0, len(gpus) - gpus_per_trial + 1, gpus_per_trial)]
+    elif gpus is not None:
+        # all of them hidden, the trials run on the CPU
+        gpu_slots = [[]] * max_concurrent
+    cpu_slots = [None] * max_concurrent
+    if cpus_per_trial:
+        cpus = sorted(os.sched_getaffinity(0))
+        cpu_slots = [cpus[i:i + cpus_per_trial] for i in range(0, len(cpus) - cpus_per_trial + 1, cpus_per_trial)]
+    slots = list(zip(gpu_slots, cpu_slots))[:max_concurrent]
+    if not slots:
+        raise ValueError("Not enough devices for one trial")
+    return slots
+
+
+def resolve_train_fn(train_fn):
+    """ "package.module:function" -> the function """
+    if callable(train_fn):
+        return train_fn
+    module, function = train_fn.split(':')
+    return getattr(importlib.import_module(module), function)
+
+
+def run_trial(train_fn, kwargs, log_dir, gpus, cpus):
+    # a session of its own, so stopping the trial stops the processes it started too
+    os.setsid()
+    os.makedirs(log_dir, exist_ok=True)
+    # the output of the concurrent trials would interleave, each goes to its own file
+    log_file = open(os.path.join(log_dir, 'trial.log'), 'a')
+    os.dup2(log_file.fileno(), 1)
+    os.dup2(log_file.fileno(), 2)
+    if gpus is not None:
+        os.environ['CUDA_VISIBLE_DEVICES'] = ','.join(str(gpu) for gpu in gpus)
+    if cpus is not None:
+        # TensorFlow sizes its thread pools by the CPUs it may run on
+        os.sched_setaffinity(0, cpus)
+    resolve_train_fn(train_fn)(log_dir=log_dir, **kwargs)
+
+
+def stop_trial(process):
+    """ Terminates the process group of the trial, its own process until it has one """
+    try:
+        if os.getpgid(process.pid) == process.pid:
+            os.killpg(process.pid, signal.SIGTERM)
+        else:
+            process.terminate()
+    except ProcessLookupError:
+        pass
+    process.join()
+
+
+def read_epochs(log_dir):
+    """ The complete lines of the epochs.jsonl of the run under log_dir """
+    paths = glob(os.path.join(log_dir, '**', 'epochs.jsonl'), recursive=True)
+    if not paths:
+        return [], None
+    with open(paths[0]) as f:
+        lines = f.read().split('\n')[:-1]
+    return [json.loads(line) for line in lines], os.path.dirname(paths[0])
+
+
+def run_sweep(search_space,
+              base_kwargs,
+              sweep_dir,
+              num_trials=None,
+              max_concurrent=1,
+              gpus=None,
+              gpus_per_trial=1,
+              cpus_per_trial=None,
+              min_epochs=1,
+              eta=3,
+              seed=0,
+              train_fn='Segmentation.train.train:main',
+              poll_interval=5):
+    """ Runs the configs of search_space (see sample_configs) as trials of
+    train_fn(**base_kwargs, **config), max_concurrent at a time, each in its
+    own process with log_dir=sweep_dir/trial_xxx.
+
+    Every trial is pinned to gpus_per_trial of gpus through
+    CUDA_VISIBLE_DEVICES and to cpus_per_trial CPUs, gpus=None and
+    cpus_per_trial=None leave them unpinned and gpus=[] runs on the CPU. The epoch losses the trials write
+    to epochs.jsonl drive a SuccessiveHalving over base_kwargs['epochs']
+    epochs, which stops the poor trials early. A trial runs in a session of
+    its own and is stopped with the processes it started.
+
+    sweep_dir/results.csv has a row per trial with its config, status
+    (completed, stopped or failed), epochs run and validation losses. It is
+    rewritten whenever a trial changes, the rows are also returned.
+    """
+    if 'epochs' in search_space or 'log_dir' in search_space:
+        raise ValueError("epochs and log_dir are set by the sweep")
+    configs = sample_configs(search_space, num_trials, seed)
+    scheduler = SuccessiveHalving(base_kwargs['epochs'], min_epochs, eta)
+    free_slots = get_slots(max_concurrent, gpus, gpus_per_trial, cpus_per_trial)
+    os.makedirs(sweep_dir, exist_ok=True)
+    print(f"Sweep of {len(configs)} trials, {len(free_slots)} at a time, rungs at epochs {scheduler.rungs}")
+
+    ctx = multiprocessing.get_context('spawn')
+    trials = [{'trial': i, 'config': config, 'status': 'pending', 'epochs': 0,
+               'best_val_loss': np.inf, 'last_val_loss': np.inf, 'time_s': 0.0, 'run_dir': None,
+               'log_dir': os.path.join(sweep_dir, f'trial_{i:03d}')}
+              for i, config in enumerate(configs)]
+    pending = list(trials)
+    running = []
+
+    def finish(trial, status):
+        trial['status'] = status
+        trial['time_s'] = time() - trial.pop('start')
+        trial.pop('process')
+        free_slots.append(trial.pop('slot'))
+        running.remove(trial)
+        print(f"Trial {trial['trial']} {status} after {trial['epochs']} epochs"
+              f" - best val_loss: {trial['best_val_loss']:.05f} - {trial['config']}")
+        write_results(trials, os.path.join(sweep_dir, 'results.csv'))
+
+    while pending or running:
+        while pending and free_slots:
+            trial = pending.pop(0)
+            trial['slot'] = free_slots.pop(0)
+            trial['start'] = time()
+            trial['process'] = ctx.Process(target=run_trial,
+                                           args=(train_fn, dict(base_kwargs, **trial['config']),
+                                                 trial['log_dir'], *trial['slot']))
+            trial['process'].start()
+            trial['status'] = 'running'
+            running.append(trial)
+
+        sleep(poll_interval)
+        for trial in list(running):
+            process = trial['process']
+            exited = process.exitcode is not None
+            if exited:
+                # the epochs it wrote since it was last read are read after it is gone
+                process.join()
+            records, trial['run_dir'] = read_epochs(trial['log_dir'])
+            stop = False
+            for record in records[trial['epochs']:]:
+                trial['epochs'] = record['epoch'] + 1
+                trial['last_val_loss'] = record['val_loss']
+                trial['best_val_loss'] = min(trial['best_val_loss'], record['val_loss'])
+                if not scheduler.report(trial['epochs'], trial['best_val_loss']) and not exited:
+                    stop = True
+                    break
+            if exited:
+                finish(trial, 'completed' if process.exitcode == 0 else 'failed')
+            elif stop:
+                stop_trial(process)
+                finish(trial, 'stopped')
+
+    rows = write_results(trials, os.path.join(sweep_dir, 'results.csv'))
+    epochs_run = sum(trial['epochs'] for trial in trials)
+    print(f"{epochs_run} epochs run, {len(trials) * base_kwargs['epochs']} without early stopping")
+    for row in sorted(rows, key=lambda row: row['best_val_loss']):
+        print(" - ".join(f"{key}: {value}" for key, value in row.items() if key != 'run_dir'))
+    return rows
+
+
+def write_results(trials, path):
+    keys = sorted(set(key for trial in trials for key in trial['config']))
+    rows = [dict([('trial', trial['trial']), ('status', trial['status']), ('epochs', trial['epochs']),
+                  ('best_val_loss', trial['best_val_loss']), ('last_val_loss', trial['last_val_loss']),
+                  ('time_s', round(trial['time_s'], 1)), ('run_dir', trial['run_dir'])]
+                 + [(key, trial['config'].get(key)) for key in keys])
+            for trial in trials]
+    with open(path + '.tmp', 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(path + '.tmp', path)
+    return rows
+
+
+if __name__ == "__main__":
+    import sys
+    sys.path.insert(0, os.getcwd())
+
+    run_sweep({'lr': ('log_uniform', 1e-5, 1e-3),
+               'crop_size': [64, 96, 144],
+               'aug': [[], ['rotate'], ['rotate', 'flip']],
+               'num_channels': [[8, 16, 32, 64], [16, 32, 64, 128]]},
+              {'epochs': 27, 'name': 'vnet_sweep', 'num_to_visualise': 0},
+              'logs/sweep',
+              num_trials=27,
+              max_concurrent=4,
+              gpus=[0, 1, 2, 3],
+              eta=3)
@@ -1,18 +1,27 @@
 import sys
 import os
+import json
+import shutil
+import tempfile
 from glob import glob
 import datetime
 import tensorflow as tf
 import numpy as np
 from time import time
 
-from Segmentation.train.utils import setup_gpu, LearningRateUpdate, Metric
+from Segmentation.train.utils import setup_gpu, LearningRateUpdate, Metric, ConfusionMetric
+from Segmentation.train.utils import setup_mixed_precision, get_loss_scale_optimizer, setup_compile_cache
+from Segmentation.train.utils import get_strategy, distribute_dataset, is_chief, CropCurriculum
+from Segmentation.train.utils import check_batch_size, check_num_steps
 from Segmentation.train.reshape import get_mid_slice, get_mid_vol
 from Segmentation.train.validation import validate_best_model
+from Segmentation.train.profiler import StepProfiler, TraceWindow
+from Segmentation.train.checkpoint import AsyncCheckpointManager
+from Segmentation.train.background_validation import BackgroundValidator
+from Segmentation.train.planner import choose_batch_size
 from Segmentation.utils.data_loader import read_tfrecord_3d
-from Segmentation.utils.visualise_utils import visualise_sample
-from Segmentation.utils.losses import dice_loss, tversky_loss, iou_loss
-from Segmentation.utils.losses import iou_loss_eval_3d, dice_coef_eval_3d
+from Segmentation.utils.visualise_utils import visualise_sample, VisualisationPool
+from Segmentation.utils.losses import dice_loss, tversky_loss
 from Segmentation.utils.losses import dice_loss_weighted_3d, focal_tversky
 from Segmentation.model.vnet import VNet
 
@@ -28,8 +37,24 @@ class Train:
                  predict_slice,
                  metrics,
                  tfrec_dir='./Data/tfrecords/',
-                 log_dir="logs"):
-
+                 log_dir="logs",
+                 accum_steps=1,
+                 steps_per_epoch=None,
+                 validation_steps=None,
+                 steps_per_execution=1,
+                 profile=False,
+                 profile_steps=None,
+                 profile_dir=None,
+                 keep_top_k=3,
+                 keep_latest=1,
+                 checkpoint_steps=0,
+                 resume=None,
+                 background_validator=None,
+                 curriculum=None,
+                 jit_compile=False,
+                 best_model=None):
+        """ metrics is either a ConfusionMetric or the dict Metric takes, the
+        other options are explained by the methods that use them """
 
         self.epochs = epochs
         self.batch_size = batch_size
@@ -39,35 +64,358 @@ class Train:
         self.loss_func = loss_func
         self.lr_manager = lr_manager
         self.predict_slice = predict_slice
-        self.metrics = Metric(metrics)
+        self.metrics = metrics if isinstance(metrics, ConfusionMetric) else Metric(metrics)
         self.tfrec_dir = tfrec_dir
         self.log_dir = log_dir
+        self.accum_steps = accum_steps
+        self.steps_per_epoch = steps_per_epoch
+        self.validation_steps = validation_steps
+        self.steps_per_execution = steps_per_execution
+        self.profile = profile
+        self.profile_steps = profile_steps
+        self.profile_dir = profile_dir
+        self.keep_top_k = keep_top_k
+        self.keep_latest = keep_latest
+        self.checkpoint_steps = checkpoint_steps
+        self.resume = resume
+        self.background_validator = background_validator
+        self.curriculum = curriculum
+        self.jit_compile = jit_compile
+        self.best_model = best_model
+        if curriculum is None:
+            # a curriculum checks the batch size and steps of each of its phases
+            check_batch_size(batch_size, tf.distribute.get_strategy().num_replicas_in_sync, accum_steps)
+            check_num_steps(steps_per_epoch=steps_per_epoch, validation_steps=validation_steps)
+        check_num_steps(steps_per_execution=steps_per_execution)
+        if jit_compile:
+            # XLA compiles the model call, loss and backward pass, the gradients are still all-reduced
+            # and applied outside it. Its 3D convolutions on the CPU are slower, see benchmark.benchmark_jit
+            self.compute_gradients = tf.function(self.compute_gradients, experimental_compile=True)
+            self.compute_loss = tf.function(self.compute_loss, experimental_compile=True)
+        # the LossScaleOptimizer of either mixed precision API
+        self.loss_scale = hasattr(optimizer, 'get_scaled_loss')
 
     def train_step(self,
                    x_train,
                    y_train,
-                   visualise):
-        with tf.GradientTape() as tape:
-            predictions = self.model(x_train, training=True)
-            loss = self.loss_func(y_train, predictions)
-        grads = tape.gradient(loss, self.model.trainable_variables)
+                   visualise,
+                   store_metrics=True):
+        if self.accum_steps > 1:
+            loss, grads, predictions = self.accumulate_gradients(x_train, y_train)
+        else:
+            loss, grads, predictions = self.compute_gradients(x_train, y_train)
         self.optimizer.apply_gradients(zip(grads, self.model.trainable_variables))
-        self.metrics.store_metric(y_train, predictions, training=True)
+        if store_metrics:
+            self.metrics.store_metric(y_train, predictions, training=True)
         if visualise:
             return loss, predictions
         return loss, None
 
+    def compute_gradients(self,
+                          x_train,
+                          y_train):
+        """ With a LossScaleOptimizer the loss is scaled for the backward pass
+        and the gradients unscaled, the optimizer skips non-finite steps """
+        with tf.GradientTape() as tape:
+            predictions = self.model(x_train, training=True)
+            loss = self.loss_func(y_train, predictions)
+            scaled_loss = self.optimizer.get_scaled_loss(loss) if self.loss_scale else loss
+        grads = tape.gradient(scaled_loss, self.model.trainable_variables)
+        if self.loss_scale:
+            grads = self.optimizer.get_unscaled_gradients(grads)
+        return loss, grads, predictions
+
+    def accumulate_gradients(self,
+                             x_train,
+                             y_train):
+        """ Runs the micro-batches one after another in a while loop, so only
+        one micro-batch of activations is alive at a time, and returns the
+        mean loss and gradients and the predictions for the whole batch.
+        batch_size is the effective batch, it has to divide into accum_steps
+        micro-batches on every replica, and the optimizer counts effective steps.
+        """
+        num_micro = self.accum_steps
+        x_micro = tf.reshape(x_train, tf.concat([[num_micro, -1], tf.shape(x_train)[1:]], axis=0))
+        y_micro = tf.reshape(y_train, tf.concat([[num_micro, -1], tf.shape(y_train)[1:]], axis=0))
+
+        if not self.model.built:
+            # variables can not be created inside the loop
+            self.model(x_micro[0], training=False)
+        variables = self.model.trainable_variables
+
+        def body(i, total_loss, total_grads, predictions):
+            loss, grads, pred = self.compute_gradients(x_micro[i], y_micro[i])
+            total_loss += tf.cast(loss, tf.float32) / num_micro
+            total_grads = [g if mg is None else g + tf.cast(mg, g.dtype) / num_micro for g, mg in zip(total_grads, grads)]
+            predictions = predictions.write(i, tf.cast(pred, tf.float32))
+            return i + 1, total_loss, total_grads, predictions
+
+        total_grads = [tf.zeros_like(v) for v in variables]
+        predictions = tf.TensorArray(tf.float32, size=num_micro)
+        _, loss, grads, predictions = tf.while_loop(lambda i, *_: i < num_micro,
+                                                    body,
+                                                    [tf.constant(0), tf.constant(0.0), total_grads, predictions],
+                                                    parallel_iterations=1)
+        predictions = predictions.stack()
+        predictions = tf.reshape(predictions, tf.concat([[-1], tf.shape(predictions)[2:]], axis=0))
+        return loss, grads, predictions
+
+    def get_current_lr(self):
+        lr = self.optimizer.learning_rate
+        if isinstance(lr, tf.keras.optimizers.schedules.LearningRateSchedule):
+            lr = lr(self.optimizer.iterations)
+        return float(tf.keras.backend.get_value(lr))
+
+    def compute_loss(self,
+                     x_test,
+                     y_test):
+        predictions = self.model(x_test, training=False)
+        loss = self.loss_func(y_test, predictions)
+        return loss, predictions
+
     def test_step(self,
                   x_test,
                   y_test,
-                  visualise):
-        predictions = self.model(x_test, training=False)
-        loss = self.loss_func(y_test, predictions)
-        self.metrics.store_metric(y_test, predictions, training=False)
+                  visualise,
+                  store_metrics=True):
+        loss, predictions = self.compute_loss(x_test, y_test)
+        if store_metrics:
+            self.metrics.store_metric(y_test, predictions, training=False)
         if visualise:
             return loss, predictions
         return loss, None
 
+    def distributed_train_step(self, x, y, visualise, store_metrics=True):
+        """ train_step on every replica, returns the summed loss and the predictions """
+        total_step_loss, pred = self.strategy.run(self.train_step, args=(x, y, visualise, store_metrics, ))
+        return self.strategy.reduce(
+            tf.distribute.ReduceOp.SUM, total_step_loss, axis=None), pred
+
+    def distributed_test_step(self, x, y, visualise, store_metrics=True):
+        """ test_step on every replica, returns the summed loss and the predictions """
+        total_step_loss, pred = self.strategy.run(self.test_step, args=(x, y, visualise, store_metrics, ))
+        return self.strategy.reduce(
+            tf.distribute.ReduceOp.SUM, total_step_loss, axis=None), pred
+
+    def distributed_metric_update(self, y, pred, training):
+        self.strategy.run(self.metrics.store_metric, args=(y, pred, training, ))
+        # a returned value to wait on, so the update can be timed
+        return tf.constant(0)
+
+    def train_steps(self, iterator, num_steps):
+        """ The summed loss of num_steps train steps, a graph loop in a tf.function """
+        total_loss = tf.constant(0.0)
+        for _ in tf.range(num_steps):
+            x, y = next(iterator)
+            total_loss += self.distributed_train_step(x, y, False)[0]
+        return total_loss
+
+    def test_steps(self, iterator, num_steps):
+        """ The summed loss of num_steps test steps, a graph loop in a tf.function """
+        total_loss = tf.constant(0.0)
+        for _ in tf.range(num_steps):
+            x, y = next(iterator)
+            total_loss += self.distributed_test_step(x, y, False)[0]
+        return total_loss
+
+    def skip_batches(self, iterator, num_steps):
+        for _ in tf.range(num_steps):
+            next(iterator)
+        return tf.constant(0)
+
+    def compile_step_fns(self):
+        """ The step functions of the loop by name, new tf.functions if
+        enable_function so the graphs traced for an earlier phase are dropped """
+        step_fns = {'train': self.distributed_train_step,
+                    'test': self.distributed_test_step,
+                    'train_steps': self.train_steps,
+                    'test_steps': self.test_steps,
+                    'metrics': self.distributed_metric_update,
+                    'skip': self.skip_batches}
+        if self.enable_function:
+            step_fns = {name: tf.function(fn) for name, fn in step_fns.items()}
+        self.step_fns = step_fns
+
+    def get_run_dir(self, multi_class, debug):
+        """ The log dir of a new run, or of the run resumed """
+        if self.resume is not None:
+            return self.resume
+        name = "/" + self.model.name
+        db = "/debug" if debug else "/test"
+        mc = "/multi" if multi_class else "/binary"
+        return self.log_dir + name + db + mc + datetime.datetime.now().strftime("/%Y%m%d/%H%M%S")
+
+    def setup_checkpoints(self, log_dir_now, chief):
+        """ The AsyncCheckpointManager of the run, which keeps the keep_top_k
+        best epochs by validation loss and the keep_latest most recent. With a
+        best_model, a second model of the same architecture, it saves every new
+        best as best_weights.tf as it arrives, and it passes the new bests to
+        the background_validator, which validates them in its own process """
+        on_best = None
+        if self.background_validator is not None and chief:
+            self.background_validator.start(log_dir_now)
+            on_best = self.background_validator.submit
+        return AsyncCheckpointManager(self.model, os.path.join(log_dir_now, 'checkpoints'),
+                                      keep_top_k=self.keep_top_k, keep_latest=self.keep_latest,
+                                      on_best=on_best, best_model=self.best_model,
+                                      best_weights_path=os.path.join(log_dir_now, 'best_weights.tf'))
+
+    def setup_state(self, log_dir_now):
+        """ The training state under log_dir_now/resume, saved at the end of every
+        epoch and every checkpoint_steps train steps. The data is a deterministic
+        stream, so its position is the epoch and the step in it """
+        self.state = tf.train.Checkpoint(model=self.model,
+                                         optimizer=self.optimizer,
+                                         epoch=tf.Variable(0, dtype=tf.int64),
+                                         step=tf.Variable(0, dtype=tf.int64),
+                                         epoch_step=tf.Variable(0, dtype=tf.int64),
+                                         epoch_loss=tf.Variable(0.0),
+                                         best_loss=tf.Variable(np.inf))
+        if isinstance(self.metrics, ConfusionMetric):
+            self.state.train_metrics = self.metrics.stats[0]
+        self.state_manager = tf.train.CheckpointManager(self.state, os.path.join(log_dir_now, 'resume'),
+                                                        max_to_keep=1)
+
+    def save_state(self, epoch, epoch_step, epoch_loss):
+        self.state.epoch.assign(epoch)
+        self.state.step.assign(self.global_step)
+        self.state.epoch_step.assign(epoch_step)
+        self.state.epoch_loss.assign(epoch_loss)
+        self.state.best_loss.assign(np.inf if self.best_loss is None else self.best_loss)
+        self.state_manager.save(checkpoint_number=self.global_step)
+
+    def restore_state(self, run_dir):
+        """ Restores the last state of run_dir when resuming, returns the epoch,
+        the step in it and the loss sum of its steps done so far """
+        latest_state = tf.train.latest_checkpoint(os.path.join(run_dir, 'resume'))
+        if self.resume is None or not latest_state:
+            return 0, 0, 0.0
+        self.state.restore(latest_state)
+        self.global_step = int(self.state.step.numpy())
+        best_loss = float(self.state.best_loss.numpy())
+        self.best_loss = None if np.isinf(best_loss) else best_loss
+        start_epoch = int(self.state.epoch.numpy())
+        print(f"Resuming {run_dir} at epoch {start_epoch + 1}, step {self.global_step}")
+        return start_epoch, int(self.state.epoch_step.numpy()), float(self.state.epoch_loss.numpy())
+
+    def start_iterators(self, train_ds, valid_ds, start_epoch, start_batch):
+        """ The iterators of a run without a curriculum, which carry on from
+        epoch to epoch. The datasets are either datasets, read again from the
+        start and skipped to the global step when resuming, or functions of
+        the epoch their stream starts at, e.g. read_tfrecord_3d(...,
+        start_epoch=start_epoch), so only the steps of the epoch done already
+        are skipped. Every epoch is steps_per_epoch (validation_steps) batches """
+        if callable(train_ds):
+            self.train_iter = iter(train_ds(start_epoch))
+            self.valid_iter = iter(valid_ds(start_epoch))
+            if start_batch:
+                self.step_fns['skip'](self.train_iter, tf.constant(start_batch))
+            return
+        self.train_iter = iter(train_ds)
+        self.valid_iter = iter(valid_ds)
+        if self.global_step:
+            self.step_fns['skip'](self.train_iter, tf.constant(self.global_step))
+            self.step_fns['skip'](self.valid_iter, tf.constant(start_epoch * self.validation_steps))
+
+    def start_phase(self, train_ds, valid_ds, epoch):
+        """ Starts the CropCurriculum phase of epoch: the steps of an epoch are
+        the phase's, the step functions are compiled anew for its shapes and
+        the iterators built from train_ds(phase, epoch within the phase) and
+        valid_ds(...), moved to where the run is within the phase """
+        phase = self.curriculum.get_phase(epoch)
+        self.steps_per_epoch = phase['steps_per_epoch']
+        self.validation_steps = phase['validation_steps']
+        self.compile_step_fns()
+        self.train_iter = iter(train_ds(phase, epoch - phase['epoch']))
+        self.valid_iter = iter(valid_ds(phase, epoch - phase['epoch']))
+        # the steps of a resumed epoch that are done already
+        train_skip = self.global_step - self.curriculum.get_steps_before(epoch)
+        if train_skip:
+            self.step_fns['skip'](self.train_iter, tf.constant(train_skip))
+        print(f"Epoch {epoch + 1}: crop_size {phase['crop_size']}, depth_crop_size {phase['depth_crop_size']}, "
+              f"batch_size {phase['batch_size']}")
+        return phase
+
+    def steps_to_boundary(self):
+        """ The train steps until the profiler trace starts or stops or a checkpoint is due, None if neither """
+        boundaries = [self.trace.steps_to_boundary(self.global_step)]
+        if self.checkpoint_steps:
+            boundaries.append(self.checkpoint_steps - self.global_step % self.checkpoint_steps)
+        boundaries = [b for b in boundaries if b]
+        return min(boundaries) if boundaries else None
+
+    def distributed_epoch(self,
+                          iterator,
+                          num_batches,
+                          epoch,
+                          is_training,
+                          num_to_visualise,
+                          multi_class,
+                          slice_writer,
+                          vol_writer,
+                          start_batch=0,
+                          start_loss=0.0):
+        """ Runs num_batches steps and returns the mean loss. The visualised
+        steps run one by one and the rest steps_per_execution at a time in one
+        tf.function call, ending where steps_to_boundary does. profile=True
+        times every step with the StepProfiler, one at a time. A resumed epoch
+        starts at start_batch with the loss sum start_loss. """
+        run_strategy = self.step_fns['train' if is_training else 'test']
+        run_steps = self.step_fns['train_steps' if is_training else 'test_steps']
+        total_loss, num_batch = start_loss, start_batch
+        use_2d = False
+        while num_batch < num_batches:
+            if is_training:
+                self.trace.update(self.global_step)
+            with self.trace.step_context('train' if is_training else 'validation', self.global_step):
+                if self.profiler.enabled:
+                    # one step at a time, so every phase can be timed on its own
+                    with self.profiler.phase('data'):
+                        x, y = next(iterator)
+                    with self.profiler.phase('compute'):
+                        loss, pred = run_strategy(x, y, True, False)
+                        loss.numpy()
+                    with self.profiler.phase('metrics'):
+                        self.step_fns['metrics'](y, pred, is_training).numpy()
+                    if num_batch < num_to_visualise:
+                        with self.profiler.phase('visualise'):
+                            num_to_visualise = visualise_sample(x, y, pred,
+                                                                num_to_visualise,
+                                                                slice_writer, vol_writer,
+                                                                use_2d, epoch, multi_class, self.predict_slice,
+                                                                is_training, self.strategy, self.visualiser,
+                                                                self.visual_save_freq)
+                    self.profiler.end_step(epoch, x, self.strategy, is_training)
+                    num_steps = 1
+                elif num_batch < num_to_visualise:
+                    x, y = next(iterator)
+                    loss, pred = run_strategy(x, y, True)
+                    num_to_visualise = visualise_sample(x, y, pred,
+                                                        num_to_visualise,
+                                                        slice_writer, vol_writer,
+                                                        use_2d, epoch, multi_class, self.predict_slice, is_training,
+                                                        self.strategy, self.visualiser, self.visual_save_freq)
+                    num_steps = 1
+                else:
+                    num_steps = min(self.steps_per_execution, num_batches - num_batch)
+                    if is_training and self.steps_to_boundary():
+                        num_steps = min(num_steps, self.steps_to_boundary())
+                    loss = run_steps(iterator, tf.constant(num_steps))
+            total_loss += loss
+            num_batch += num_steps
+            if is_training:
+                self.global_step += num_steps
+                if self.checkpoint_steps and self.global_step % self.checkpoint_steps == 0 and num_batch < num_batches:
+                    self.save_state(epoch, num_batch, total_loss)
+        return total_loss / self.strategy.num_replicas_in_sync / num_batches
+
+    def log_epoch(self, epoch, train_loss, test_loss, lr, seconds):
+        """ Appends the losses of the epoch to epochs.jsonl, which a sweep reads while the run goes on """
+        self.epoch_log.write(json.dumps({'epoch': epoch, 'loss': float(train_loss), 'val_loss': float(test_loss),
+                                         'best_val_loss': float(self.best_loss), 'lr': lr,
+                                         'time': seconds}) + '\n')
+        self.epoch_log.flush()
+
     def train_model_loop(self,
                          train_ds,
                          valid_ds,
@@ -78,78 +426,14 @@ class Train:
                          num_to_visualise=0):
         """ Trains 3D model with custom tf loop and MirrorStrategy
         """
-
-        def run_train_strategy(x, y, visualise):
-            total_step_loss, pred = strategy.run(self.train_step, args=(x, y, visualise, ))
-            return strategy.reduce(
-                tf.distribute.ReduceOp.SUM, total_step_loss, axis=None), pred
-
-        def run_test_strategy(x, y, visualise):
-            total_step_loss, pred = strategy.run(self.test_step, args=(x, y, visualise, ))
-            return strategy.reduce(
-                tf.distribute.ReduceOp.SUM, total_step_loss, axis=None), pred
-
-        # TODO(Joe): This needs to be rewritten so that it works with 2D as well
-        def distributed_train_epoch(train_ds,
-                                    epoch,
-                                    strategy,
-                                    num_to_visualise,
-                                    multi_class,
-                                    slice_writer,
-                                    vol_writer,
-                                    visual_save_freq,
-                                    predict_slice):
-
-            total_loss, num_train_batch = 0.0, 0.0
-            is_training = True
-            use_2d = False
-            for x_train, y_train in train_ds:
-                visualise = (num_train_batch < num_to_visualise)
-                loss, pred = run_train_strategy(x_train, y_train, visualise)
-                loss /= strategy.num_replicas_in_sync
-                total_loss += loss
-                if visualise:
-                    num_to_visualise = visualise_sample(x_train, y_train, pred, 
-                                                        num_to_visualise,
-                                                        slice_writer, vol_writer, 
-                                                        use_2d, epoch, multi_class, predict_slice, is_training)
-                num_train_batch += 1
-            return total_loss / num_train_batch
-
-        def distributed_test_epoch(valid_ds,
-                                   epoch,
-                                   strategy,
-                                   num_to_visualise,
-                                   multi_class,
-                                   slice_writer,
-                                   vol_writer,
-                                   visual_save_freq,
-                                   predict_slice):
-            total_loss, num_test_batch = 0.0, 0.0
-            is_training = False
-            use_2d = False
-            for x_valid, y_valid in valid_ds:
-                visualise = (num_test_batch < num_to_visualise)
-                loss, pred = run_test_strategy(x_valid, y_valid, visualise)
-                loss /= strategy.num_replicas_in_sync
-                total_loss += loss
-                if visualise:
-                    num_to_visualise = visualise_sample(x_train, y_train, pred, 
-                                                        num_to_visualise,
-                                                        slice_writer, vol_writer, 
-                                                        use_2d, epoch, multi_class, predict_slice, is_training)
-                num_test_batch += 1
-            return total_loss / num_test_batch
-
-        if self.enable_function:
-            run_train_strategy = tf.function(run_train_strategy)
-            run_test_strategy = tf.function(run_test_strategy)
-
-        # TODO: This whole chunk of code needs to be refactored. Perhaps write it as a function
-        name = "/" + self.model.name
-        db = "/debug" if debug else "/test"
-        mc = "/multi" if multi_class else "/binary"
-        log_dir_now = self.log_dir + name + db + mc + datetime.datetime.now().strftime("/%Y%m%d/%H%M%S")
+        self.strategy = strategy
+        self.visual_save_freq = visual_save_freq
+        self.compile_step_fns()
+
+        run_dir = self.get_run_dir(multi_class, debug)
+        # every worker runs the same steps and collectives, only the chief's files are kept
+        chief = is_chief()
+        log_dir_now = run_dir if chief else tempfile.mkdtemp(prefix='worker_')
         train_summary_writer = tf.summary.create_file_writer(log_dir_now + '/train')
         test_summary_writer = tf.summary.create_file_writer(log_dir_now + '/val')
         test_min_summary_writer = tf.summary.create_file_writer(log_dir_now + '/val_min')
@@ -160,65 +444,87 @@ class Train:
         lr_summary_writer = tf.summary.create_file_writer(log_dir_now + '/lr')
 
         self.metrics.add_metric_summary_writer(log_dir_now)
-
-        best_loss = None
-        for e in range(self.epochs):
+        self.profiler = StepProfiler(log_dir_now, enabled=self.profile)
+        # the image summaries are rendered off the training thread
+        self.visualiser = VisualisationPool()
+        # profile_steps="start:stop" captures a tf.profiler trace of those global train steps
+        self.trace = TraceWindow(self.profile_steps, self.profile_dir or os.path.join(log_dir_now, 'trace'))
+        self.global_step = 0
+        self.best_loss = None
+        ckpt_manager = self.setup_checkpoints(log_dir_now, chief)
+        self.epoch_log = open(os.path.join(log_dir_now, 'epochs.jsonl'), 'a')
+
+        self.setup_state(log_dir_now)
+        start_epoch, start_batch, start_loss = self.restore_state(run_dir)
+        if self.curriculum is None:
+            self.start_iterators(train_ds, valid_ds, start_epoch, start_batch)
+
+        phase = None
+        for e in range(start_epoch, self.epochs):
+            if self.curriculum is not None and self.curriculum.get_phase(e) is not phase:
+                phase = self.start_phase(train_ds, valid_ds, e)
             self.optimizer.learning_rate = self.lr_manager.update_lr(e)
 
             et0 = time()
 
-            train_loss = distributed_train_epoch(train_ds,
-                                                 e,
-                                                 strategy,
-                                                 num_to_visualise,
-                                                 multi_class,
-                                                 train_img_slice_writer,
-                                                 train_img_vol_writer,
-                                                 visual_save_freq,
-                                                 self.predict_slice)
+            train_loss = self.distributed_epoch(self.train_iter,
+                                                self.steps_per_epoch,
+                                                e,
+                                                True,
+                                                num_to_visualise,
+                                                multi_class,
+                                                train_img_slice_writer,
+                                                train_img_vol_writer,
+                                                start_batch if e == start_epoch else 0,
+                                                start_loss if e == start_epoch else 0.0)
 
             with train_summary_writer.as_default():
                 tf.summary.scalar('epoch_loss', train_loss, step=e)
 
-            # distributed_test_epoch(valid_ds,
-            #                        e,
-            #                        strategy,
-            #                        num_to_visualise,
-            #                        multi_class,
-            #                        test_img_slice_writer,
-            #                        test_img_vol_writer,
-            #                        visual_save_freq,
-            #                        self.predict_slice)
-            test_loss = distributed_test_epoch(valid_ds,
+            test_loss = self.distributed_epoch(self.valid_iter,
+                                               self.validation_steps,
                                                e,
-                                               strategy,
+                                               False,
                                                num_to_visualise,
                                                multi_class,
                                                test_img_slice_writer,
-                                               test_img_vol_writer,
-                                               visual_save_freq,
-                                               self.predict_slice)
+                                               test_img_vol_writer)
             with test_summary_writer.as_default():
                 tf.summary.scalar('epoch_loss', test_loss, step=e)
 
-            current_lr = self.optimizer.get_config()['learning_rate']
+            current_lr = self.get_current_lr()
             with lr_summary_writer.as_default():
                 tf.summary.scalar('epoch_lr', current_lr, step=e)
 
             self.metrics.record_metric_to_summary(e)
             metric_str = self.metrics.reset_metrics_get_str()
-            print(f"Epoch {e+1}/{self.epochs} - {time() - et0:.0f}s - loss: {train_loss:.05f} - val_loss: {test_loss:.05f} - lr: {self.optimizer.get_config()['learning_rate']: .06f}" + metric_str)
-
-            if best_loss is None:
-                self.model.save_weights(os.path.join(log_dir_now + f'/best_weights.tf'))
-                best_loss = test_loss
-            else:
-                if test_loss < best_loss:
-                    self.model.save_weights(os.path.join(log_dir_now + f'/best_weights.tf'))
-                    best_loss = test_loss
+
+            with self.profiler.phase('checkpoint'):
+                ckpt_manager.save(e, test_loss)
+                if self.best_loss is None or test_loss < self.best_loss:
+                    self.best_loss = test_loss
+            profile_str = self.profiler.end_epoch(e)
+            print(f"Epoch {e+1}/{self.epochs} - {time() - et0:.0f}s - loss: {train_loss:.05f} - val_loss: {test_loss:.05f} - lr: {current_lr: .06f}" + metric_str + profile_str)
             with test_min_summary_writer.as_default():
-                tf.summary.scalar('epoch_loss', best_loss, step=e)
-        return log_dir_now
+                tf.summary.scalar('epoch_loss', self.best_loss, step=e)
+            self.log_epoch(e, train_loss, test_loss, current_lr, time() - et0)
+            self.save_state(e + 1, 0, 0.0)
+        self.epoch_log.close()
+        self.profiler.close()
+        self.trace.close()
+        self.visualiser.close()
+        if self.visualiser.dropped:
+            print(f"Dropped {self.visualiser.dropped} visualisations, the pool was full")
+        # the weights of the best epoch go where train.main and validation load them from
+        ckpt_manager.restore_best()
+        ckpt_manager.close()
+        if self.background_validator is not None:
+            self.background_validator.close()
+        if self.best_model is None:
+            self.model.save_weights(os.path.join(log_dir_now + f'/best_weights.tf'))
+        if not chief:
+            shutil.rmtree(log_dir_now, ignore_errors=True)
+        return run_dir
 
 
 def load_datasets(batch_size, buffer_size,
@@ -228,9 +534,15 @@ def load_datasets(batch_size, buffer_size,
                   depth_crop_size=80,
                   aug=[],
                   predict_slice=False,
+                  seed=1,
+                  num_shards=1,
+                  shard_index=0,
+                  start_epoch=0,
                   ):
     """
-    Loads tf records datasets for 3D models.
+    Loads tf records datasets for 3D models, num_shards and shard_index pick
+    the files of one worker of a multi worker run, start_epoch is the epoch
+    they start at.
     """
     args = {
         'batch_size': batch_size,
@@ -240,6 +552,10 @@ def load_datasets(batch_size, buffer_size,
         'crop_size': crop_size, 
         'depth_crop_size': depth_crop_size,
         'aug': aug,
+        'seed': seed,
+        'num_shards': num_shards,
+        'shard_index': shard_index,
+        'start_epoch': start_epoch,
     }
     train_ds = read_tfrecord_3d(tfrecords_dir=os.path.join(tfrec_dir, 'train_3d/'),
                                 is_training=True, predict_slice=predict_slice, **args)
@@ -279,41 +595,107 @@ def main(epochs,
          tpu=False,
          min_lr=1e-7,
          custom_loss=None,
+         seed=1,
+         accum_steps=1,
+         precision=None,
+         steps_per_execution=1,
+         profile=False,
+         profile_steps=None,
+         profile_dir=None,
+         keep_top_k=3,
+         keep_latest=1,
+         checkpoint_steps=0,
+         resume=None,
+         background_validation=False,
+         background_validation_gpu=None,
+         background_validation_volumes=None,
+         multi_worker=False,
+         log_dir="logs",
+         curriculum=None,
+         jit_compile=False,
+         compile_cache_dir=None,
+         memory_budget_mb=None,
+         inference_batch_size=4,
+         gaussian=False,
+         in_graph_validation=False,
+         tta=(),
          **model_kwargs,
          ):
+    """ multi_worker=True trains with MultiWorkerMirroredStrategy on the
+    cluster in TF_CONFIG, batch_size is then the batch of all workers together.
+    The run dir is created under log_dir.
+
+    curriculum is a list of the phases of a CropCurriculum, which then sets
+    the training crop and batch sizes by epoch. crop_size and depth_crop_size
+    remain the window of the whole-volume validation.
+
+    jit_compile=True compiles the steps with XLA, compile_cache_dir keeps the
+    compiled kernels for the next runs, e.g. the trials of a sweep.
+
+    batch_size='auto' picks the largest power of two batch per replica the
+    planner estimates to fit in memory_budget_mb on each device.
+
+    The whole-volume validation runs inference_batch_size windows through
+    the model at once, gaussian=True weights their overlap by the distance
+    from each window's centre, in_graph_validation=True stitches them in
+    a single tf.function. tta lists the test time augmentations (see
+    validation.TTA_TRANSFORMS) each window is averaged over. """
     t0 = time()
 
+    setup_compile_cache(compile_cache_dir)
+    strategy = get_strategy(tpu='pit-tpu' if tpu else None, multi_worker=multi_worker)
+    # strategy = tf.distribute.OneDeviceStrategy(device="/gpu:0")
+
     if tpu:
         tfrec_dir = 'gs://oai-challenge-dataset/tfrecords'
 
     num_classes = 7 if multi_class else 1
-
-    metrics = {
-        'losses': {
-            'mIoU': [iou_loss, tf.keras.metrics.Mean(), tf.keras.metrics.Mean(), None, None],
-            'dice': [dice_loss, tf.keras.metrics.Mean(), tf.keras.metrics.Mean(), None, None]
-        },
-    }
-
-    if multi_class:
-        metrics['losses']['mIoU-6ch'] = [iou_loss_eval_3d, tf.keras.metrics.Mean(), tf.keras.metrics.Mean(), None, None]
-        metrics['losses']['dice-6ch'] = [dice_coef_eval_3d, tf.keras.metrics.Mean(), tf.keras.metrics.Mean(), None, None]
-
-    train_ds, valid_ds = load_datasets(batch_size, buffer_size, tfrec_dir, multi_class,
-                                       crop_size=crop_size, depth_crop_size=depth_crop_size, aug=aug,
-                                       predict_slice=predict_slice)
+    setup_mixed_precision(precision)
+
+    if batch_size == 'auto':
+        if memory_budget_mb is None:
+            raise ValueError("batch_size='auto' needs a memory_budget_mb")
+        batch_size = choose_batch_size(build_model, (num_channels, num_classes, name),
+                                       dict(predict_slice=predict_slice, **model_kwargs),
+                                       crop_size, depth_crop_size, memory_budget_mb,
+                                       num_replicas=strategy.num_replicas_in_sync)
+        print(f"Batch size: {batch_size}")
+
+    def dataset_fn(is_training, crop_size=crop_size, depth_crop_size=depth_crop_size, seed=seed, start_epoch=0):
+        def shard_fn(shard_batch_size, num_shards, shard_index):
+            datasets = load_datasets(shard_batch_size, buffer_size, tfrec_dir, multi_class,
+                                     crop_size=crop_size, depth_crop_size=depth_crop_size, aug=aug,
+                                     predict_slice=predict_slice, seed=seed,
+                                     num_shards=num_shards, shard_index=shard_index, start_epoch=start_epoch)
+            return datasets[0 if is_training else 1]
+        return shard_fn
+
+    def epoch_dataset_fn(is_training):
+        def build(start_epoch):
+            return distribute_dataset(strategy, dataset_fn(is_training, start_epoch=start_epoch), batch_size)
+        return build
+
+    def phase_dataset_fn(is_training):
+        def build(phase, start_epoch):
+            # a seed of its own, so the phases do not repeat the augmentations of the first
+            shard_fn = dataset_fn(is_training, phase['crop_size'], phase['depth_crop_size'], seed + phase['index'],
+                                  start_epoch)
+            return distribute_dataset(strategy, shard_fn, phase['batch_size'])
+        return build
+
+    # the checkpoint thread saves the best weights through this copy, kept on the host
+    with tf.device('/cpu:0'):
+        best_model = build_model(num_channels, num_classes, name, predict_slice=predict_slice, **model_kwargs)
+        best_model(tf.zeros((1, depth_crop_size * 2 + (1 if predict_slice else 0), crop_size * 2, crop_size * 2, 1)),
+                   training=False)
 
     num_gpu = len(tf.config.experimental.list_physical_devices('GPU'))
-    steps_per_epoch = len(glob(os.path.join(tfrec_dir, 'train_3d/*'))) / (batch_size)
-
-    if tpu:
-        resolver = tf.distribute.cluster_resolver.TPUClusterResolver(tpu='pit-tpu')
-        tf.config.experimental_connect_to_cluster(resolver)
-        tf.tpu.experimental.initialize_tpu_system(resolver)
-        strategy = tf.distribute.experimental.TPUStrategy(resolver)
-    else:
-        strategy = tf.distribute.MirroredStrategy()
-    # strategy = tf.distribute.OneDeviceStrategy(device="/gpu:0")
+    num_train = len(glob(os.path.join(tfrec_dir, 'train_3d/*')))
+    num_valid = len(glob(os.path.join(tfrec_dir, 'valid_3d/*')))
+    steps_per_epoch = num_train // batch_size
+    validation_steps = num_valid // batch_size
+    if curriculum is not None:
+        curriculum = CropCurriculum(curriculum, num_train, num_valid, strategy.num_replicas_in_sync, accum_steps)
     with strategy.scope():
         if custom_loss is None:
             loss_func = tversky_loss if multi_class else dice_loss
@@ -325,22 +707,49 @@ def main(epochs,
             raise NotImplementedError(f"Custom loss: {custom_loss} not implemented.")
 
         lr_manager = LearningRateUpdate(lr, lr_drop, lr_drop_freq, warmup=lr_warmup, min_lr=min_lr)
+        metrics = ConfusionMetric(num_classes)
 
         optimizer = tf.keras.optimizers.Adam(learning_rate=lr)
+        optimizer = get_loss_scale_optimizer(optimizer, precision)
         model = build_model(num_channels, num_classes, name, predict_slice=predict_slice, **model_kwargs)
 
+        background_validator = None
+        if background_validation:
+            model_config = dict(num_channels=num_channels, num_classes=num_classes, name=name,
+                                predict_slice=predict_slice, **model_kwargs)
+            background_validator = BackgroundValidator(build_model, model_config, tfrec_dir, multi_class,
+                                                       crop_size, depth_crop_size, predict_slice=predict_slice,
+                                                       val_batch_size=val_batch_size, buffer_size=buffer_size,
+                                                       num_volumes=background_validation_volumes,
+                                                       gpu=background_validation_gpu,
+                                                       inference_batch_size=inference_batch_size,
+                                                       gaussian=gaussian,
+                                                       tta=tta)
+
         trainer = Train(epochs, batch_size, enable_function,
                         model, optimizer, loss_func, lr_manager, predict_slice, metrics,
-                        tfrec_dir=tfrec_dir)
-
-        train_ds = strategy.experimental_distribute_dataset(train_ds)
-        valid_ds = strategy.experimental_distribute_dataset(valid_ds)
+                        tfrec_dir=tfrec_dir, log_dir=log_dir, accum_steps=accum_steps,
+                        steps_per_epoch=steps_per_epoch, validation_steps=validation_steps,
+                        steps_per_execution=steps_per_execution, profile=profile,
+                        profile_steps=profile_steps, profile_dir=profile_dir,
+                        keep_top_k=keep_top_k, keep_latest=keep_latest,
+                        checkpoint_steps=checkpoint_steps, resume=resume,
+                        background_validator=background_validator, curriculum=curriculum,
+                        jit_compile=jit_compile, best_model=best_model)
+
+        if curriculum is None:
+            train_ds, valid_ds = epoch_dataset_fn(True), epoch_dataset_fn(False)
+        else:
+            train_ds, valid_ds = phase_dataset_fn(True), phase_dataset_fn(False)
 
         if log_dir_now is None:
-            log_dir_now = trainer.train_model_loop(train_ds, valid_ds, strategy, multi_class, debug, num_to_visualise)
+            log_dir_now = trainer.train_model_loop(train_ds, valid_ds, strategy, multi_class,
+                                                   debug=debug, num_to_visualise=num_to_visualise)
 
     train_time = time() - t0
     print(f"Train Time: {train_time:.02f}")
+    if not is_chief():
+        return
     t1 = time()
     with strategy.scope():
         model = build_model(num_channels, num_classes, name, predict_slice=predict_slice, **model_kwargs)
@@ -357,7 +766,14 @@ def main(epochs,
                                                      crop_size,
                                                      depth_crop_size,
                                                      predict_slice,
-                                                     Metric(metrics))
+                                                     ConfusionMetric(num_classes),
+                                                     trace_volumes='0:1' if profile_steps else None,
+                                                     trace_dir=profile_dir or os.path.join(log_dir_now, 'trace'),
+                                                     inference_batch_size=inference_batch_size,
+                                                     gaussian=gaussian,
+                                                     jit_compile=jit_compile,
+                                                     in_graph=in_graph_validation,
+                                                     tta=tta)
         print(f"Train Time: {train_time:.02f}")
         print(f"Validation Time: {time() - t1:.02f}")              
         print(f"Total Time: {time() - t0:.02f}")
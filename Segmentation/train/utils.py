@@ -1,3 +1,4 @@
+import os
 import tensorflow as tf
 from glob import glob
 import math
@@ -18,6 +19,118 @@ def setup_gpu():
             print(e)
 
 
+def setup_mixed_precision(precision=None):
+    """ Sets the global Keras policy to mixed_float16 or mixed_bfloat16.
+    Variables keep float32 master copies under both policies, only the layer
+    computations and activations use the 16 bit dtype. """
+    if precision is None:
+        return
+    if precision not in ('float16', 'bfloat16'):
+        raise NotImplementedError(f"Precision: {precision} not implemented.")
+    if hasattr(tf.keras.mixed_precision, 'set_global_policy'):
+        tf.keras.mixed_precision.set_global_policy(f'mixed_{precision}')
+    else:
+        # TF < 2.4 only has the experimental API
+        policy = tf.keras.mixed_precision.experimental.Policy(f'mixed_{precision}')
+        tf.keras.mixed_precision.experimental.set_policy(policy)
+
+
+def get_loss_scale_optimizer(optimizer, precision=None):
+    """ Wraps optimizer with dynamic loss scaling for float16, bfloat16 has the
+    float32 exponent range and does not need it """
+    if precision != 'float16':
+        return optimizer
+    if hasattr(tf.keras.mixed_precision, 'LossScaleOptimizer'):
+        # dynamic loss scaling is the default
+        return tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+    return tf.keras.mixed_precision.experimental.LossScaleOptimizer(optimizer, 'dynamic')
+
+
+def setup_compile_cache(cache_dir=None):
+    """ Keeps compiled kernels in cache_dir, so later runs and sweep trials
+    on the machine do not compile them again. The CUDA driver caches the
+    kernels it JIT compiles from PTX there, and TensorFlow builds with a
+    persistent XLA cache (2.12 on, GPU only) keep their XLA executables too.
+    Has to be called before the first step runs. """
+    if cache_dir is None:
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault('CUDA_CACHE_PATH', os.path.join(cache_dir, 'cuda'))
+    # the largest cache the driver allows
+    os.environ.setdefault('CUDA_CACHE_MAXSIZE', str(2 ** 32))
+    version = tuple(int(v) for v in tf.__version__.split('.')[:2])
+    xla_flags = os.environ.get('TF_XLA_FLAGS', '')
+    # older versions abort on the unknown flag, and the XLA CPU backend can not serialise its executables
+    if version >= (2, 12) and tf.config.experimental.list_physical_devices('GPU') \
+            and 'tf_xla_persistent_cache_directory' not in xla_flags:
+        os.environ['TF_XLA_FLAGS'] = f"{xla_flags} --tf_xla_persistent_cache_directory={os.path.join(cache_dir, 'xla')}".strip()
+
+
+def get_worker_info():
+    """ (task_type, task_id, num_workers) of this process in the TF_CONFIG
+    cluster, (None, 0, 1) without one """
+    resolver = tf.distribute.cluster_resolver.TFConfigClusterResolver()
+    jobs = resolver.cluster_spec().as_dict()
+    num_workers = len(jobs.get('chief', [])) + len(jobs.get('worker', []))
+    return resolver.task_type, resolver.task_id or 0, max(num_workers, 1)
+
+
+def is_chief():
+    """ Whether this worker writes the summaries and checkpoints of the run """
+    task_type, task_id, _ = get_worker_info()
+    if task_type is None or task_type == 'chief':
+        return True
+    has_chief = 'chief' in tf.distribute.cluster_resolver.TFConfigClusterResolver().cluster_spec().jobs
+    return task_type == 'worker' and task_id == 0 and not has_chief
+
+
+def get_strategy(tpu=None, multi_worker=False):
+    """ TPUStrategy for the named TPU, MultiWorkerMirroredStrategy for the
+    TF_CONFIG cluster, otherwise MirroredStrategy over the local GPUs. Create
+    it before any other TensorFlow op, the collectives of the multi worker
+    strategy can not be set up once the runtime is running. """
+    if tpu:
+        resolver = tf.distribute.cluster_resolver.TPUClusterResolver(tpu=tpu)
+        tf.config.experimental_connect_to_cluster(resolver)
+        tf.tpu.experimental.initialize_tpu_system(resolver)
+        return tf.distribute.experimental.TPUStrategy(resolver)
+    if multi_worker:
+        return tf.distribute.experimental.MultiWorkerMirroredStrategy()
+    return tf.distribute.MirroredStrategy()
+
+
+def distribute_dataset(strategy, dataset_fn, batch_size):
+    """ dataset_fn(batch_size, num_shards, shard_index) builds the dataset.
+
+    On one worker the batch_size dataset is split across the local replicas as
+    before. With several workers every worker reads its own shard batched per
+    replica, so batch_size stays the global batch. """
+    if get_worker_info()[2] == 1:
+        return strategy.experimental_distribute_dataset(dataset_fn(batch_size, 1, 0))
+
+    def input_fn(input_context):
+        return dataset_fn(input_context.get_per_replica_batch_size(batch_size),
+                          input_context.num_input_pipelines,
+                          input_context.input_pipeline_id)
+    return strategy.experimental_distribute_datasets_from_function(input_fn)
+
+
+def check_num_steps(**num_steps):
+    """ Raises a ValueError for any step count that is missing or below 1,
+    e.g. steps_per_epoch=num_train // batch_size with fewer examples than a batch """
+    for name, steps in num_steps.items():
+        if steps is None or steps < 1:
+            raise ValueError(f"{name} has to be at least 1, got {steps}")
+
+
+def check_batch_size(batch_size, num_replicas=1, accum_steps=1):
+    """ Raises a ValueError unless batch_size splits evenly into the
+    accum_steps micro-batches of every replica """
+    if batch_size % (num_replicas * accum_steps):
+        raise ValueError(f"batch_size {batch_size} is not divisible by {num_replicas} replicas "
+                         f"x {accum_steps} accum_steps")
+
+
 class LearningRateUpdate:
     def __init__(self,
                  init_lr,
@@ -42,6 +155,48 @@ class LearningRateUpdate:
             return new_lr
 
 
+class CropCurriculum:
+    """ Crop and batch sizes that change with the epoch. phases are dicts of
+    the epoch the phase starts at and its crop_size, depth_crop_size and
+    batch_size, e.g. 32^3 crops in big batches growing to 160x288x288:
+
+        [{'epoch': 0, 'crop_size': 16, 'depth_crop_size': 16, 'batch_size': 16},
+         {'epoch': 10, 'crop_size': 64, 'depth_crop_size': 40, 'batch_size': 4},
+         {'epoch': 20, 'crop_size': 144, 'depth_crop_size': 80, 'batch_size': 2}]
+
+    The steps of an epoch follow the batch size of its phase. Every batch
+    size has to split into the accum_steps micro-batches of num_replicas
+    replicas and give at least one train and validation step.
+    """
+
+    def __init__(self,
+                 phases,
+                 num_train,
+                 num_valid,
+                 num_replicas=1,
+                 accum_steps=1,
+                 ):
+        self.phases = sorted((dict(phase) for phase in phases), key=lambda phase: phase['epoch'])
+        if not self.phases or self.phases[0]['epoch'] != 0:
+            raise ValueError("The first phase of a curriculum has to start at epoch 0")
+        for index, phase in enumerate(self.phases):
+            phase['index'] = index
+            phase['steps_per_epoch'] = num_train // phase['batch_size']
+            phase['validation_steps'] = num_valid // phase['batch_size']
+            try:
+                check_batch_size(phase['batch_size'], num_replicas, accum_steps)
+                check_num_steps(steps_per_epoch=phase['steps_per_epoch'], validation_steps=phase['validation_steps'])
+            except ValueError as e:
+                raise ValueError(f"The curriculum phase at epoch {phase['epoch']}: {e}") from None
+
+    def get_phase(self, epoch):
+        return [phase for phase in self.phases if phase['epoch'] <= epoch][-1]
+
+    def get_steps_before(self, epoch):
+        """ The train steps of all epochs before epoch """
+        return sum(self.get_phase(e)['steps_per_epoch'] for e in range(epoch))
+
+
 class Metric():
     def __init__(self, metrics):
         self.metrics = metrics
@@ -86,3 +241,114 @@ class Metric():
                     pos = -2 if training else -1
                     with self.metrics[metric_loss][metric][pos].as_default():
                         tf.summary.scalar('metrics', self.metrics[metric_loss][metric][pos - 2].result(), step=e)
+
+
+class ConfusionStatistics(tf.keras.metrics.Metric):
+    """ Accumulates per-class TP/FP/FN/TN sums on the device with one pass over
+    each batch. The sums are soft (over probabilities) so dice and IoU match
+    dsc and iou_loss, hard=True takes the argmax (or rounds a single channel)
+    first. """
+
+    def __init__(self, num_classes, hard=False, name='confusion_statistics', **kwargs):
+        super(ConfusionStatistics, self).__init__(name=name, **kwargs)
+        self.num_classes = num_classes
+        self.hard = hard
+        self.tp = self.add_weight('tp', shape=(num_classes,), initializer='zeros')
+        self.fp = self.add_weight('fp', shape=(num_classes,), initializer='zeros')
+        self.fn = self.add_weight('fn', shape=(num_classes,), initializer='zeros')
+        self.tn = self.add_weight('tn', shape=(num_classes,), initializer='zeros')
+
+    def update_state(self, y_true, y_pred, sample_weight=None):
+        y_true = tf.reshape(tf.cast(y_true, tf.float32), [-1, self.num_classes])
+        y_pred = tf.reshape(tf.cast(y_pred, tf.float32), [-1, self.num_classes])
+        if self.hard:
+            if self.num_classes == 1:
+                y_pred = tf.round(tf.clip_by_value(y_pred, 0, 1))
+            else:
+                y_pred = tf.one_hot(tf.argmax(y_pred, axis=-1), self.num_classes)
+
+        tp = tf.reduce_sum(y_true * y_pred, axis=0)
+        true_sum = tf.reduce_sum(y_true, axis=0)
+        pred_sum = tf.reduce_sum(y_pred, axis=0)
+        num_voxels = tf.cast(tf.shape(y_true)[0], tf.float32)
+
+        self.tp.assign_add(tp)
+        self.fp.assign_add(pred_sum - tp)
+        self.fn.assign_add(true_sum - tp)
+        self.tn.assign_add(num_voxels - true_sum - pred_sum + tp)
+
+    def get_scores(self):
+        """ Dice, IoU, precision and recall of every class, of all classes
+        together and of the foreground classes 1: together """
+        stats = {'': [self.tp, self.fp, self.fn]}
+        stats['all'] = [tf.reduce_sum(s) for s in stats['']]
+        if self.num_classes > 1:
+            stats[f'{self.num_classes - 1}ch'] = [tf.reduce_sum(s[1:]) for s in stats['']]
+
+        scores = {}
+        for suffix, (tp, fp, fn) in stats.items():
+            scores[suffix] = {
+                'dice': tf.math.divide_no_nan(2 * tp, 2 * tp + fp + fn),
+                'mIoU': tf.math.divide_no_nan(tp, tp + fp + fn),
+                'precision': tf.math.divide_no_nan(tp, tp + fp),
+                'recall': tf.math.divide_no_nan(tp, tp + fn),
+            }
+        return scores
+
+    def result(self):
+        return self.get_scores()['all']['dice']
+
+    def reset_states(self):
+        for v in self.variables:
+            v.assign(tf.zeros_like(v))
+
+
+class ConfusionMetric():
+    """ Drop-in for Metric backed by one ConfusionStatistics each for training
+    and validation, the scores are only derived at the end of the epoch """
+
+    def __init__(self, num_classes, hard=False):
+        self.num_classes = num_classes
+        self.stats = [ConfusionStatistics(num_classes, hard=hard, name='confusion_statistics'),
+                      ConfusionStatistics(num_classes, hard=hard, name='val_confusion_statistics')]
+        self.writers = [None, None]
+
+    def store_metric(self, y, predictions, training=False):
+        training = 0 if training else 1
+        self.stats[training].update_state(y, predictions)
+
+    def get_scalars(self, training):
+        """ Flat {name: value} of the scores, per class ones end in _c{class} """
+        scores = self.stats[0 if training else 1].get_scores()
+        scalars = {}
+        for suffix, class_scores in scores.items():
+            for metric, value in class_scores.items():
+                if suffix == '':
+                    for c, class_value in enumerate(value.numpy()):
+                        scalars[f'{metric}_c{c}'] = class_value
+                elif suffix == 'all':
+                    scalars[metric] = value.numpy()
+                else:
+                    scalars[f'{metric}-{suffix}'] = value.numpy()
+        return scalars
+
+    def reset_metrics_get_str(self):
+        metric_str = ""
+        for training in range(2):
+            val = "" if training else "val_"
+            scalars = self.get_scalars(training)
+            for metric in scalars:
+                if '_c' not in metric:
+                    metric_str += f" - {val}{metric}: {scalars[metric]:.06f}"
+            self.stats[0 if training else 1].reset_states()
+        return metric_str
+
+    def add_metric_summary_writer(self, log_dir_now):
+        self.writers = [tf.summary.create_file_writer(log_dir_now + '/metrics'),
+                        tf.summary.create_file_writer(log_dir_now + '/val_metrics')]
+
+    def record_metric_to_summary(self, e):
+        for training in range(2):
+            with self.writers[0 if training else 1].as_default():
+                for metric, value in self.get_scalars(training).items():
+                    tf.summary.scalar(metric, value, step=e)
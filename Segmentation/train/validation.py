@@ -1,15 +1,16 @@
 import tensorflow as tf
 import numpy as np
 from Segmentation.utils.data_loader import read_tfrecord_3d
-from Segmentation.utils.augmentation import crop_3d, crop_3d_pad_slice
+from Segmentation.utils.augmentation import crop_3d
 from Segmentation.utils.losses import dice_loss
 from Segmentation.train.reshape import get_mid_vol, get_mid_slice, plot_through_slices
+from Segmentation.train.profiler import TraceWindow
 import os
+from glob import glob
 from time import time
 import datetime
 import itertools
 import math
-import copy
 import imageio
 
 def get_validation_stride_coords(pad, full_shape, iterator, strides_required):
@@ -90,75 +91,281 @@ def get_slice_paddings(crop_size, depth_crop_size, full_shape=(160,288,288), sli
     return paddings, coords
 
 
-def validate_best_model(model, log_dir_now, val_batch_size, buffer_size, tfrec_dir, multi_class,
-                        crop_size, depth_crop_size, predict_slice, metrics):
-    valid_ds = read_tfrecord_3d(tfrecords_dir=os.path.join(tfrec_dir, 'valid_3d/'), batch_size=val_batch_size, buffer_size=buffer_size, 
+def get_whole_val_dataset(tfrec_dir, val_batch_size, buffer_size, multi_class, num_volumes=None):
+    """ One pass over the validation volumes, or over the first num_volumes """
+    valid_ds = read_tfrecord_3d(tfrecords_dir=os.path.join(tfrec_dir, 'valid_3d/'), batch_size=val_batch_size, buffer_size=buffer_size,
                                 is_training=False, use_keras_fit=False, multi_class=multi_class)
+    # the dataset repeats, so take one pass over the validation volumes
+    num_volumes = num_volumes or len(glob(os.path.join(tfrec_dir, 'valid_3d/*')))
+    return valid_ds.take(num_volumes // val_batch_size)
 
-    now = datetime.datetime.now().strftime("/%Y%m%d/%H%M%S")
 
+def get_whole_val_paddings(crop_size, depth_crop_size, predict_slice, full_shape=(160, 288, 288)):
     if predict_slice:
-        vad_padding, val_coord = get_slice_paddings(crop_size, depth_crop_size)
-    else:
-        vad_padding, val_coord = get_paddings(crop_size, depth_crop_size)
+        return get_slice_paddings(crop_size, depth_crop_size, full_shape)
+    return get_paddings(crop_size, depth_crop_size, full_shape)
+
+
+def crop_whole_volume(x, y):
+    """ Centre 160x288x288 of the volumes, or all of a smaller dimension """
+    centre = [int(y.shape[1]/2), int(y.shape[2]/2), int(y.shape[3]/2)]
+    crop_size = min(144, centre[1], centre[2])
+    depth_crop_size = min(80, centre[0])
+    x_crop = tf.cast(crop_3d(x, crop_size, depth_crop_size, centre, False), tf.float32)
+    y_crop = tf.cast(crop_3d(y, crop_size, depth_crop_size, centre, False), tf.float32)
+    return x_crop, y_crop
+
+
+# test time augmentations of (batch, depth, height, width, channels) tensors, each with its inverse
+TTA_TRANSFORMS = {
+    'flip_depth': (lambda x: tf.reverse(x, [1]), lambda x: tf.reverse(x, [1])),
+    'flip_height': (lambda x: tf.reverse(x, [2]), lambda x: tf.reverse(x, [2])),
+    'flip_width': (lambda x: tf.reverse(x, [3]), lambda x: tf.reverse(x, [3])),
+    # a quarter turn in the height-width plane, the crops are square
+    'rot90': (lambda x: tf.reverse(tf.transpose(x, [0, 1, 3, 2, 4]), [2]),
+              lambda x: tf.transpose(tf.reverse(x, [2]), [0, 1, 3, 2, 4])),
+}
+
+
+def predict_tta(model, x, tta):
+    """ Mean of the model's predictions of x and of each transform in tta
+    (names of TTA_TRANSFORMS), all in a single forward pass with the
+    transforms of the predictions inverted before the mean """
+    transforms = [TTA_TRANSFORMS[name] for name in tta]
+    batch = tf.concat([x] + [forward(x) for forward, _ in transforms], 0)
+    preds = tf.split(model(batch, training=False), len(transforms) + 1)
+    preds = [preds[0]] + [inverse(pred) for (_, inverse), pred in zip(transforms, preds[1:])]
+    return tf.add_n(preds) / len(preds)
+
+
+def get_predict_fn(model, jit_compile=False, tta=()):
+    """ The model's inference call traced once, and compiled with XLA if
+    jit_compile. tta averages it over those test time augmentations, see
+    predict_tta, which multiplies the batch of every call by len(tta) + 1 """
+    if tta:
+        return tf.function(lambda x: predict_tta(model, x, tta), experimental_compile=jit_compile)
+    return tf.function(lambda x: model(x, training=False), experimental_compile=jit_compile)
+
+
+def get_gaussian_weights(shape, sigma_scale=0.125):
+    """ Importance of each voxel of a (depth, height, width) prediction, a
+    gaussian about its centre with a sigma of sigma_scale times each side,
+    so where the windows overlap the voxels near the centre of a window
+    count for more than those at its edges """
+    weights = np.ones(shape, np.float32)
+    for axis, size in enumerate(shape):
+        if size == 1:
+            continue
+        coord = np.arange(size) - (size - 1) / 2
+        gaussian = np.exp(-0.5 * (coord / (size * sigma_scale)) ** 2)
+        weights *= gaussian.reshape([-1 if i == axis else 1 for i in range(len(shape))]).astype(np.float32)
+    return weights / weights.max()
+
+
+def get_slabs(x, depth_crop_size, mode='edge'):
+    """ Views of the 2 * depth_crop_size + 1 slices about every depth of the
+    (batch, depth, height, width, channels) volume x, so slabs[:, d] is the
+    model input of slice d. The volume is padded once by depth_crop_size at
+    either end with mode ('edge' or 'reflect', as np.pad) and the slabs
+    overlap in its memory, none of them is a copy """
+    dc = depth_crop_size
+    x = np.pad(x, [[0, 0], [dc, dc], [0, 0], [0, 0], [0, 0]], mode)
+    batch, depth, height, width, channels = x.shape
+    batch_stride, depth_stride, height_stride, width_stride, channel_stride = x.strides
+    return np.lib.stride_tricks.as_strided(x, (batch, depth - 2 * dc, 2 * dc + 1, height, width, channels),
+                                           (batch_stride, depth_stride, depth_stride, height_stride,
+                                            width_stride, channel_stride), writeable=False)
+
+
+def get_window(volume, centre, crop_size, depth_crop_size, predict_slice):
+    """ The model input of a sliding window and the (depth, height, width)
+    offset of its prediction in the volume. volume is the get_slabs of the
+    volume for predict_slice """
+    d, h, w = centre
+    if predict_slice:
+        slab = volume[:, d, :, h - crop_size:h + crop_size, w - crop_size:w + crop_size]
+        return slab, (d, h - crop_size, w - crop_size)
+    x_model_crop = crop_3d(volume, crop_size, depth_crop_size, centre, False)
+    return x_model_crop, (d - depth_crop_size, h - crop_size, w - crop_size)
+
+
+def predict_whole_volume(model, x_crop, output_shape, val_coord, crop_size, depth_crop_size, predict_slice,
+                         batch_size=4, gaussian=False, predict_fn=None, slice_padding='edge'):
+    """ Mean of the model predictions over the sliding windows centred on
+    val_coord, output_shape is the shape of the labels of x_crop.
+
+    The windows go through predict_fn (get_predict_fn of the model if None)
+    batch_size at a time, the last batch padded so every call has the same
+    shape, and each prediction is added into the accumulators in place.
+    gaussian=True weights the mean by get_gaussian_weights instead of
+    counting every window's voxels the same. predict_slice models take
+    their slabs from get_slabs, with the ends padded by slice_padding.
+    """
+    predict_fn = predict_fn or get_predict_fn(model)
+    output_shape = [int(s) for s in output_shape]
+    mean_pred = np.zeros(output_shape, np.float32)
+    counter = np.zeros(output_shape[:4] + [1], np.float32)
+    num_volumes = output_shape[0]
+    batch_size = min(batch_size, len(val_coord))
+    volume = get_slabs(x_crop.numpy(), depth_crop_size, slice_padding) if predict_slice else x_crop
+    weights = None
+
+    for start in range(0, len(val_coord), batch_size):
+        windows = [get_window(volume, centre, crop_size, depth_crop_size, predict_slice)
+                   for centre in val_coord[start:start + batch_size]]
+        x_model_crops, offsets = zip(*windows)
+        x_batch = np.concatenate(x_model_crops)
+        del x_model_crops, windows
+        num_windows = len(offsets)
+        if num_windows < batch_size:
+            filler = np.zeros(((batch_size - num_windows) * num_volumes,) + x_batch.shape[1:], x_batch.dtype)
+            x_batch = np.concatenate([x_batch, filler])
+
+        pred = predict_fn(x_batch).numpy()[:num_windows * num_volumes]
+        del x_batch
+        pred = pred.reshape((num_windows, num_volumes) + pred.shape[1:])
+        if weights is None:
+            weights = get_gaussian_weights(pred.shape[2:5]) if gaussian else np.ones(pred.shape[2:5], np.float32)
+            weights = weights[..., np.newaxis]
+
+        pred_depth, pred_height, pred_width = pred.shape[2:5]
+        for window_pred, (depth, height, width) in zip(pred, offsets):
+            region = (slice(None), slice(depth, depth + pred_depth), slice(height, height + pred_height),
+                      slice(width, width + pred_width))
+            mean_pred[region] += window_pred * weights
+            counter[region] += weights
+        del pred
+
+    return np.divide(mean_pred, counter, dtype=np.float32)
+
+
+def get_window_starts(size, window, stride):
+    """ Starts of the windows along a side, stride apart with the last one
+    flush with the end so the windows cover the whole side """
+    if window > size:
+        raise ValueError(f"A window of {window} does not fit in a side of {size}")
+    return list(range(0, size - window, stride)) + [size - window]
+
+
+def sliding_window_predict(predict_fn, x, window, strides=None, batch_size=4, weights=None):
+    """ The stitched predictions of predict_fn over the windows of the
+    (batch, depth, height, width, channels) volume x, in graph ops only.
+
+    window is the (depth, height, width) of the model input and output,
+    strides the steps between the windows, half the window if None. The
+    window starts are found at trace time from the static shape of x. A
+    tf.while_loop takes batch_size windows at a time through predict_fn and
+    scatter-adds their predictions into the running total, weighted by
+    weights (e.g. get_gaussian_weights(window)) if given, and their weights
+    into the running counter, so only a batch of windows is held besides
+    the volume. Call it inside a tf.function, e.g. the one
+    get_sliding_window_fn returns, which can also go through strategy.run.
+    """
+    volume_shape = x.shape[1:4].as_list()
+    strides = strides or [side // 2 for side in window]
+    starts = list(itertools.product(*[get_window_starts(size, side, stride)
+                                      for size, side, stride in zip(volume_shape, window, strides)]))
+    num_windows, num_volumes = len(starts), tf.shape(x)[0]
+    batch_size = min(batch_size, num_windows)
+    num_batches = -(-num_windows // batch_size)
+    num_padding = num_batches * batch_size - num_windows
+
+    # the last batch is filled with copies of the last window that weigh nothing,
+    # so every call of predict_fn has the same shape
+    batch_starts = tf.reshape(tf.constant(starts + starts[-1:] * num_padding, tf.int32),
+                              [num_batches, batch_size, 3])
+    batch_valid = tf.reshape(tf.constant([1.0] * num_windows + [0.0] * num_padding), [num_batches, batch_size])
+    grid = tf.stack(tf.meshgrid(*[tf.range(side) for side in window], indexing='ij'), -1)
+    if weights is None:
+        weights = tf.ones(window)
+    weights = tf.broadcast_to(tf.cast(weights, tf.float32), window)
+
+    def predict_batch(i):
+        """ The voxel indices, predictions and weights of the windows of batch i """
+        windows = [tf.slice(x, tf.concat([[0], start, [0]], 0), [-1] + list(window) + [-1])
+                   for start in tf.unstack(batch_starts[i])]
+        preds = predict_fn(tf.concat(windows, 0))
+        preds = tf.reshape(preds, tf.concat([[batch_size, num_volumes], tf.shape(preds)[1:]], 0))
+        # (window, depth, height, width, volume, class), so a voxel's index is its first 3 coordinates
+        preds = tf.transpose(preds, [0, 2, 3, 4, 1, 5])
+        indices = batch_starts[i][:, tf.newaxis, tf.newaxis, tf.newaxis, :] + grid[tf.newaxis]
+        window_weights = batch_valid[i][:, tf.newaxis, tf.newaxis, tf.newaxis] * weights[tf.newaxis]
+        return indices, preds, tf.cast(window_weights[..., tf.newaxis], preds.dtype)
+
+    def accumulate(i, total, counter):
+        indices, preds, window_weights = predict_batch(i)
+        total = tf.tensor_scatter_nd_add(total, indices, preds * window_weights[..., tf.newaxis])
+        counter = tf.tensor_scatter_nd_add(counter, indices, window_weights)
+        return i + 1, total, counter
+
+    # the first batch gives the number of classes and the dtype of the accumulators
+    indices, preds, window_weights = predict_batch(0)
+    total = tf.tensor_scatter_nd_add(tf.zeros(volume_shape + [num_volumes, preds.shape[-1]], preds.dtype),
+                                     indices, preds * window_weights[..., tf.newaxis])
+    counter = tf.tensor_scatter_nd_add(tf.zeros(volume_shape + [1], preds.dtype), indices, window_weights)
+    _, total, counter = tf.while_loop(lambda i, total, counter: i < num_batches, accumulate,
+                                      (tf.constant(1), total, counter), parallel_iterations=1)
+    return tf.transpose(total / counter[..., tf.newaxis], [3, 0, 1, 2, 4])
+
+
+def get_sliding_window_fn(model, window, strides=None, batch_size=4, gaussian=False, jit_compile=False, tta=()):
+    """ sliding_window_predict of the model as one tf.function of the volume.
+    jit_compile and tta are those of get_predict_fn """
+    predict_fn = get_predict_fn(model, jit_compile, tta)
+    weights = get_gaussian_weights(window) if gaussian else None
+
+    @tf.function
+    def sliding_window_fn(x):
+        return sliding_window_predict(predict_fn, x, window, strides, batch_size, weights)
+    return sliding_window_fn
+
+
+def predict_distributed(strategy, sliding_window_fn, x):
+    """ Whole-volume predictions of the distributed batch x (an element of a
+    distributed dataset), each replica stitching its own volumes. Returns the
+    predictions of the local replicas concatenated in order """
+    preds = strategy.run(sliding_window_fn, args=(x,))
+    return tf.concat(strategy.experimental_local_results(preds), 0)
+
+
+def validate_best_model(model, log_dir_now, val_batch_size, buffer_size, tfrec_dir, multi_class,
+                        crop_size, depth_crop_size, predict_slice, metrics, trace_volumes=None, trace_dir=None,
+                        inference_batch_size=4, gaussian=False, jit_compile=False, in_graph=False,
+                        slice_padding='edge', tta=()):
+    """ trace_volumes="start:stop" captures a tf.profiler trace of the sliding
+    window inference of those validation batches into trace_dir.
+    inference_batch_size windows go through the model at once, see
+    predict_whole_volume for gaussian. in_graph=True stitches the windows
+    with get_sliding_window_fn instead, half a window apart. slice_padding
+    is the padding of the volume ends for predict_slice, see get_slabs.
+    tta averages every window over those test time augmentations, see
+    predict_tta """
+    if in_graph and predict_slice:
+        raise ValueError("The in graph sliding window needs a model that predicts the whole window")
+    valid_ds = get_whole_val_dataset(tfrec_dir, val_batch_size, buffer_size, multi_class)
+    predict_fn = get_predict_fn(model, jit_compile, tta)
+    if in_graph:
+        window = (depth_crop_size * 2, crop_size * 2, crop_size * 2)
+        sliding_window_fn = get_sliding_window_fn(model, window, None, inference_batch_size, gaussian,
+                                                  jit_compile, tta)
+    trace = TraceWindow(trace_volumes, trace_dir)
+
+    now = datetime.datetime.now().strftime("/%Y%m%d/%H%M%S")
+
     total_loss, total_count = 0.0, 0.0
     for idx,ds in enumerate(valid_ds):
+        trace.update(idx)
         t0 = time()
         x, y = ds
 
-        centre = [int(y.shape[1]/2), int(y.shape[2]/2), int(y.shape[3]/2)]
-        x_crop = tf.cast(crop_3d(x, 144, 80, centre, False), tf.float32)
-        y_crop = tf.cast(crop_3d(y, 144, 80, centre, False), tf.float32)
-
-        mean_pred = np.zeros(tf.shape(y_crop))
-        counter = np.zeros(tf.shape(y_crop))
-
-        for pad, iter_centre in zip(vad_padding, val_coord):
-            pad_copy = copy.deepcopy(pad)
-            iter_centre_c = copy.deepcopy(iter_centre)
-            if predict_slice:
-                x_ = x_crop.numpy()
-                if pad_copy[1][0] < 0:
-                    ## need to pad before
-                    pad_by = pad_copy[1][0] * -1
-                    iter_centre_c[0] += pad_by
-                    x_[:, pad_by:, :, :, :] = x_[:, :-pad_by, :, :, :]
-                    for i in range(pad_by):
-                        x_[:, i, :, :, :] = x_[:, iter_centre_c[0], :, :, :]
-                    pad_copy[1][0] = 0
-                    pad_copy[1][1] = pad_copy[1][1] - pad_by
-                elif pad_copy[1][1] < 0:
-                    ## pad after
-                    pad_by = pad_copy[1][1] * -1
-                    iter_centre_c[0] -= pad_by
-                    x_[:, :pad_by, :, :, :] = x_[:, -pad_by:, :, :, :]
-                    for i in range(pad_by):
-                        x_[:, -i, :, :, :] = x_[:, iter_centre_c[0], :, :, :]
-                    pad_copy[1][1] = 0
-                    pad_copy[1][0] = pad_copy[1][0] - pad_by
-                pad_copy[1][0] += depth_crop_size
-                pad_copy[1][1] += depth_crop_size
-                x_model_crop = crop_3d_pad_slice(x_, crop_size, depth_crop_size, iter_centre_c)
-                del x_
-            else:
-                x_model_crop = crop_3d(x_crop, crop_size, depth_crop_size, iter_centre_c, False)
-                y_model_crop = crop_3d(y_crop, crop_size, depth_crop_size, iter_centre_c, False)
-
-            pred = model.predict(x_model_crop)
-
-            del x_model_crop
-            output_shape = pred.shape
-            pred = np.pad(pred, pad_copy, "constant")
-
-            mean_pred += pred
-            del pred
-            count = np.ones(output_shape)
-            count = np.pad(count, pad_copy, "constant")
-            counter += count
-            del count
-
-        mean_pred = np.divide(mean_pred, counter, dtype=np.float32)
-        del counter
+        x_crop, y_crop = crop_whole_volume(x, y)
+        if in_graph:
+            mean_pred = sliding_window_fn(x_crop).numpy()
+        else:
+            _, val_coord = get_whole_val_paddings(crop_size, depth_crop_size, predict_slice, tuple(y_crop.shape[1:4]))
+            mean_pred = predict_whole_volume(model, x_crop, tf.shape(y_crop), val_coord,
+                                             crop_size, depth_crop_size, predict_slice,
+                                             inference_batch_size, gaussian, predict_fn, slice_padding)
 
         loss = dice_loss(y_crop, mean_pred)        
         metrics.store_metric(y_crop, mean_pred)
@@ -184,6 +391,7 @@ def validate_best_model(model, log_dir_now, val_batch_size, buffer_size, tfrec_d
             with vol_writer.as_default():
                 tf.summary.image("Whole Validation - Vol", img, step=idx)
 
+    trace.close()
     metric_str = metrics.reset_metrics_get_str()
     total_loss /= total_count
     print("Dice Validation Loss:", total_loss)
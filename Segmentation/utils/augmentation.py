@@ -1,30 +1,42 @@
 import tensorflow as tf
 # import tensorflow_addons as tfa
-import random
-import sys
 
-def crop_randomly_image_pair_2d(image_tensor, label_tensor):
 
-    random_seed = random.randrange(sys.maxsize)
-    random_var = tf.random.uniform(maxval=2, dtype=tf.int32, shape=[])
+def get_augmentation_seed(seed, epoch, index):
+    """ Stateless RNG key of one sample. Every augmentation is a pure function
+    of this key, so any augmented sample can be regenerated from
+    (seed, epoch, index) alone. """
+    seed = tf.cast(seed, tf.int64)
+    counter = tf.cast(epoch, tf.int64) * (2 ** 32) + tf.cast(index, tf.int64)
+    return tf.stack([seed, counter])
+
+
+def fold_in_seed(seed, salt):
+    """ Derives an independent key from seed, so that different random draws
+    made from the same sample key are uncorrelated """
+    key = tf.random.stateless_uniform([2], seed=seed, minval=0, maxval=2 ** 62, dtype=tf.int64)
+    return key + tf.constant([0, salt], dtype=tf.int64)
+
+
+def crop_randomly_image_pair_2d(image_tensor, label_tensor, seed):
+
+    random_var = tf.random.stateless_uniform([], seed=fold_in_seed(seed, 0), maxval=2, dtype=tf.int32)
+    max_offset = tf.shape(image_tensor)[:2] - 288 + 1
+    offset = tf.random.stateless_uniform([2], seed=fold_in_seed(seed, 1), maxval=tf.int32.max, dtype=tf.int32) % max_offset
 
     randomly_cropped_img = tf.cond(pred=tf.equal(random_var, 0),
-                                   true_fn=lambda: tf.image.random_crop(image_tensor,
-                                                                        size=[288, 288, 1],
-                                                                        seed=random_seed),
+                                   true_fn=lambda: tf.slice(image_tensor, [offset[0], offset[1], 0], [288, 288, 1]),
                                    false_fn=lambda: tf.image.resize_with_crop_or_pad(image_tensor, 288, 288))
 
     randomly_cropped_label = tf.cond(pred=tf.equal(random_var, 0),
-                                     true_fn=lambda: tf.image.random_crop(label_tensor,
-                                                                          size=[288, 288, 7],
-                                                                          seed=random_seed),
+                                     true_fn=lambda: tf.slice(label_tensor, [offset[0], offset[1], 0], [288, 288, 7]),
                                      false_fn=lambda: tf.image.resize_with_crop_or_pad(label_tensor, 288, 288))
 
     return randomly_cropped_img, randomly_cropped_label
 
-def flip_randomly_left_right_image_pair_2d(image_tensor, label_tensor):
+def flip_randomly_left_right_image_pair_2d(image_tensor, label_tensor, seed):
 
-    random_var = tf.random.uniform(maxval=2, dtype=tf.int32, shape=[])
+    random_var = tf.random.stateless_uniform([], seed=fold_in_seed(seed, 2), maxval=2, dtype=tf.int32)
 
     randomly_flipped_img = tf.cond(pred=tf.equal(random_var, 0),
                                    true_fn=lambda: tf.image.flip_left_right(image_tensor),
@@ -37,10 +49,10 @@ def flip_randomly_left_right_image_pair_2d(image_tensor, label_tensor):
     return randomly_flipped_img, randomly_flipped_label
 
 
-def adjust_brightness_randomly_image_pair_2d(image_tensor, label_tensor):
+def adjust_brightness_randomly_image_pair_2d(image_tensor, label_tensor, seed):
 
-    random_var = tf.random.uniform(maxval=2, dtype=tf.int32, shape=[])
-    random_delta = tf.random.uniform(maxval=1, dtype=tf.float32, shape=[])
+    random_var = tf.random.stateless_uniform([], seed=fold_in_seed(seed, 3), maxval=2, dtype=tf.int32)
+    random_delta = tf.random.stateless_uniform([], seed=fold_in_seed(seed, 4), maxval=1, dtype=tf.float32)
 
     randomly_brightened_img = tf.cond(pred=tf.equal(random_var, 0),
                                       true_fn=lambda: tf.image.adjust_brightness(image_tensor, delta=random_delta),
@@ -52,10 +64,10 @@ def adjust_brightness_randomly_image_pair_2d(image_tensor, label_tensor):
 
     return randomly_brightened_img, randomly_brightened_label
 
-def adjust_contrast_randomly_image_pair_2d(image_tensor, label_tensor):
+def adjust_contrast_randomly_image_pair_2d(image_tensor, label_tensor, seed):
 
-    random_var = tf.random.uniform(maxval=2, dtype=tf.int32, shape=[])
-    random_contrast_factor = tf.random.uniform(maxval=1, dtype=tf.float32, shape=[])
+    random_var = tf.random.stateless_uniform([], seed=fold_in_seed(seed, 5), maxval=2, dtype=tf.int32)
+    random_contrast_factor = tf.random.stateless_uniform([], seed=fold_in_seed(seed, 6), maxval=1, dtype=tf.float32)
 
     random_crop_img = tf.cond(pred=tf.equal(random_var, 0),
                               true_fn=lambda: tf.image.adjust_contrast(image_tensor, random_contrast_factor),
@@ -67,151 +79,10 @@ def adjust_contrast_randomly_image_pair_2d(image_tensor, label_tensor):
 
     return random_crop_img, random_crop_label
 
-def get_random_batch_centre(image_tensor, crop_size, depth_crop_size, pad=20):
-    batch_size = tf.shape(image_tensor)[0]
-    centre = (tf.cast(tf.math.divide(tf.shape(image_tensor)[1], 2), tf.int32), 
-              tf.cast(tf.math.divide(tf.shape(image_tensor)[2], 2), tf.int32),
-              tf.cast(tf.math.divide(tf.shape(image_tensor)[3], 2), tf.int32),
-              )
-    drc = tf.random.normal([batch_size], mean=tf.cast(centre[0], tf.float32), stddev=tf.cast(centre[0] / 4, tf.float32))
-    hrc = tf.random.normal([batch_size], mean=tf.cast(centre[1], tf.float32), stddev=tf.cast(centre[1] / 4, tf.float32))
-    wrc = tf.random.normal([batch_size], mean=tf.cast(centre[2], tf.float32), stddev=tf.cast(centre[2] / 4, tf.float32))
-    drc = tf.clip_by_value(drc, tf.cast(depth_crop_size + pad, tf.float32), tf.cast(tf.shape(image_tensor)[1] - depth_crop_size - pad, tf.float32))
-    hrc = tf.clip_by_value(hrc, tf.cast(crop_size + pad, tf.float32), tf.cast(tf.shape(image_tensor)[2] - crop_size - pad, tf.float32))
-    wrc = tf.clip_by_value(wrc, tf.cast(crop_size + pad, tf.float32), tf.cast(tf.shape(image_tensor)[3] - crop_size - pad, tf.float32))
-    drc = tf.cast(tf.math.round(drc), tf.int32)
-    hrc = tf.cast(tf.math.round(hrc), tf.int32)
-    wrc = tf.cast(tf.math.round(wrc), tf.int32)
-    centre = (drc, hrc, wrc)
-    return centre
-
-def apply_valid_random_crop_3d(image_tensor,
-                               label_tensor,
-                               crop_size,
-                               depth_crop_size,
-                               resize,
-                               random_shift,
-                               output_slice,
-                               factor=0.04):
-
-    def crop_per_batch(x, y, centre, crop_size, depth_crop_size, resize, output_slice):
-        if resize:
-            original_height = tf.cast(tf.shape(x)[1], tf.float32)
-            original_width = tf.cast(tf.shape(x)[2], tf.float32)
-            new_height = tf.cast(original_height + tf.random.uniform([], minval=-original_height * factor, maxval=original_height * factor), tf.int32)
-            new_width = tf.cast(original_width + tf.random.uniform([], minval=-original_width * factor, maxval=original_width * factor), tf.int32)
-            x = tf.image.resize(x, [new_height, new_width])
-            y = tf.image.resize(y, [new_height, new_width])
-            y = tf.math.round(y)
-        dc, hc, wc = centre
-        if output_slice:
-            x = tf.slice(x, [dc - depth_crop_size, hc - crop_size, wc - crop_size, 0], [1 + (depth_crop_size * 2), crop_size * 2, crop_size * 2, -1])
-            y = tf.slice(y, [dc, hc - crop_size, wc - crop_size, 0], [1, crop_size * 2, crop_size * 2, -1])
-        else:
-            x = tf.slice(x, [dc - depth_crop_size, hc - crop_size, wc - crop_size, 0], [depth_crop_size * 2, crop_size * 2, crop_size * 2, -1])
-            y = tf.slice(y, [dc - depth_crop_size, hc - crop_size, wc - crop_size, 0], [depth_crop_size * 2, crop_size * 2, crop_size * 2, -1])
-        return x, y, centre
-
-    if random_shift:
-        centre = get_random_batch_centre(image_tensor, crop_size, depth_crop_size)
-        image_tensor, label_tensor, centre = tf.map_fn(lambda x: crop_per_batch(x[0], x[1], x[2], crop_size, depth_crop_size, resize, output_slice), (image_tensor, label_tensor, centre))
-    else:
-        image_tensor, label_tensor = apply_centre_crop_3d(image_tensor, label_tensor, crop_size, depth_crop_size, output_slice)
-    return image_tensor, label_tensor
-
-def apply_centre_crop_3d(image_tensor, label_tensor, crop_size, depth_crop_size, output_slice):
-    centre = (tf.cast(tf.math.divide(tf.shape(image_tensor)[1], 2), tf.int32),
-              tf.cast(tf.math.divide(tf.shape(image_tensor)[2], 2), tf.int32),
-              tf.cast(tf.math.divide(tf.shape(image_tensor)[3], 2), tf.int32),
-              )
-    image_tensor = crop_3d(image_tensor, crop_size, depth_crop_size, centre, output_slice, False)
-    label_tensor = crop_3d(label_tensor, crop_size, depth_crop_size, centre, output_slice, True)
-    return image_tensor, label_tensor
+def rotate_randomly_image_pair_2d(image_tensor, label_tensor, min_angle, max_angle, seed):
 
-def crop_3d(img, crop_size, depth_crop_size, centre, output_slice, target=None):
-    dc, hc, wc = centre
-    if output_slice:
-        if target:
-            img = tf.slice(img, [0, dc, hc - crop_size, wc - crop_size, 0], [-1, 1, crop_size * 2, crop_size * 2, -1])
-        else:
-            img = tf.slice(img, [0, dc - depth_crop_size, hc - crop_size, wc - crop_size, 0], [-1, 1 + (depth_crop_size * 2), crop_size * 2, crop_size * 2, -1])
-    else:
-        img = tf.slice(img, [0, dc - depth_crop_size, hc - crop_size, wc - crop_size, 0], [-1, depth_crop_size * 2, crop_size * 2, crop_size * 2, -1])
-    return img
-
-def crop_3d_pad_slice(img, crop_size, depth_crop_size, centre):
-    """ Gets slice with same padding, used for 3D to 3D slice with x """
-    dc, hc, wc = centre
-
-    img = tf.slice(img, [0, dc - depth_crop_size, hc - crop_size, wc - crop_size, 0], [-1, 1 + (depth_crop_size * 2), crop_size * 2, crop_size * 2, -1])
-    return img
-
-
-def apply_random_brightness_3d(image_tensor, label_tensor):
-    do_brightness = tf.random.uniform([]) > 0.75
-    norm = tf.math.abs(tf.random.normal([], 0.0, 0.1))
-    norm = tf.clip_by_value(norm, 0, 0.999)
-    image_tensor = tf.cond(do_brightness, lambda: tf.image.adjust_brightness(image_tensor, norm), lambda: image_tensor)
-    return image_tensor, label_tensor
-
-
-def apply_random_contrast_3d(image_tensor, label_tensor):
-    do_contrast = tf.random.uniform([]) > 0.75
-    contrast = tf.random.uniform([], 0.9, 1.1)
-    image_tensor = tf.cond(do_contrast, lambda: tf.image.adjust_contrast(image_tensor, contrast), lambda: image_tensor)
-    return image_tensor, label_tensor
-
-
-def apply_random_gamma_3d(image_tensor, label_tensor):
-    do_gamma = tf.random.uniform([]) > 0.75
-    gamma = tf.random.uniform([], 0.9, 1.1)
-    gain = tf.random.uniform([], 0.95, 1.05)
-    image_tensor = tf.cond(do_gamma, lambda: tf.image.adjust_gamma(image_tensor, gamma=gamma, gain=gain), lambda: image_tensor)
-    return image_tensor, label_tensor
-
-
-def normalise(image_tensor, label_tensor):
-    image_tensor = tf.map_fn(lambda x: normalise_per_batch(x), image_tensor)
-    return image_tensor, label_tensor
-
-
-def normalise_per_batch(image_tensor):
-    mean = tf.math.reduce_mean(image_tensor)
-    std = tf.math.reduce_std(image_tensor)
-    image_tensor = tf.divide(tf.math.subtract(image_tensor, mean), std)
-    return image_tensor
-
-
-def apply_flip_3d_axis(image_tensor, label_tensor, axis):
-    do_flip = tf.random.uniform([]) > 0.5
-    image_tensor = tf.cond(do_flip, lambda: tf.reverse(image_tensor, [axis]), lambda: image_tensor)
-    label_tensor = tf.cond(do_flip, lambda: tf.reverse(label_tensor, [axis]), lambda: label_tensor)
-    return image_tensor, label_tensor
-
-
-def apply_flip_3d(image_tensor, label_tensor):
-    image_tensor, label_tensor = tf.map_fn(lambda x: apply_flip_3d_axis(x[0], x[1], axis=-2), (image_tensor, label_tensor))
-    image_tensor, label_tensor = tf.map_fn(lambda x: apply_flip_3d_axis(x[0], x[1], axis=-3), (image_tensor, label_tensor))
-    image_tensor, label_tensor = tf.map_fn(lambda x: apply_flip_3d_axis(x[0], x[1], axis=-4), (image_tensor, label_tensor))
-    return image_tensor, label_tensor
-
-
-def apply_rotate_3d(image_tensor, label_tensor):
-    image_tensor, label_tensor = tf.map_fn(lambda x: rotate_per_batch_3d(x[0], x[1]), (image_tensor, label_tensor))
-    return image_tensor, label_tensor
-
-
-def rotate_per_batch_3d(image_tensor, label_tensor):
-    k = tf.random.uniform([], minval=0, maxval=3, dtype=tf.int32)
-    image_tensor = tf.image.rot90(image_tensor, k=k)
-    label_tensor = tf.image.rot90(label_tensor, k=k)
-    return image_tensor, label_tensor
-
-
-def rotate_randomly_image_pair_2d(image_tensor, label_tensor, min_angle, max_angle):
-
-    random_var = tf.random.uniform(maxval=2, dtype=tf.int32, shape=[])
-    random_angle = tf.random.uniform(minval=min_angle, maxval=max_angle, dtype=tf.float32, shape=[])
+    random_var = tf.random.stateless_uniform([], seed=fold_in_seed(seed, 7), maxval=2, dtype=tf.int32)
+    random_angle = tf.random.stateless_uniform([], seed=fold_in_seed(seed, 8), minval=min_angle, maxval=max_angle, dtype=tf.float32)
 
     randomly_rotated_img = tf.cond(pred=tf.equal(random_var, 0),
                                    true_fn=lambda: tfa.image.rotate(image_tensor, random_angle),
@@ -295,17 +166,21 @@ def one_hot_background_2d(label_tensor):
 #     return image_tensor, label_tensor
 
 
-def apply_valid_random_crop_3d(image_tensor, label_tensor, crop_size, depth_crop_size, resize, random_shift, output_slice, factor=0.04):
+def apply_valid_random_crop_3d(image_tensor, label_tensor, seeds, crop_size, depth_crop_size, resize, random_shift, output_slice, factor=0.04):
 
-    def crop_per_batch(x, y, centre, crop_size, depth_crop_size, resize, output_slice):
+    def crop_per_batch(x, y, centre, seed, crop_size, depth_crop_size, resize, output_slice):
         if resize:
+            # labels are resampled as a single-channel class map and only one-hot encoded after cropping
+            num_classes = y.shape[-1]
+            label_dtype = y.dtype
             original_height = tf.cast(tf.shape(x)[1], tf.float32)
             original_width = tf.cast(tf.shape(x)[2], tf.float32)
-            new_height = tf.cast(original_height + tf.random.uniform([], minval=-original_height * factor, maxval=original_height * factor), tf.int32)
-            new_width = tf.cast(original_width + tf.random.uniform([], minval=-original_width * factor, maxval=original_width * factor), tf.int32)
+            scale = tf.random.stateless_uniform([2], seed=fold_in_seed(seed, 9), minval=-factor, maxval=factor)
+            new_height = tf.cast(original_height + original_height * scale[0], tf.int32)
+            new_width = tf.cast(original_width + original_width * scale[1], tf.int32)
             x = tf.image.resize(x, [new_height, new_width])
-            y = tf.image.resize(y, [new_height, new_width])
-            y = tf.math.round(y)
+            y = label_to_class_map(y)
+            y = tf.image.resize(y, [new_height, new_width], method=tf.image.ResizeMethod.NEAREST_NEIGHBOR)
         dc, hc, wc = centre
         if output_slice:
             x = tf.slice(x, [dc - depth_crop_size, hc - crop_size, wc - crop_size, 0], [1 + (depth_crop_size * 2), crop_size * 2, crop_size * 2, -1])
@@ -313,25 +188,43 @@ def apply_valid_random_crop_3d(image_tensor, label_tensor, crop_size, depth_crop
         else:
             x = tf.slice(x, [dc - depth_crop_size, hc - crop_size, wc - crop_size, 0], [depth_crop_size * 2, crop_size * 2, crop_size * 2, -1])
             y = tf.slice(y, [dc - depth_crop_size, hc - crop_size, wc - crop_size, 0], [depth_crop_size * 2, crop_size * 2, crop_size * 2, -1])
-        return x, y, centre
-    
+        if resize:
+            y = class_map_to_label(y, num_classes, label_dtype)
+        return x, y, centre, seed
+
     if random_shift:
-        centre = get_random_batch_centre(image_tensor, crop_size, depth_crop_size)
-        image_tensor, label_tensor, centre = tf.map_fn(lambda x: crop_per_batch(x[0], x[1], x[2], crop_size, depth_crop_size, resize, output_slice), (image_tensor, label_tensor, centre))
+        centre = get_random_batch_centre(image_tensor, seeds, crop_size, depth_crop_size)
+        image_tensor, label_tensor, centre, seeds = tf.map_fn(lambda x: crop_per_batch(x[0], x[1], x[2], x[3], crop_size, depth_crop_size, resize, output_slice), (image_tensor, label_tensor, centre, seeds))
     else:
         image_tensor, label_tensor = apply_centre_crop_3d(image_tensor, label_tensor, crop_size, depth_crop_size, output_slice)
     return image_tensor, label_tensor
 
 
-def get_random_batch_centre(image_tensor, crop_size, depth_crop_size, pad=20):
-    batch_size = tf.shape(image_tensor)[0]
+def label_to_class_map(label_tensor):
+    """ Collapses a one-hot label (..., num_classes) to a uint8 class map (..., 1) """
+    if label_tensor.shape[-1] == 1:
+        return tf.cast(label_tensor, tf.uint8)
+    class_map = tf.cast(tf.argmax(label_tensor, axis=-1), tf.uint8)
+    return tf.expand_dims(class_map, -1)
+
+
+def class_map_to_label(class_map, num_classes, dtype=tf.float32):
+    """ Inverse of label_to_class_map, one-hot encodes a (..., 1) class map """
+    if num_classes == 1:
+        return tf.cast(class_map, dtype)
+    return tf.one_hot(tf.squeeze(class_map, -1), num_classes, dtype=dtype)
+
+
+def get_random_batch_centre(image_tensor, seeds, crop_size, depth_crop_size, pad=20):
     centre = (tf.cast(tf.math.divide(tf.shape(image_tensor)[1], 2), tf.int32), 
               tf.cast(tf.math.divide(tf.shape(image_tensor)[2], 2), tf.int32),
               tf.cast(tf.math.divide(tf.shape(image_tensor)[3], 2), tf.int32),
               )
-    drc = tf.random.normal([batch_size], mean=tf.cast(centre[0], tf.float32), stddev=tf.cast(centre[0] / 4, tf.float32))
-    hrc = tf.random.normal([batch_size], mean=tf.cast(centre[1], tf.float32), stddev=tf.cast(centre[1] / 4, tf.float32))
-    wrc = tf.random.normal([batch_size], mean=tf.cast(centre[2], tf.float32), stddev=tf.cast(centre[2] / 4, tf.float32))
+    # one (depth, height, width) draw per sample, each from its own key
+    norm = tf.map_fn(lambda seed: tf.random.stateless_normal([3], seed=fold_in_seed(seed, 10)), seeds, dtype=tf.float32)
+    drc = tf.cast(centre[0], tf.float32) + norm[:, 0] * tf.cast(centre[0] / 4, tf.float32)
+    hrc = tf.cast(centre[1], tf.float32) + norm[:, 1] * tf.cast(centre[1] / 4, tf.float32)
+    wrc = tf.cast(centre[2], tf.float32) + norm[:, 2] * tf.cast(centre[2] / 4, tf.float32)
     drc = tf.clip_by_value(drc, tf.cast(depth_crop_size + pad, tf.float32), tf.cast(tf.shape(image_tensor)[1] - depth_crop_size - pad, tf.float32))
     hrc = tf.clip_by_value(hrc, tf.cast(crop_size + pad, tf.float32), tf.cast(tf.shape(image_tensor)[2] - crop_size - pad, tf.float32))
     wrc = tf.clip_by_value(wrc, tf.cast(crop_size + pad, tf.float32), tf.cast(tf.shape(image_tensor)[3] - crop_size - pad, tf.float32))
@@ -372,27 +265,32 @@ def crop_3d_pad_slice(img, crop_size, depth_crop_size, centre):
     return img
 
 
-def apply_random_brightness_3d(image_tensor, label_tensor):
-    do_brightness = tf.random.uniform([]) > 0.75
-    norm = tf.math.abs(tf.random.normal([], 0.0, 0.1))
-    norm = tf.clip_by_value(norm, 0, 0.999)
-    image_tensor = tf.cond(do_brightness, lambda: tf.image.adjust_brightness(image_tensor, norm), lambda: image_tensor)
-    return image_tensor, label_tensor
-
+def apply_random_intensity_3d(image_tensor, label_tensor, seeds, brightness=True, contrast=True, gamma=True, prob=0.25):
+    """ Random brightness, contrast and gamma/gain in a single elementwise pass
+    over the (batch, depth, height, width, channels) image. Each sample draws
+    its own parameters (and its own decision to apply each one) from its key.
+    Contrast is taken about the per-volume mean. """
+    params = tf.map_fn(lambda seed: get_intensity_params(seed, brightness, contrast, gamma, prob), seeds, dtype=tf.float32)
+    params = tf.cast(tf.reshape(params, [-1, 4, 1, 1, 1, 1]), image_tensor.dtype)
+    delta, contrast_factor, gamma_factor, gain = tf.unstack(params, axis=1)
 
-def apply_random_contrast_3d(image_tensor, label_tensor):
-    do_contrast = tf.random.uniform([]) > 0.75
-    contrast = tf.random.uniform([], 0.9, 1.1)
-    image_tensor = tf.cond(do_contrast, lambda: tf.image.adjust_contrast(image_tensor, contrast), lambda: image_tensor)
+    mean = tf.math.reduce_mean(image_tensor, axis=[1, 2, 3], keepdims=True)
+    image_tensor = gain * tf.math.pow((image_tensor - mean) * contrast_factor + mean + delta, gamma_factor)
     return image_tensor, label_tensor
 
 
-def apply_random_gamma_3d(image_tensor, label_tensor):
-    do_gamma = tf.random.uniform([]) > 0.75
-    gamma = tf.random.uniform([], 0.9, 1.1)
-    gain = tf.random.uniform([], 0.95, 1.05)
-    image_tensor = tf.cond(do_gamma, lambda: tf.image.adjust_gamma(image_tensor, gamma=gamma, gain=gain), lambda: image_tensor)
-    return image_tensor, label_tensor
+def get_intensity_params(seed, brightness, contrast, gamma, prob):
+    """ Returns (delta, contrast, gamma, gain) for one sample, set to the
+    identity for every adjustment that is disabled or not drawn """
+    u = tf.random.stateless_uniform([6], seed=fold_in_seed(seed, 11))
+    norm = tf.random.stateless_normal([], seed=fold_in_seed(seed, 12), stddev=0.1)
+
+    delta = tf.clip_by_value(tf.math.abs(norm), 0, 0.999)
+    delta = tf.where(brightness & (u[0] < prob), delta, 0.0)
+    contrast_factor = tf.where(contrast & (u[1] < prob), 0.9 + 0.2 * u[2], 1.0)
+    gamma_factor = tf.where(gamma & (u[3] < prob), 0.9 + 0.2 * u[4], 1.0)
+    gain = tf.where(gamma & (u[3] < prob), 0.95 + 0.1 * u[5], 1.0)
+    return tf.stack([delta, contrast_factor, gamma_factor, gain])
 
 
 def normalise(image_tensor, label_tensor):
@@ -407,27 +305,27 @@ def normalise_per_batch(image_tensor):
     return image_tensor
 
 
-def apply_flip_3d_axis(image_tensor, label_tensor, axis):
-    do_flip = tf.random.uniform([]) > 0.5
+def apply_flip_3d_axis(image_tensor, label_tensor, seed, axis):
+    do_flip = tf.random.stateless_uniform([], seed=fold_in_seed(seed, 18 - axis)) > 0.5
     image_tensor = tf.cond(do_flip, lambda: tf.reverse(image_tensor, [axis]), lambda: image_tensor)
     label_tensor = tf.cond(do_flip, lambda: tf.reverse(label_tensor, [axis]), lambda: label_tensor)
     return image_tensor, label_tensor
 
 
-def apply_flip_3d(image_tensor, label_tensor):
-    image_tensor, label_tensor = tf.map_fn(lambda x: apply_flip_3d_axis(x[0], x[1], axis=-2), (image_tensor, label_tensor))
-    image_tensor, label_tensor = tf.map_fn(lambda x: apply_flip_3d_axis(x[0], x[1], axis=-3), (image_tensor, label_tensor))
-    image_tensor, label_tensor = tf.map_fn(lambda x: apply_flip_3d_axis(x[0], x[1], axis=-4), (image_tensor, label_tensor))
+def apply_flip_3d(image_tensor, label_tensor, seeds):
+    image_tensor, label_tensor, _ = tf.map_fn(lambda x: (*apply_flip_3d_axis(x[0], x[1], x[2], axis=-2), x[2]), (image_tensor, label_tensor, seeds))
+    image_tensor, label_tensor, _ = tf.map_fn(lambda x: (*apply_flip_3d_axis(x[0], x[1], x[2], axis=-3), x[2]), (image_tensor, label_tensor, seeds))
+    image_tensor, label_tensor, _ = tf.map_fn(lambda x: (*apply_flip_3d_axis(x[0], x[1], x[2], axis=-4), x[2]), (image_tensor, label_tensor, seeds))
     return image_tensor, label_tensor
 
 
-def apply_rotate_3d(image_tensor, label_tensor):
-    image_tensor, label_tensor = tf.map_fn(lambda x: rotate_per_batch_3d(x[0], x[1]), (image_tensor, label_tensor))
+def apply_rotate_3d(image_tensor, label_tensor, seeds):
+    image_tensor, label_tensor, _ = tf.map_fn(lambda x: (*rotate_per_batch_3d(x[0], x[1], x[2]), x[2]), (image_tensor, label_tensor, seeds))
     return image_tensor, label_tensor
 
 
-def rotate_per_batch_3d(image_tensor, label_tensor):
-    k = tf.random.uniform([], minval=0, maxval=3, dtype=tf.int32)
+def rotate_per_batch_3d(image_tensor, label_tensor, seed):
+    k = tf.random.stateless_uniform([], seed=fold_in_seed(seed, 23), minval=0, maxval=3, dtype=tf.int32)
     image_tensor = tf.image.rot90(image_tensor, k=k)
     label_tensor = tf.image.rot90(label_tensor, k=k)
     return image_tensor, label_tensor
@@ -11,8 +11,9 @@ from glob import glob
 from Segmentation.utils.augmentation import crop_randomly_image_pair_2d, adjust_contrast_randomly_image_pair_2d
 from Segmentation.utils.augmentation import adjust_brightness_randomly_image_pair_2d
 from Segmentation.utils.augmentation import apply_centre_crop_3d, apply_valid_random_crop_3d
-from Segmentation.utils.augmentation import apply_random_brightness_3d, apply_random_contrast_3d, apply_random_gamma_3d
+from Segmentation.utils.augmentation import apply_random_intensity_3d
 from Segmentation.utils.augmentation import apply_flip_3d, apply_rotate_3d, normalise
+from Segmentation.utils.augmentation import get_augmentation_seed, fold_in_seed
 
 def get_multiclass(label):
 
@@ -155,7 +156,7 @@ def create_OAI_dataset(data_folder, tfrecord_directory, get_train=True, use_2d=T
                 writer.write(example.SerializeToString())
         print(f'{idx} out of {len(files) - 1} datasets have been processed. Target: {target_shape}, Label: {label_shape}')
 
-def parse_fn_2d(example_proto, training, augmentation, multi_class=True, use_bfloat16=False, use_RGB=False):
+def parse_fn_2d(example_proto, training, augmentation, multi_class=True, use_bfloat16=False, use_RGB=False, seed=None):
 
     if use_bfloat16:
         dtype = tf.bfloat16
@@ -184,14 +185,14 @@ def parse_fn_2d(example_proto, training, augmentation, multi_class=True, use_bfl
 
     if training:
         if augmentation == 'random_crop':
-            image, seg = crop_randomly_image_pair_2d(image, seg)
+            image, seg = crop_randomly_image_pair_2d(image, seg, seed)
         elif augmentation == 'noise':
-            image, seg = adjust_brightness_randomly_image_pair_2d(image, seg)
-            image, seg = adjust_contrast_randomly_image_pair_2d(image, seg)
+            image, seg = adjust_brightness_randomly_image_pair_2d(image, seg, seed)
+            image, seg = adjust_contrast_randomly_image_pair_2d(image, seg, seed)
         elif augmentation == 'crop_and_noise':
-            image, seg = crop_randomly_image_pair_2d(image, seg)
-            image, seg = adjust_brightness_randomly_image_pair_2d(image, seg)
-            image, seg = adjust_contrast_randomly_image_pair_2d(image, seg)
+            image, seg = crop_randomly_image_pair_2d(image, seg, seed)
+            image, seg = adjust_brightness_randomly_image_pair_2d(image, seg, seed)
+            image, seg = adjust_contrast_randomly_image_pair_2d(image, seg, seed)
         elif augmentation is None:
             image = tf.image.resize_with_crop_or_pad(image, 288, 288)
             seg = tf.image.resize_with_crop_or_pad(seg, 288, 288)
@@ -210,7 +211,7 @@ def parse_fn_2d(example_proto, training, augmentation, multi_class=True, use_bfl
 
     return (image, seg)
 
-def parse_fn_3d(example_proto, training, multi_class=True, use_bfloat16=False, use_RGB=False):
+def parse_fn_3d(example_proto, training, augmentation=None, multi_class=True, use_bfloat16=False, use_RGB=False, seed=None):
 
     if use_bfloat16:
         dtype = tf.bfloat16
@@ -244,9 +245,10 @@ def parse_fn_3d(example_proto, training, multi_class=True, use_bfloat16=False, u
         seg = tf.clip_by_value(seg, 0, 1)
     
     if training:
-        dx = tf.cast(tf.random.uniform(shape=[], minval=0, maxval=128), tf.int32)
-        dy = tf.cast(tf.random.uniform(shape=[], minval=0, maxval=96), tf.int32)
-        dz = tf.cast(tf.random.uniform(shape=[], minval=0, maxval=96), tf.int32)
+        offset = tf.random.stateless_uniform([3], seed=fold_in_seed(seed, 24), minval=0, maxval=1)
+        dx = tf.cast(offset[0] * 128, tf.int32)
+        dy = tf.cast(offset[1] * 96, tf.int32)
+        dz = tf.cast(offset[2] * 96, tf.int32)
 
         image = image[dx:dx+32, dy:dy+288, dz:dz+288, :]
         seg = seg[dx:dx+32, dy:dy+288, dz:dz+288, :]
@@ -259,26 +261,51 @@ def parse_fn_3d(example_proto, training, multi_class=True, use_bfloat16=False, u
 
     return (image, seg)
 
+def add_epoch_seeds(dataset_fn, seed, num_shards=1, shard_index=0, start_epoch=0, epoch_fn=None):
+    """ Repeats the dataset built by dataset_fn(epoch) forever from start_epoch,
+    pairing every element with its get_augmentation_seed(seed, epoch, index)
+    key. The index of a shard's elements is interleaved with the other shards'
+    so no two workers draw the same augmentation. epoch_fn maps the keyed
+    dataset of every epoch on its own, e.g. to batch it without a batch
+    straddling two epochs. """
+    def epoch_dataset(epoch):
+        dataset = dataset_fn(epoch)
+        dataset = dataset.enumerate()
+        dataset = dataset.map(lambda index, element: (get_augmentation_seed(seed, epoch, index * num_shards + shard_index), element))
+        return dataset if epoch_fn is None else epoch_fn(dataset)
+
+    return tf.data.experimental.Counter(start=start_epoch).flat_map(epoch_dataset)
+
 def read_tfrecord_2d(tfrecords_dir, batch_size, buffer_size, augmentation,
                      parse_fn=parse_fn_2d, multi_class=True,
                      is_training=False, use_bfloat16=False,
-                     use_RGB=False):
+                     use_RGB=False, seed=1, return_seeds=False,
+                     num_shards=1, shard_index=0, start_epoch=0):
+    """ num_shards > 1 reads only every num_shards-th file from shard_index,
+    for one worker of a multi worker run. All workers shuffle the whole file
+    list the same way first, so every epoch splits the files differently.
+
+    Every epoch is batched on its own, dropping its remainder, and the
+    dataset starts at epoch start_epoch, so a resumed run reads the same
+    batches without replaying the epochs before. """
 
     file_list = tf.io.matching_files(os.path.join(tfrecords_dir, '*-*'))
-    shards = tf.data.Dataset.from_tensor_slices(file_list)
-    cycle_l = 1
-    if is_training:
-        shards = shards.shuffle(tf.cast(tf.shape(file_list)[0], tf.int64)) 
-        cycle_l = 8
-    
-    if parse_fn == parse_fn_2d:
-        shards = shards.repeat()
-    dataset = shards.interleave(tf.data.TFRecordDataset,
-                                cycle_length=cycle_l,
-                                num_parallel_calls=tf.data.experimental.AUTOTUNE)
-    if is_training:
-        dataset = dataset.shuffle(buffer_size=buffer_size)
-        
+    cycle_l = 8 if is_training else 1
+
+    def epoch_dataset(epoch):
+        # the shuffle order is a function of (seed, epoch) so epochs can be replayed
+        shuffle_seed = tf.random.stateless_uniform([], seed=tf.stack([tf.cast(seed, tf.int64), epoch]),
+                                                   minval=0, maxval=tf.int64.max, dtype=tf.int64)
+        shards = tf.data.Dataset.from_tensor_slices(file_list)
+        if is_training:
+            shards = shards.shuffle(tf.cast(tf.shape(file_list)[0], tf.int64), seed=shuffle_seed)
+        shards = shards.shard(num_shards, shard_index)
+        dataset = shards.interleave(tf.data.TFRecordDataset,
+                                    cycle_length=cycle_l,
+                                    num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        if is_training:
+            dataset = dataset.shuffle(buffer_size=buffer_size, seed=shuffle_seed)
+        return dataset
 
     parser = partial(parse_fn,
                      training=is_training,
@@ -286,21 +313,36 @@ def read_tfrecord_2d(tfrecords_dir, batch_size, buffer_size, augmentation,
                      multi_class=multi_class,
                      use_bfloat16=use_bfloat16,
                      use_RGB=use_RGB)
-    dataset = dataset.map(map_func=parser, num_parallel_calls=tf.data.experimental.AUTOTUNE)
-    dataset = dataset.batch(batch_size, drop_remainder=True).prefetch(tf.data.experimental.AUTOTUNE)
-    if parse_fn == parse_fn_3d:
-        dataset = dataset.repeat()
+
+    def parse_epoch(dataset):
+        dataset = dataset.map(map_func=lambda key, example: (key, parser(example, seed=key)),
+                              num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        return dataset.batch(batch_size, drop_remainder=True)
+
+    dataset = add_epoch_seeds(epoch_dataset, seed, num_shards, shard_index, start_epoch, parse_epoch)
+    if not return_seeds:
+        dataset = dataset.map(lambda keys, example: example)
 
     # optimise dataset performance
     options = tf.data.Options()
     options.experimental_optimization.parallel_batch = True
     options.experimental_optimization.map_fusion = True
-    options.experimental_optimization.map_vectorization.enabled = True
+    if hasattr(options.experimental_optimization, 'map_vectorization'):
+        # removed in TF 2.5
+        options.experimental_optimization.map_vectorization.enabled = True
     options.experimental_optimization.map_parallelization = True
+    if num_shards > 1:
+        # already sharded, tf.distribute must not shard it again
+        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
     dataset = dataset.with_options(options)
     dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
     return dataset
 
+def map_with_seeds(dataset, map_func):
+    """ Maps map_func(image, label, seeds) over a (seeds, (image, label)) dataset """
+    return dataset.map(lambda seeds, example: (seeds, map_func(*example, seeds=seeds)),
+                       num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
 def read_tfrecord_3d(tfrecords_dir,
                      batch_size,
                      buffer_size,
@@ -309,34 +351,35 @@ def read_tfrecord_3d(tfrecords_dir,
                      depth_crop_size=80,
                      aug=[],
                      predict_slice=False,
+                     use_keras_fit=False,
+                     seed=1,
                      **kwargs):
 
-    dataset = read_tfrecord(tfrecords_dir=tfrecords_dir,
-                            batch_size=batch_size,
-                            buffer_size=buffer_size,
-                            augmentation=None,
-                            parse_fn=parse_fn_3d,
-                            is_training=is_training,
-                            **kwargs)
+    dataset = read_tfrecord_2d(tfrecords_dir=tfrecords_dir,
+                               batch_size=batch_size,
+                               buffer_size=buffer_size,
+                               augmentation=None,
+                               parse_fn=parse_fn_3d,
+                               is_training=is_training,
+                               seed=seed,
+                               return_seeds=True,
+                               **kwargs)
 
     if crop_size is not None:
         if is_training:
             resize = "resize" in aug
             random_shift = "shift" in aug
             parse_crop = partial(apply_valid_random_crop_3d, crop_size=crop_size, depth_crop_size=depth_crop_size, resize=resize, random_shift=random_shift, output_slice=predict_slice)
-            dataset = dataset.map(map_func=parse_crop, num_parallel_calls=tf.data.experimental.AUTOTUNE)
-            if "bright" in aug:
-                dataset = dataset.map(apply_random_brightness_3d)
-            if "contrast" in aug:
-                dataset = dataset.map(apply_random_contrast_3d)
-            if "gamma" in aug:
-                dataset = dataset.map(apply_random_gamma_3d)
+            dataset = map_with_seeds(dataset, parse_crop)
+            if ("bright" in aug) or ("contrast" in aug) or ("gamma" in aug):
+                parse_intensity = partial(apply_random_intensity_3d, brightness="bright" in aug, contrast="contrast" in aug, gamma="gamma" in aug)
+                dataset = map_with_seeds(dataset, parse_intensity)
             if "flip" in aug:
-                dataset = dataset.map(apply_flip_3d)
+                dataset = map_with_seeds(dataset, apply_flip_3d)
             if "rotate" in aug:
-                dataset = dataset.map(apply_rotate_3d)
+                dataset = map_with_seeds(dataset, apply_rotate_3d)
         else:
             parse_crop = partial(apply_centre_crop_3d, crop_size=crop_size, depth_crop_size=depth_crop_size, output_slice=predict_slice)
-            dataset = dataset.map(map_func=parse_crop, num_parallel_calls=tf.data.experimental.AUTOTUNE)
-    dataset = dataset.map(normalise)
+            dataset = dataset.map(map_func=lambda seeds, example: (seeds, parse_crop(*example)), num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.map(lambda seeds, example: normalise(*example))
     return dataset
@@ -7,13 +7,19 @@ epsilon = 1e-5
 smooth = 1
 
 
+def flatten_float32(x):
+    """ Flattens x and casts it to float32 so the sums over whole volumes
+    are accumulated in float32 under float16/bfloat16 policies """
+    return K.flatten(tf.cast(x, tf.float32))
+
+
 def dice_coef_loss(y_true, y_pred):
     return -dice_coef(y_true, y_pred)
 
 
 def dice_coef(y_true, y_pred, smooth=1):
-    y_true_f = K.flatten(y_true)
-    y_pred_f = K.flatten(y_pred)
+    y_true_f = flatten_float32(y_true)
+    y_pred_f = flatten_float32(y_pred)
 
     intersection = K.sum(y_true_f * y_pred_f)
     return (2. * intersection + smooth) / (K.sum(y_true_f * y_true_f) + K.sum(y_pred_f * y_pred_f) + smooth)
@@ -22,8 +28,8 @@ def dice_coef(y_true, y_pred, smooth=1):
 def dsc(y_true, y_pred):
     # https://github.com/nabsabraham/focal-tversky-unet/blob/master/losses.py
     smooth = 1.
-    y_true_f = K.flatten(y_true)
-    y_pred_f = K.flatten(y_pred)
+    y_true_f = flatten_float32(y_true)
+    y_pred_f = flatten_float32(y_pred)
     intersection = K.sum(y_true_f * y_pred_f)
     score = (2. * intersection + smooth) / (K.sum(y_true_f) + K.sum(y_pred_f) + smooth)
     return score
@@ -49,8 +55,8 @@ def tversky_loss(y_true, y_pred, alpha=0.5, beta=0.5, smooth=1e-10):
     tensor
         tensor containing tversky loss.
     """
-    y_true = K.flatten(y_true)
-    y_pred = K.flatten(y_pred)
+    y_true = flatten_float32(y_true)
+    y_pred = flatten_float32(y_pred)
     truepos = K.sum(y_true * y_pred)
     fp_and_fn = alpha * K.sum(y_pred * (1 - y_true)) + beta * K.sum((1 - y_pred) * y_true)
     answer = (truepos + smooth) / ((truepos + smooth) + fp_and_fn)
@@ -68,8 +74,8 @@ def tversky_crossentropy(y_true, y_pred):
 
 
 def iou_loss(y_true, y_pred, smooth=1):
-    y_true = K.flatten(y_true)
-    y_pred = K.flatten(y_pred)
+    y_true = flatten_float32(y_true)
+    y_pred = flatten_float32(y_pred)
     intersection = K.sum(K.abs(y_true * y_pred), axis=-1)
     union = K.sum(y_true, -1) + K.sum(y_pred, -1) - intersection
     iou = (intersection + smooth) / (union + smooth)
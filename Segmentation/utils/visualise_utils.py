@@ -1,28 +1,102 @@
 """ Necessary functions for visualizing, eg. making gifs, plots, or saving
     numpy volumes for plotly graph 
 """
+import queue
+import threading
+import traceback
+
 import numpy as np
 import matplotlib.pyplot as plt
+import tensorflow as tf
+
+from Segmentation.train.reshape import get_mid_slice, get_mid_vol
+
+# pyplot keeps global state, the pool renders one figure at a time
+pyplot_lock = threading.Lock()
+
+
+class VisualisationPool:
+    """ Writes the image summaries of the train loop from background threads.
+
+    submit() only queues the function and its arrays. When max_pending items
+    are already waiting the item is dropped instead of blocking training.
+    """
+
+    def __init__(self, num_workers=1, max_pending=4):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.dropped = 0
+        self.threads = [threading.Thread(target=self.work, daemon=True) for _ in range(num_workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, fn, *args):
+        try:
+            self.queue.put_nowait((fn, args))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            fn, args = item
+            try:
+                fn(*args)
+            except Exception:  # a broken image must not stop the next ones
+                traceback.print_exc()
+            self.queue.task_done()
+
+    def close(self):
+        """ Waits for the queued summaries to be written """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
 
 
 ### train model loop
-def visualise_sample(x, y, pred, 
-                    num_to_visualise,
-                    slice_writer, vol_writer, 
-                    use_2d, epoch, multi_class, predict_slice, is_training):
-    img = get_mid_slice(x.values[0], y.values[0], pred.values[0], multi_class)
+def visualise_sample(x, y, pred,
+                     num_to_visualise,
+                     slice_writer, vol_writer,
+                     use_2d, epoch, multi_class, predict_slice, is_training,
+                     strategy, pool, visual_save_freq=1, rad=12):
+    """ Takes the mid slice and the mid sub-volume of the first example of the
+    first replica off the device and hands them to pool to render. An empty
+    sub-volume is skipped and num_to_visualise raised so the next batch is
+    shown instead. """
+    x, y, pred = (tf.cast(strategy.experimental_local_results(t)[0][:1], tf.float32) for t in (x, y, pred))
+    mid = y.shape[1] // 2
+    slices = [t[:, mid:mid + 1].numpy() for t in (x, y, pred)]
+
+    subvols = None
+    if epoch % visual_save_freq == 0 and not predict_slice:
+        centre = [d // 2 for d in y.shape[1:4]]
+        subvols = [t[:, centre[0] - rad:centre[0] + rad,
+                     centre[1] - rad:centre[1] + rad,
+                     centre[2] - rad:centre[2] + rad].numpy() for t in (y, pred)]
+        if np.sum(subvols[0]) < 25:
+            subvols = None
+            num_to_visualise += 1
+
     session_type = "Train" if is_training else "Validation"
+    pool.submit(write_sample_summaries, slices, subvols, slice_writer, vol_writer,
+                session_type, epoch, multi_class, rad)
+    return num_to_visualise
+
+
+def write_sample_summaries(slices, subvols, slice_writer, vol_writer, session_type, epoch, multi_class, rad):
+    img = get_mid_slice(*slices, multi_class)
     with slice_writer.as_default():
         tf.summary.image(f"{session_type} - Slice", img, step=epoch)
-    if epoch % visual_save_freq == 0:
-        if not predict_slice:
-            img = get_mid_vol(y.values[0], pred.values[0], multi_class, check_empty=True)
-            if img is None:
-                num_to_visualise += 1
-            else:
-                with vol_writer.as_default():
-                    tf.summary.image(f"{session_type} - Volume", img, step=epoch)
-    return num_to_visualise
+    if subvols is not None:
+        with pyplot_lock:
+            img = get_mid_vol(*subvols, multi_class, rad=rad)
+        with vol_writer.as_default():
+            tf.summary.image(f"{session_type} - Volume", img, step=epoch)
 
 
 ## VNet: vnet_train from og dev_rl
@@ -10,8 +10,21 @@ flags.DEFINE_bool('custom_decay_lr', False, 'Whether to specify epochs to decay
 flags.DEFINE_list('lr_decay_epochs', [10, 20, 40, 60], 'Epochs to decay the learning rate by. Only used if custom_decay_lr is True')
 flags.DEFINE_string('dataset', 'oai_challenge', 'Dataset: oai_challenge, isic_2018 or oai_full')
 flags.DEFINE_bool('use_2d', True, 'True to train on 2D slices, False to train on 3D data')
+flags.DEFINE_bool('predict_slice', False, 'The model predicts the centre slice of its window')
 flags.DEFINE_integer('train_epochs', 50, 'Number of training epochs.')
 flags.DEFINE_string('aug_strategy', None, 'Augmentation Strategies: None, random-crop, noise, crop_and_noise')
+flags.DEFINE_integer('accum_steps', 1, 'Number of micro-batches each batch is split into, gradients are summed over them and applied once')
+flags.DEFINE_integer('steps_per_execution', 1, 'Number of train steps run inside one tf.function call of the custom loop')
+flags.DEFINE_bool('profile', False, 'Time every step of the custom loop (input, compute, metrics, visualisation, checkpoint), runs the steps one at a time')
+flags.DEFINE_string('profile_steps', None, 'Global train steps to capture a TF profiler trace of, e.g. 100:120')
+flags.DEFINE_string('profile_dir', None, 'Where the profiler trace is written, the log dir of the run by default')
+flags.DEFINE_integer('keep_top_k', 3, 'Number of checkpoints with the lowest validation loss to keep')
+flags.DEFINE_integer('keep_latest', 1, 'Number of most recent checkpoints to keep')
+flags.DEFINE_integer('checkpoint_steps', 0, 'Also save the full training state every this many train steps, 0 for only at the end of an epoch')
+flags.DEFINE_string('resume', None, 'Log dir of a run to resume from its last saved training state')
+flags.DEFINE_bool('multi_worker', False, 'Train with MultiWorkerMirroredStrategy on the cluster described by the TF_CONFIG environment variable')
+flags.DEFINE_bool('jit_compile', False, 'Compile the model call, loss and gradients of the train and test steps with XLA')
+flags.DEFINE_string('compile_cache_dir', None, 'Directory where compiled kernels are kept for later runs')
 
 # Model options
 flags.DEFINE_string('model_architecture', 'unet', 'unet, r2unet, segnet, unet++, 100-Layer-Tiramisu, deeplabv3, deeplabv3_plus')
@@ -83,6 +96,7 @@ flags.DEFINE_string('which_representation', None, 'Whether to do epoch gif ("epo
 # Accelerator flags
 flags.DEFINE_bool('use_gpu', False, 'Whether to run on GPU or otherwise TPU.')
 flags.DEFINE_bool('use_bfloat16', False, 'Whether to use mixed precision.')
+flags.DEFINE_bool('use_float16', False, 'Whether to use float16 mixed precision with dynamic loss scaling (GPU).')
 flags.DEFINE_integer('num_cores', 8, 'Number of TPU cores or number of GPUs.')
 flags.DEFINE_string('tpu', 'joe', 'Name of the TPU. Only used if use_gpu is False.')
 
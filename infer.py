@@ -0,0 +1,55 @@
+import os
+
+from absl import app
+from absl import flags
+
+from Segmentation.train.infer import infer_directory
+from Segmentation.train.utils import setup_compile_cache
+
+from flags import FLAGS
+from select_model import select_model
+
+flags.DEFINE_string('input_dir', './Data/valid', 'Directory of the .im volumes to segment')
+flags.DEFINE_string('output_dir', './Data/masks', 'Directory the .seg.h5 masks are written to')
+flags.DEFINE_integer('crop_size', 144, 'Half the height and width of the sliding window')
+flags.DEFINE_integer('depth_crop_size', 80, 'Half the depth of the sliding window')
+flags.DEFINE_integer('inference_batch_size', 4, 'Number of windows in a forward pass')
+flags.DEFINE_bool('gaussian', False, 'Weight the overlap of the windows by the distance from their centres')
+flags.DEFINE_list('tta', [], 'Test time augmentations: flip_depth, flip_height, flip_width, rot90')
+flags.DEFINE_integer('num_readers', 2, 'Threads reading the volumes')
+flags.DEFINE_integer('num_writers', 2, 'Threads writing the masks')
+
+
+def main(argv):
+    """ Segments the .im volumes of --input_dir with the best_weights.tf of
+    the run in --weights_dir, e.g.
+
+    python infer.py --model_architecture vnet --use_2d False --activation prelu \
+        --num_filters 16,32,64,128 --multi_class --weights_dir logs/vnet/... \
+        --input_dir Data/valid --output_dir Data/masks
+    """
+    del argv  # unused arg
+
+    setup_compile_cache(FLAGS.compile_cache_dir)
+    num_classes = 7 if FLAGS.multi_class else 1
+    # a list flag given on the command line holds strings
+    FLAGS.num_filters = [int(num) for num in FLAGS.num_filters]
+    model_fn, model_args = select_model(FLAGS, num_classes)
+    if model_fn is None:
+        return
+    infer_directory(model_fn, model_args, {'predict_slice': True} if FLAGS.predict_slice else None,
+                    os.path.join(FLAGS.weights_dir, 'best_weights.tf'),
+                    FLAGS.input_dir, FLAGS.output_dir,
+                    crop_size=FLAGS.crop_size,
+                    depth_crop_size=FLAGS.depth_crop_size,
+                    predict_slice=FLAGS.predict_slice,
+                    batch_size=FLAGS.inference_batch_size,
+                    gaussian=FLAGS.gaussian,
+                    tta=tuple(FLAGS.tta),
+                    jit_compile=FLAGS.jit_compile,
+                    num_readers=FLAGS.num_readers,
+                    num_writers=FLAGS.num_writers)
+
+
+if __name__ == '__main__':
+    app.run(main)
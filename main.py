@@ -11,6 +11,8 @@ from Segmentation.utils.data_loader import parse_fn_2d, parse_fn_3d
 from Segmentation.utils.losses import dice_coef_loss, tversky_loss, dice_coef, iou_loss  # focal_tversky
 from Segmentation.utils.evaluation_metrics import dice_coef_eval, iou_loss_eval
 from Segmentation.utils.training_utils import LearningRateSchedule
+from Segmentation.train.utils import setup_mixed_precision, get_loss_scale_optimizer, ConfusionMetric
+from Segmentation.train.utils import get_strategy, distribute_dataset, setup_compile_cache
 # from Segmentation.utils.evaluation_utils import plot_and_eval_3D, confusion_matrix, epoch_gif, volume_gif, take_slice
 from Segmentation.utils.evaluation_utils import eval_loop
 from Segmentation.train.train import Train
@@ -19,16 +21,55 @@ from flags import FLAGS
 from select_model import select_model
 
 
+def get_global_batch_size():
+    """ The batch of all the cores, FLAGS.batch_size is the batch of each """
+    return FLAGS.batch_size * FLAGS.num_cores
+
+
+def get_train(strategy, model, optimiser, loss_fn, lr_manager, num_classes, steps_per_epoch, validation_steps):
+    """ The Train of the flags, which takes the global batch """
+    with strategy.scope():
+        train_metrics = ConfusionMetric(num_classes)
+
+        # in the scope, so Train checks the batch against its replicas
+        return Train(epochs=FLAGS.train_epochs,
+                     batch_size=get_global_batch_size(),
+                     enable_function=True,
+                     model=model,
+                     optimizer=optimiser,
+                     loss_func=loss_fn,
+                     lr_manager=lr_manager,
+                     predict_slice=FLAGS.predict_slice,
+                     metrics=train_metrics,
+                     tfrec_dir='./Data/tfrecords/',
+                     log_dir="logs",
+                     accum_steps=FLAGS.accum_steps,
+                     steps_per_epoch=steps_per_epoch,
+                     validation_steps=validation_steps,
+                     steps_per_execution=FLAGS.steps_per_execution,
+                     profile=FLAGS.profile,
+                     profile_steps=FLAGS.profile_steps,
+                     profile_dir=FLAGS.profile_dir,
+                     keep_top_k=FLAGS.keep_top_k,
+                     keep_latest=FLAGS.keep_latest,
+                     checkpoint_steps=FLAGS.checkpoint_steps,
+                     resume=FLAGS.resume,
+                     jit_compile=FLAGS.jit_compile)
+
+
 def main(argv):
 
     if FLAGS.visual_file:
         assert FLAGS.train is False, "Train must be set to False if you are doing a visual."
 
     del argv  # unused arg
-    tf.random.set_seed(FLAGS.seed)  # set seed
 
+    setup_compile_cache(FLAGS.compile_cache_dir)
     # set whether to train on GPU or TPU
-    if FLAGS.use_gpu:
+    if FLAGS.multi_worker:
+        # before any other op, see get_strategy
+        strategy = get_strategy(multi_worker=True)
+    elif FLAGS.use_gpu:
         logging.info('Using GPU...')
         # strategy requires: export TF_FORCE_GPU_ALLOW_GROWTH=true to be wrote in cmd
         if FLAGS.num_cores == 1:
@@ -53,11 +94,12 @@ def main(argv):
         tf.config.experimental_connect_to_cluster(resolver)
         tf.tpu.experimental.initialize_tpu_system(resolver)
         strategy = tf.distribute.experimental.TPUStrategy(resolver)
+    tf.random.set_seed(FLAGS.seed)  # set seed
 
     # set dataset configuration
     if FLAGS.dataset == 'oai_challenge':
 
-        batch_size = FLAGS.batch_size * FLAGS.num_cores
+        batch_size = get_global_batch_size()
 
         if FLAGS.use_2d:
             steps_per_epoch = 19200 // batch_size
@@ -79,13 +121,25 @@ def main(argv):
             'multi_class': FLAGS.multi_class,
             'is_training': True,
             'use_bfloat16': FLAGS.use_bfloat16,
-            'use_RGB': False if FLAGS.backbone_architecture == 'default' else True
+            'use_RGB': False if FLAGS.backbone_architecture == 'default' else True,
+            'seed': FLAGS.seed
         }
 
-        train_ds = read_tfrecord(tfrecords_dir=os.path.join(FLAGS.tfrec_dir, train_dir),
-                                 **ds_args)
-        valid_ds = read_tfrecord(tfrecords_dir=os.path.join(FLAGS.tfrec_dir, valid_dir),
-                                 **ds_args)
+        if FLAGS.multi_worker:
+            # every worker reads its own files, batch_size stays the batch of all workers
+            def dataset_fn(directory):
+                def shard_fn(shard_batch_size, num_shards, shard_index):
+                    return read_tfrecord(tfrecords_dir=os.path.join(FLAGS.tfrec_dir, directory),
+                                         **dict(ds_args, batch_size=shard_batch_size,
+                                                num_shards=num_shards, shard_index=shard_index))
+                return shard_fn
+            train_ds = distribute_dataset(strategy, dataset_fn(train_dir), batch_size)
+            valid_ds = distribute_dataset(strategy, dataset_fn(valid_dir), batch_size)
+        else:
+            train_ds = read_tfrecord(tfrecords_dir=os.path.join(FLAGS.tfrec_dir, train_dir),
+                                     **ds_args)
+            valid_ds = read_tfrecord(tfrecords_dir=os.path.join(FLAGS.tfrec_dir, valid_dir),
+                                     **ds_args)
 
         num_classes = 7 if FLAGS.multi_class else 1
 
@@ -97,8 +151,12 @@ def main(argv):
         crossentropy_loss_fn = tf.keras.losses.binary_crossentropy
 
     if FLAGS.use_bfloat16:
-        policy = tf.keras.mixed_precision.experimental.Policy('mixed_bfloat16')
-        tf.keras.mixed_precision.experimental.set_policy(policy)
+        precision = 'bfloat16'
+    elif FLAGS.use_float16:
+        precision = 'float16'
+    else:
+        precision = None
+    setup_mixed_precision(precision)
 
     # set model architecture
 
@@ -127,6 +185,7 @@ def main(argv):
         else:
             print('Not a valid input optimizer, using Adam.')
             optimiser = tf.keras.optimizers.Adam(learning_rate=lr_rate)
+        optimiser = get_loss_scale_optimizer(optimiser, precision)
 
         # for some reason, if i build the model then it can't load checkpoints. I'll see what I can do about this
         if FLAGS.train:
@@ -171,10 +230,6 @@ def main(argv):
 
         logdir = os.path.join(FLAGS.logdir, FLAGS.tpu)
         logdir = os.path.join(logdir, time)
-        logdir_arch = os.path.join(logdir, FLAGS.model_architecture)
-        ckpt_cb = tf.keras.callbacks.ModelCheckpoint(logdir_arch + '_weights.{epoch:03d}.ckpt',
-                                                     save_best_only=False,
-                                                     save_weights_only=True)
         tb = tf.keras.callbacks.TensorBoard(logdir, update_freq='epoch')
 
         # history = model.fit(train_ds,
@@ -182,7 +237,7 @@ def main(argv):
         #                     epochs=FLAGS.train_epochs,
         #                     validation_data=valid_ds,
         #                     validation_steps=validation_steps,
-        #                     callbacks=[ckpt_cb, tb])
+        #                     callbacks=[tb])
 
         lr_manager = LearningRateSchedule(steps_per_epoch=steps_per_epoch,
                                           initial_learning_rate=FLAGS.base_learning_rate,
@@ -190,17 +245,8 @@ def main(argv):
                                           epochs_drop=FLAGS.lr_decay_epochs,
                                           warmup_epochs=FLAGS.lr_warmup_epochs)
         
-        train = Train(epochs=FLAGS.train_epochs,
-                      batch_size=FLAGS.batch_size,
-                      enable_function=True,
-                      model=model,
-                      optimizer=optimiser,
-                      loss_func=loss_fn,
-                      lr_manager=lr_manager,
-                      predict_slice=FLAGS.which_slice,
-                      metrics=metrics,
-                      tfrec_dir='./Data/tfrecords/',
-                      log_dir="logs")
+        train = get_train(strategy, model, optimiser, loss_fn, lr_manager, num_classes,
+                          steps_per_epoch, validation_steps)
 
         log_dir_now = train.train_model_loop(train_ds=train_ds,
                                              valid_ds=valid_ds,
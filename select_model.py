@@ -1,3 +1,5 @@
+import functools
+
 from Segmentation.model.unet import UNet, R2_UNet, Nested_UNet, Nested_UNet_v2
 from Segmentation.model.segnet import SegNet
 from Segmentation.model.deeplabv3 import Deeplabv3, Deeplabv3_plus
@@ -27,16 +29,16 @@ def select_model(FLAGS, num_classes):
         model_fn = UNet
     elif FLAGS.model_architecture == 'vnet':
         model_args = [FLAGS.num_filters,
-                      num_classes,
-                      FLAGS.use_2d,
-                      FLAGS.num_conv,
-                      FLAGS.kernel_size,
-                      FLAGS.activation,
-                      FLAGS.use_batchnorm,
-                      FLAGS.dropout_rate,
-                      FLAGS.use_spatial,
-                      FLAGS.channel_order]
-        model_fn = VNet
+                      num_classes]
+        # by keyword, VNet takes noise where the other models take dropout_rate
+        model_fn = functools.partial(VNet,
+                                     use_2d=FLAGS.use_2d,
+                                     num_conv_layers=FLAGS.num_conv,
+                                     kernel_size=FLAGS.kernel_size,
+                                     activation=FLAGS.activation,
+                                     use_batchnorm=FLAGS.use_batchnorm,
+                                     dropout_rate=FLAGS.dropout_rate,
+                                     use_spatial_dropout=FLAGS.use_spatial)
     elif FLAGS.model_architecture == 'r2unet':
         model_args = [FLAGS.num_filters,
                       num_classes,
@@ -142,3 +144,6 @@ def select_model(FLAGS, num_classes):
 
     else:
         logging.error('The model architecture {} is not supported!'.format(FLAGS.model_architecture))
+        return None, None
+
+    return model_fn, model_args